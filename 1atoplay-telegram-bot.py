@@ -1,18 +1,66 @@
 import sqlite3
 import uuid
+import secrets
+import queue
+import asyncio
+import functools
+import collections
+import itertools
+import heapq
+import bisect
+import contextvars
+import csv
+import json
+import io
+import threading
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from types import MappingProxyType
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram.ext import Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ContextTypes, filters
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.helpers import escape_markdown
 import os
 import warnings
 import logging
+import logging.handlers
+import atexit
 
-# Enable logging for debugging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves all formatting to the listener thread.
+    
+    The stock prepare() renders every record in the thread that logs it.
+    Log calls here pass only IDs, amounts and strings as arguments, so the
+    record can be queued as it is and merged with its arguments later.
+    """
+    
+    def prepare(self, record):
+        return record
+
+# Logging calls only put the record on a queue; log_listener's thread
+# formats it and writes it to stderr, off the event loop
+log_queue = queue.SimpleQueue()
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+logging.basicConfig(level=logging.INFO, handlers=[DeferredQueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# httpx logs every Bot API request at INFO
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+# Audit events (purchases, payments, admin actions) and lifecycle go to
+# logger; per-update chatter goes to update_logger, which is rate limited
 logger = logging.getLogger(__name__)
+update_logger = logging.getLogger(f'{__name__}.updates')
+
+# Startup phases are timed from here (after the telegram imports)
+STARTUP_STARTED = time.perf_counter()
+startup_timings = {}  # phase -> seconds since STARTUP_STARTED
 
 # Suppress ALL warnings
 warnings.filterwarnings("ignore")
@@ -21,112 +69,575 @@ warnings.filterwarnings("ignore")
 TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN', '8505602493:AAF8fznj0OA3OqVstBDt-Zn9MkQ8DjPh5vw')
 ADMIN_IDS = [5911406948, 5510368247]  # Initial admins - 5911406948 is super admin
 
-# Make prices editable
-PRODUCT_PRICES = {
-    '3d': 280,
-    '10d': 560,
-    '30d': 1250
+# Webhook mode: set ATOPLAY_WEBHOOK_URL to the public HTTPS base URL, otherwise the bot polls
+WEBHOOK_URL = os.environ.get('ATOPLAY_WEBHOOK_URL')
+WEBHOOK_LISTEN = os.environ.get('ATOPLAY_WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('ATOPLAY_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('ATOPLAY_WEBHOOK_PATH', 'telegram')
+# Telegram sends this back in X-Telegram-Bot-Api-Secret-Token; a random one is used per run if unset
+WEBHOOK_SECRET = os.environ.get('ATOPLAY_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+
+# Only the update types the bot has handlers for (photos arrive as messages)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Products seeded into the products table on first run; after that the table is the catalog
+DEFAULT_PRODUCTS = [
+    # (key_type, name, days, price)
+    ('3d', '3-Day Key', 3, 280),
+    ('10d', '10-Day Key', 10, 560),
+    ('30d', '30-Day Key', 30, 1250)
+]
+PRODUCT_COLUMNS = ('product_id', 'key_type', 'name', 'days', 'price', 'is_active')
+# key_type ends up in commands and callback data (/addkey_<type>, /price_<type>)
+PRODUCT_KEY_TYPE_MAX_LENGTH = 16
+
+# /stock pagination
+STOCK_PAGE_SIZE = 20
+STOCK_STATUS_CODES = {'a': 'available', 'u': 'used'}
+
+# /mykeys pagination
+MY_KEYS_PAGE_SIZE = 10
+MY_KEYS_CACHE_SIZE = 1024
+
+# Outbound delivery to admins
+ADMIN_FANOUT_CONCURRENCY = 8
+SEND_MAX_RETRIES = 3
+
+# Outbound send scheduler (Telegram allows ~30 msg/s overall, ~1 msg/s per chat)
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_GLOBAL_BURST = 5
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 3
+OUTBOUND_CHAT_BUCKETS_MAX = 10000
+OUTBOUND_THROTTLED_ENDPOINTS = {
+    'sendMessage', 'forwardMessage', 'copyMessage', 'sendPhoto', 'sendDocument',
+    'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup'
 }
 
-PAYMENT_METHODS = {
+# Send priorities, lower goes first
+SEND_PRIORITY_KEY_DELIVERY = 0
+SEND_PRIORITY_REPLY = 1
+SEND_PRIORITY_NOTIFICATION = 2
+SEND_PRIORITY_BULK = 3
+
+# /broadcast pacing, kept under OUTBOUND_GLOBAL_RATE to leave room for purchases
+BROADCAST_BATCH_SIZE = 100
+BROADCAST_CONCURRENCY = 10
+BROADCAST_RATE = 20
+
+# Conversation state (context.user_data / chat_data) write-behind interval, seconds
+CONVERSATION_FLUSH_INTERVAL = 1.0
+
+# Concurrent update processing; each user's updates still run one at a time
+UPDATE_CONCURRENCY = 64
+
+# update_logger records let through per second (and burst); the rest are counted and skipped
+UPDATE_LOG_RATE = 5
+UPDATE_LOG_BURST = 20
+
+# Latency histogram bucket upper bounds in seconds (plus a +Inf bucket)
+METRICS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# /metrics lists this many of the busiest handlers and DB calls
+METRICS_TOP = 15
+# Prometheus text endpoint on 127.0.0.1; 0 disables it
+METRICS_PORT = int(os.environ.get('ATOPLAY_METRICS_PORT', '0'))
+
+# Bulk key import limits
+KEY_IMPORT_CHUNK_SIZE = 500
+KEY_MAX_LENGTH = 64
+KEY_FILE_MAX_BYTES = 5 * 1024 * 1024
+
+# Default payment details; /setupi and /setqr override them in the settings table
+DEFAULT_PAYMENT_METHODS = {
     'easypaisa': {'name': 'Easypaisa', 'number': '03431178575'},
     'binance': {'name': 'Binance', 'number': '335277914'},
     'upi': {'name': 'UPI', 'number': 'trustedprem9719472@ybl', 'qr_code': None}
 }
 
-def get_products():
-    """Get products with current prices"""
-    return {
-        'product_3d': {'name': '3-Day Key', 'price': PRODUCT_PRICES['3d'], 'days': 3},
-        'product_10d': {'name': '10-Day Key', 'price': PRODUCT_PRICES['10d'], 'days': 10},
-        'product_30d': {'name': '30-Day Key', 'price': PRODUCT_PRICES['30d'], 'days': 30}
-    }
+# Static keyboards, built once
+PAYMENT_METHOD_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Easypaisa", callback_data='payment_easypaisa'),
+        InlineKeyboardButton("Binance", callback_data='payment_binance')
+    ],
+    [
+        InlineKeyboardButton("UPI", callback_data='payment_upi'),
+        InlineKeyboardButton("❌ Cancel", callback_data='cancel')
+    ]
+])
+
+ADD_BALANCE_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("₹500", callback_data='amount_500'),
+        InlineKeyboardButton("₹1000", callback_data='amount_1000'),
+        InlineKeyboardButton("₹2000", callback_data='amount_2000')
+    ],
+    [
+        InlineKeyboardButton("Other Amount", callback_data='amount_other'),
+        InlineKeyboardButton("❌ Cancel", callback_data='cancel')
+    ]
+])
+
+BALANCE_CHOICE_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("💳 Use Balance", callback_data='use_balance'),
+        InlineKeyboardButton("💸 New Payment", callback_data='new_payment')
+    ],
+    [InlineKeyboardButton("❌ Cancel", callback_data='cancel')]
+])
+
+CANCEL_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data='cancel')]])
+
+ADMIN_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("🛒 Buy Keys"), KeyboardButton("🔧 Admin Panel")],
+    [KeyboardButton("💳 Check Balance"), KeyboardButton("🔑 My Keys")],
+    [KeyboardButton("📞 Contact"), KeyboardButton("📢 Channel")]
+], resize_keyboard=True)
+
+USER_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    [KeyboardButton("🛒 Buy Keys")],
+    [KeyboardButton("💳 Check Balance"), KeyboardButton("🔑 My Keys")],
+    [KeyboardButton("📞 Contact"), KeyboardButton("📢 Channel")]
+], resize_keyboard=True)
+
+# Database settings
+DB_PATH = os.environ.get('ATOPLAY_DB_PATH', 'atoplay_bot.db')
+DB_POOL_SIZE = int(os.environ.get('ATOPLAY_DB_POOL_SIZE', '4'))
+
+class ConnectionPool:
+    """Small pool of long-lived SQLite connections shared by all handlers.
+
+    Connections are opened lazily (up to ``size``), tuned once with WAL
+    pragmas and then reused, so every statement hits sqlite3's per-connection
+    prepared statement cache instead of being re-parsed on a fresh connection.
+    Connections run in autocommit mode; multi-statement writes must go
+    through ``transaction()`` which takes the write lock up front.
+    """
+
+    def __init__(self, path, size=4):
+        self.path = path
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA busy_timeout=30000')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-16000')
+        return conn
+
+    def acquire(self):
+        """Get an idle connection, opening a new one while under the limit"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        
+        return self._idle.get()
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any open transaction"""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Run a block of statements as one write transaction"""
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
 
-def init_db():
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
-    # USERS table with ALL columns
-    cursor.execute('''CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        telegram_id INTEGER UNIQUE,
-        username TEXT,
-        balance REAL DEFAULT 0,
-        unique_id TEXT UNIQUE,
-        is_blocked INTEGER DEFAULT 0,
-        blocked_reason TEXT,
-        blocked_at TIMESTAMP,
-        is_admin INTEGER DEFAULT 0,
-        added_by INTEGER
-    )''')
+    def close_all(self):
+        """Close every idle connection (used on shutdown)"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+db_pool = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+
+# Dedicated threads for blocking SQLite work, one per pooled connection
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='atoplay-db')
+
+class LatencyHistogram:
+    """Call count, error count and latency distribution of one handler or DB helper.
     
-    cursor.execute('''CREATE TABLE IF NOT EXISTS transactions (
-        transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        amount REAL,
-        payment_method TEXT,
-        screenshot TEXT,
-        status TEXT DEFAULT 'pending',
-        admin_id INTEGER,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+    Latencies are counted into fixed buckets (METRICS_BUCKETS plus +Inf)
+    in a preallocated list, so recording one is a bisect and a few
+    additions. Only updated from the event loop thread, so no lock.
+    """
     
-    cursor.execute('''CREATE TABLE IF NOT EXISTS keys_stock (
-        key_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        key_value TEXT UNIQUE,
-        key_type TEXT,  -- '3d', '10d', '30d'
-        status TEXT DEFAULT 'available',  -- 'available', 'used'
-        used_by INTEGER,
-        used_at TIMESTAMP,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+    __slots__ = ('buckets', 'count', 'errors', 'total')
     
-    cursor.execute('''CREATE TABLE IF NOT EXISTS user_keys (
-        user_key_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        key_value TEXT,
-        key_type TEXT,
-        purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        status TEXT DEFAULT 'active'  -- 'active', 'expired'
-    )''')
+    def __init__(self):
+        self.buckets = [0] * (len(METRICS_BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
     
-    cursor.execute('''CREATE TABLE IF NOT EXISTS admin_logs (
-        log_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        admin_id INTEGER,
-        action TEXT,
-        target_user_id INTEGER,
-        details TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
+    def observe(self, seconds, error=False):
+        self.buckets[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
     
-    cursor.execute('''CREATE TABLE IF NOT EXISTS settings (
-        setting_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        setting_key TEXT UNIQUE,
-        setting_value TEXT,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (inf past the last bound)"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(METRICS_BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+class Instrumentation:
+    """Latency histograms for every handler and every run_db() helper, by name.
+    
+    wrap_handler() times a handler callback; run_db() times the helper it
+    runs, including the wait for a free DB thread, since that is what the
+    handler awaiting it sees.
+    """
+    
+    def __init__(self):
+        self.handlers = collections.defaultdict(LatencyHistogram)
+        self.db = collections.defaultdict(LatencyHistogram)
+    
+    def wrap_handler(self, callback):
+        if hasattr(callback, '__wrapped__'):
+            return callback
+        histogram = self.handlers[callback.__name__]
+        
+        @functools.wraps(callback)
+        async def timed(update, context):
+            started = time.perf_counter()
+            try:
+                result = await callback(update, context)
+            except Exception:
+                histogram.observe(time.perf_counter() - started, error=True)
+                raise
+            histogram.observe(time.perf_counter() - started)
+            return result
+        
+        return timed
+
+instrumentation = Instrumentation()
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking data-access helper on the DB executor and await its result.
+
+    Each helper opens and commits its own transaction inside the executor
+    thread, so transaction boundaries are the same as calling it directly.
+    """
+    loop = asyncio.get_running_loop()
+    histogram = instrumentation.db[func.__qualname__]
+    started = time.perf_counter()
+    try:
+        result = await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+    except Exception:
+        histogram.observe(time.perf_counter() - started, error=True)
+        raise
+    histogram.observe(time.perf_counter() - started)
+    return result
+
+# Recompute daily_stats from users and transactions. Users registered
+# before created_at existed are counted on 1970-01-01 so totals still add up.
+DAILY_STATS_BACKFILL = [
+    'DELETE FROM daily_stats',
+    '''INSERT INTO daily_stats (day, new_users)
+       SELECT DATE(COALESCE(created_at, '1970-01-01')), COUNT(*)
+       FROM users GROUP BY 1''',
+    '''INSERT INTO daily_stats (day, transactions, approved_transactions, revenue)
+       SELECT DATE(created_at), COUNT(*),
+              SUM(status = 'approved'),
+              COALESCE(SUM(CASE WHEN status = 'approved' THEN amount END), 0)
+       FROM transactions WHERE true GROUP BY 1
+       ON CONFLICT (day) DO UPDATE SET
+           transactions = excluded.transactions,
+           approved_transactions = excluded.approved_transactions,
+           revenue = excluded.revenue'''
+]
+
+# Ordered schema migrations: (version, description, statements).
+# Never edit an applied migration - append a new one instead.
+SCHEMA_MIGRATIONS = [
+    (1, "Base tables", [
+        # USERS table with ALL columns
+        '''CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER UNIQUE,
+            username TEXT,
+            balance REAL DEFAULT 0,
+            unique_id TEXT UNIQUE,
+            is_blocked INTEGER DEFAULT 0,
+            blocked_reason TEXT,
+            blocked_at TIMESTAMP,
+            is_admin INTEGER DEFAULT 0,
+            added_by INTEGER
+        )''',
+        '''CREATE TABLE IF NOT EXISTS transactions (
+            transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            amount REAL,
+            payment_method TEXT,
+            screenshot TEXT,
+            status TEXT DEFAULT 'pending',
+            admin_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS keys_stock (
+            key_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key_value TEXT UNIQUE,
+            key_type TEXT,  -- products.key_type, e.g. '3d'
+            status TEXT DEFAULT 'available',  -- 'available', 'used'
+            used_by INTEGER,
+            used_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS user_keys (
+            user_key_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            key_value TEXT,
+            key_type TEXT,
+            purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'active'  -- 'active', 'expired'
+        )''',
+        '''CREATE TABLE IF NOT EXISTS admin_logs (
+            log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            action TEXT,
+            target_user_id INTEGER,
+            details TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS settings (
+            setting_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            setting_key TEXT UNIQUE,
+            setting_value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )'''
+    ]),
+    (2, "Indexes for hot queries", [
+        # Purchase key lookup, stock counts and the /stock listing
+        '''CREATE INDEX IF NOT EXISTS idx_keys_stock_type_status_created
+           ON keys_stock (key_type, status, created_at)''',
+        # Case insensitive duplicate check in /addkey and /delkey
+        '''CREATE INDEX IF NOT EXISTS idx_keys_stock_value_nocase
+           ON keys_stock (key_value COLLATE NOCASE)''',
+        # /mykeys history
+        '''CREATE INDEX IF NOT EXISTS idx_user_keys_user_purchased
+           ON user_keys (user_id, purchased_at)''',
+        # Revenue totals and today's range in /stats (covering amount)
+        '''CREATE INDEX IF NOT EXISTS idx_transactions_status_created
+           ON transactions (status, created_at, amount)''',
+        # /userinfo purchase totals
+        '''CREATE INDEX IF NOT EXISTS idx_transactions_user_status
+           ON transactions (user_id, status)''',
+        # Admin and blocked user lookups
+        '''CREATE INDEX IF NOT EXISTS idx_users_admin
+           ON users (is_admin) WHERE is_admin = 1''',
+        '''CREATE INDEX IF NOT EXISTS idx_users_blocked
+           ON users (is_blocked) WHERE is_blocked = 1'''
+    ]),
+    (3, "Per-type /mykeys pages", [
+        '''CREATE INDEX IF NOT EXISTS idx_user_keys_user_type_purchased
+           ON user_keys (user_id, key_type, purchased_at)'''
+    ]),
+    (4, "Daily stats rollup", [
+        # Users had no registration time; existing rows stay NULL
+        'ALTER TABLE users ADD COLUMN created_at TIMESTAMP',
+        '''CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT PRIMARY KEY,  -- 'YYYY-MM-DD' (UTC, same as CURRENT_TIMESTAMP)
+            new_users INTEGER NOT NULL DEFAULT 0,
+            transactions INTEGER NOT NULL DEFAULT 0,
+            approved_transactions INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0
+        )'''
+    ] + DAILY_STATS_BACKFILL),
+    (5, "Broadcast jobs", [
+        # Set when a broadcast finds the user blocked the bot, cleared on /start
+        'ALTER TABLE users ADD COLUMN bot_blocked_at TIMESTAMP',
+        '''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            message TEXT,
+            status TEXT DEFAULT 'running',  -- 'running', 'done', 'cancelled'
+            last_user_id INTEGER NOT NULL DEFAULT 0,  -- keyset cursor on users.user_id
+            total_users INTEGER NOT NULL DEFAULT 0,
+            sent_count INTEGER NOT NULL DEFAULT 0,
+            blocked_count INTEGER NOT NULL DEFAULT 0,
+            failed_count INTEGER NOT NULL DEFAULT 0,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )'''
+    ]),
+    (6, "Conversation state", [
+        '''CREATE TABLE IF NOT EXISTS conversation_state (
+            scope TEXT,  -- 'user', 'chat'
+            id INTEGER,  -- telegram user/chat ID
+            data TEXT,  -- JSON of context.user_data / chat_data
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (scope, id)
+        ) WITHOUT ROWID'''
+    ]),
+    (7, "Product catalog", [
+        '''CREATE TABLE IF NOT EXISTS products (
+            product_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key_type TEXT UNIQUE,  -- keys_stock.key_type, e.g. '3d'
+            name TEXT,
+            days INTEGER,
+            price INTEGER,
+            is_active INTEGER DEFAULT 1,  -- 0 = hidden from the buy menu
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        # Seed the built-in products, keeping prices already changed with /price_*
+        *[f'''INSERT OR IGNORE INTO products (key_type, name, days, price)
+               VALUES ('{key_type}', '{name}', {days},
+                       COALESCE((SELECT CAST(setting_value AS INTEGER) FROM settings
+                                 WHERE setting_key = 'price_{key_type}'), {price}))'''
+          for key_type, name, days, price in DEFAULT_PRODUCTS],
+        "DELETE FROM settings WHERE setting_key LIKE 'price!_%' ESCAPE '!'"
+    ]),
+    (8, "Status-filtered /stock pages", [
+        # /stock filtered by status across all types; key_type keeps the page order
+        '''CREATE INDEX IF NOT EXISTS idx_keys_stock_status_type_created
+           ON keys_stock (status, key_type, created_at)'''
+    ])
+]
+
+def get_schema_version(conn):
+    """Get the highest applied migration version (0 for a fresh database)"""
+    conn.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     )''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+def bump_daily_stats(conn, day=None, new_users=0, transactions=0, approved_transactions=0, revenue=0):
+    """Add to one day's daily_stats row (today by default).
+
+    Call with the connection of the write transaction that made the change
+    so the rollup can never drift from the underlying tables.
+    """
+    conn.execute('''INSERT INTO daily_stats (day, new_users, transactions, approved_transactions, revenue)
+                      VALUES (COALESCE(?, DATE('now')), ?, ?, ?, ?)
+                      ON CONFLICT (day) DO UPDATE SET
+                          new_users = new_users + excluded.new_users,
+                          transactions = transactions + excluded.transactions,
+                          approved_transactions = approved_transactions + excluded.approved_transactions,
+                          revenue = revenue + excluded.revenue''',
+                 (day, new_users, transactions, approved_transactions, revenue))
+
+def rebuild_daily_stats():
+    """Backfill daily_stats from scratch and return the number of days"""
+    with db_pool.transaction() as conn:
+        for statement in DAILY_STATS_BACKFILL:
+            conn.execute(statement)
+        return conn.execute('SELECT COUNT(*) FROM daily_stats').fetchone()[0]
+
+def migrate_db():
+    """Apply pending schema migrations in order, one transaction each"""
+    applied = []
+    
+    # Up-to-date database (every start but the first): one read, no write lock
+    with db_pool.connection() as conn:
+        if get_schema_version(conn) >= SCHEMA_MIGRATIONS[-1][0]:
+            return applied
     
-    # Add initial super admin (5911406948)
-    cursor.execute('''INSERT OR IGNORE INTO users 
-                      (telegram_id, username, is_admin) 
-                      VALUES (?, 'Super Admin', 1)''', (5911406948,))
+    for version, description, statements in SCHEMA_MIGRATIONS:
+        with db_pool.transaction() as conn:
+            # Re-check inside the write lock in case another process migrated
+            if version <= get_schema_version(conn):
+                continue
+            
+            for statement in statements:
+                conn.execute(statement)
+            
+            conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                         (version, description))
+        
+        applied.append(version)
+        logger.info("Applied schema migration %s: %s", version, description)
     
-    # Add other initial admin
-    cursor.execute('''INSERT OR IGNORE INTO users 
-                      (telegram_id, username, is_admin) 
-                      VALUES (?, 'Admin', 1)''', (5510368247,))
+    if applied:
+        with db_pool.connection() as conn:
+            conn.execute('ANALYZE')
     
-    conn.commit()
-    conn.close()
-    print("✅ Database tables created successfully with ALL columns!")
-    print("✅ Super Admin (5911406948) added!")
-    print("✅ Admin (5510368247) added!")
+    return applied
+
+def seed_db():
+    """One-time setup: `python 1atoplay-telegram-bot.py seed`. Safe to re-run."""
+    applied = migrate_db()
+    print(f"✅ Database schema is up to date ({len(applied)} migrations applied)")
+    
+    with db_pool.transaction() as conn:
+        cursor = conn.cursor()
+        
+        # Add initial admins, the first one is the super admin
+        new_users = 0
+        for admin_id in ADMIN_IDS:
+            cursor.execute('''INSERT OR IGNORE INTO users 
+                              (telegram_id, username, is_admin, created_at) 
+                              VALUES (?, ?, 1, CURRENT_TIMESTAMP)''',
+                           (admin_id, 'Super Admin' if admin_id == ADMIN_IDS[0] else 'Admin'))
+            new_users += cursor.rowcount
+        
+        if new_users:
+            bump_daily_stats(conn, new_users=new_users)
+    
+    print(f"✅ Admins {', '.join(map(str, ADMIN_IDS))} added!")
+    
+    add_sample_keys()
 
 def add_sample_keys():
     """Add real keys provided by user - ONLY REAL KEYS"""
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
     # ONLY REAL KEYS FROM USER'S MESSAGES
     real_keys = {
         '3d': [
@@ -145,44 +656,209 @@ def add_sample_keys():
         ]
     }
     
-    for key_type, keys in real_keys.items():
-        for key_value in keys:
-            cursor.execute('''INSERT OR IGNORE INTO keys_stock (key_value, key_type) 
-                              VALUES (?, ?)''', (key_value, key_type))
+    with db_pool.transaction() as conn:
+        conn.executemany('''INSERT OR IGNORE INTO keys_stock (key_value, key_type) 
+                              VALUES (?, ?)''',
+                         [(key_value, key_type)
+                          for key_type, keys in real_keys.items()
+                          for key_value in keys])
     
-    conn.commit()
-    conn.close()
     print("✅ ONLY REAL KEYS ADDED (EXACTLY AS PROVIDED)!")
 
+class StockCounters:
+    """Available key count per key_type, kept in memory.
+
+    Rebuilt from keys_stock in post_init, before any update is handled
+    (or lazily on first use outside the bot), and then adjusted by the key
+    add/delete/sale helpers once their write transaction has committed, so
+    reading stock never scans keys_stock. Rebuilding while writes are in
+    flight can miss or double-count them. ``version`` changes whenever a
+    count may have changed.
+    """
+
+    def __init__(self):
+        self._counts = None
+        self._lock = threading.Lock()
+        self.version = 0
+
+    def rebuild(self):
+        with db_pool.connection() as conn:
+            stock_data = conn.execute('''SELECT key_type, COUNT(*) as available
+                                      FROM keys_stock 
+                                      WHERE status = 'available'
+                                      GROUP BY key_type''').fetchall()
+        
+        with self._lock:
+            self._counts = dict(stock_data)
+            self.version += 1
+
+    def adjust(self, key_type, delta):
+        if self._counts is None:
+            # Not built yet - the rebuild will see the committed change
+            return
+        with self._lock:
+            counts = dict(self._counts)
+            counts[key_type] = max(counts.get(key_type, 0) + delta, 0)
+            self._counts = counts
+            self.version += 1
+
+    def snapshot(self):
+        counts = self._counts
+        if counts is None:
+            self.rebuild()
+            counts = self._counts
+        return dict(counts)
+
+stock_counters = StockCounters()
+
 def get_stock_info():
     """Get current stock information"""
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''SELECT key_type, 
-                             SUM(CASE WHEN status = 'available' THEN 1 ELSE 0 END) as available
-                      FROM keys_stock 
-                      GROUP BY key_type''')
-    
-    stock_data = cursor.fetchall()
-    conn.close()
-    
-    stock_info = {}
-    for key_type, available in stock_data:
-        stock_info[key_type] = available
-    
-    return stock_info
+    return stock_counters.snapshot()
+
+# Key queue refill tuning
+KEY_QUEUE_BATCH_SIZE = 100
+KEY_QUEUE_LOW_WATERMARK = 20
+
+class KeyQueue:
+    """Prefetched FIFO of available key IDs per key_type.
+
+    Only IDs are held in memory; the key stays 'available' in keys_stock
+    until a purchase confirms it with a conditional UPDATE. A crash or
+    restart therefore loses nothing (the next refill simply reads the key
+    again) and a stale ID can never be sold twice - its confirming UPDATE
+    just matches no row and the next ID is tried.
+
+    Each type refills in batches once it drops below the low watermark,
+    reading forward from a (created_at, key_id) cursor so IDs already
+    queued are never fetched again.
+    """
+
+    def __init__(self, batch_size=KEY_QUEUE_BATCH_SIZE, low_watermark=KEY_QUEUE_LOW_WATERMARK):
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self._queues = collections.defaultdict(collections.deque)
+        self._cursors = {}
+        self._exhausted = {}
+        self._lock = threading.Lock()
+
+    def _refill(self, conn, key_type):
+        cursor_created, cursor_id = self._cursors.get(key_type, ('', 0))
+        rows = conn.execute('''SELECT key_id, created_at FROM keys_stock 
+                               WHERE key_type = ? AND status = 'available' 
+                               AND (created_at, key_id) > (?, ?)
+                               ORDER BY created_at, key_id 
+                               LIMIT ?''',
+                            (key_type, cursor_created, cursor_id, self.batch_size)).fetchall()
+        
+        self._queues[key_type].extend(key_id for key_id, _ in rows)
+        if rows:
+            self._cursors[key_type] = (rows[-1][1], rows[-1][0])
+        self._exhausted[key_type] = len(rows) < self.batch_size
+
+    def pop(self, conn, key_type):
+        """Take the next candidate key ID, refilling from the DB if needed"""
+        with self._lock:
+            queue_ = self._queues[key_type]
+            if len(queue_) < self.low_watermark and not self._exhausted.get(key_type):
+                self._refill(conn, key_type)
+            if not queue_:
+                # Pick up keys added since the last refill
+                self._refill(conn, key_type)
+            return queue_.popleft() if queue_ else None
+
+    def push(self, key_type, key_id, created_at):
+        """Queue a newly inserted key if the cursor has already passed the end"""
+        with self._lock:
+            if self._exhausted.get(key_type):
+                self._queues[key_type].append(key_id)
+                self._cursors[key_type] = (created_at, key_id)
+
+    def requeue(self, key_type, key_id):
+        """Put back a key ID whose purchase was rolled back"""
+        with self._lock:
+            self._queues[key_type].appendleft(key_id)
+
+    def discard(self, key_type, key_id):
+        """Forget a deleted key"""
+        with self._lock:
+            try:
+                self._queues[key_type].remove(key_id)
+            except ValueError:
+                pass
+
+    def invalidate(self, key_type):
+        """Make the next pop refill, e.g. after a bulk import"""
+        with self._lock:
+            self._exhausted[key_type] = False
+
+    def reset(self):
+        with self._lock:
+            self._queues.clear()
+            self._cursors.clear()
+            self._exhausted.clear()
+
+key_queue = KeyQueue()
+
+class AdminCache:
+    """Process-wide set of admin telegram IDs (with usernames).
+
+    Loaded from the users table on first use, then kept in sync by
+    grant()/revoke() whenever an admin is added or removed. Updates build a
+    new dict and swap it in, so lookups never take a lock or touch the DB.
+    ``hits`` counts role checks that found an admin, ``misses`` the rest.
+    """
+
+    def __init__(self):
+        self._admins = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _read(self):
+        with db_pool.connection() as conn:
+            return dict(conn.execute('''SELECT telegram_id, username 
+                                        FROM users WHERE is_admin = 1''').fetchall())
+
+    def load(self):
+        admins = self._read()
+        with self._lock:
+            self._admins = admins
+
+    def _current(self):
+        admins = self._admins
+        if admins is None:
+            self.load()
+            admins = self._admins
+        return admins
+
+    def contains(self, user_id):
+        if user_id in self._current():
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def grant(self, user_id, username):
+        with self._lock:
+            # Not loaded yet: start from the table, not an empty set
+            admins = dict(self._admins if self._admins is not None else self._read())
+            admins[user_id] = username
+            self._admins = admins
+
+    def revoke(self, user_id):
+        with self._lock:
+            admins = dict(self._admins if self._admins is not None else self._read())
+            admins.pop(user_id, None)
+            self._admins = admins
+
+    def items(self):
+        return list(self._current().items())
+
+admin_cache = AdminCache()
 
 def is_admin(user_id):
     """Check if user is admin"""
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('SELECT is_admin FROM users WHERE telegram_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    return result and result[0] == 1
+    return admin_cache.contains(user_id)
 
 def is_super_admin(user_id):
     """Check if user is super admin (5911406948)"""
@@ -190,53 +866,945 @@ def is_super_admin(user_id):
 
 def get_all_admins():
     """Get all admin users"""
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''SELECT telegram_id, username, is_admin 
-                      FROM users WHERE is_admin = 1''')
-    admins = cursor.fetchall()
-    conn.close()
-    
-    return admins
+    return [(telegram_id, username, 1) for telegram_id, username in admin_cache.items()]
 
 def log_admin_action(admin_id, action, target_user_id, details=""):
     """Log admin actions"""
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
+    with db_pool.connection() as conn:
+        conn.execute('''INSERT INTO admin_logs (admin_id, action, target_user_id, details) 
+                          VALUES (?, ?, ?, ?)''',
+                     (admin_id, action, target_user_id, details))
+
+def is_user_blocked(user_id):
+    """Check if user is blocked"""
+    with db_pool.connection() as conn:
+        result = conn.execute('SELECT is_blocked FROM users WHERE telegram_id = ?', (user_id,)).fetchone()
+    
+    return result and result[0] == 1
+
+def get_user_profile(user_id):
+    """Get (balance, unique_id, is_blocked, is_admin, bot_blocked_at) for a telegram user"""
+    with db_pool.connection() as conn:
+        return conn.execute('SELECT balance, unique_id, is_blocked, is_admin, bot_blocked_at FROM users WHERE telegram_id = ?',
+                            (user_id,)).fetchone()
+
+def clear_bot_blocked(user_id):
+    """Include a user in broadcasts again after they came back to the bot"""
+    with db_pool.connection() as conn:
+        conn.execute('UPDATE users SET bot_blocked_at = NULL WHERE telegram_id = ?', (user_id,))
+
+def register_user(user_id, username, is_admin_user):
+    """Create a new user row and return its unique ID"""
+    unique_id = str(uuid.uuid4())[:8].upper()
+    with db_pool.transaction() as conn:
+        conn.execute('INSERT INTO users (telegram_id, username, unique_id, balance, is_blocked, is_admin, created_at) VALUES (?, ?, ?, ?, 0, ?, CURRENT_TIMESTAMP)', 
+                     (user_id, username, unique_id, 0, is_admin_user))
+        bump_daily_stats(conn, new_users=1)
     
-    cursor.execute('''INSERT INTO admin_logs (admin_id, action, target_user_id, details) 
-                      VALUES (?, ?, ?, ?)''',
-                   (admin_id, action, target_user_id, details))
+    my_keys_cache.invalidate(user_id)
+    if is_admin_user == 1:
+        admin_cache.grant(user_id, username)
     
-    conn.commit()
-    conn.close()
+    return unique_id
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Start command received from user: {update.effective_user.id}")
+def get_user_balance(user_id):
+    """Get user balance (0 for unknown users)"""
+    with db_pool.connection() as conn:
+        result = conn.execute('SELECT balance FROM users WHERE telegram_id = ?', (user_id,)).fetchone()
     
+    return result[0] if result else 0
+
+def get_user_db_id(user_id):
+    """Get the internal users.user_id for a telegram user"""
+    with db_pool.connection() as conn:
+        result = conn.execute('SELECT user_id FROM users WHERE telegram_id = ?', (user_id,)).fetchone()
+    
+    return result[0] if result else None
+
+def claim_key(conn, key_type, user_db_id):
+    """Mark the oldest available key of a type as used and return (key_id, key_value).
+
+    Must run inside a write transaction. Candidates come from key_queue and
+    are confirmed with an UPDATE that re-checks the status of the row, so
+    a key can never be handed out twice. Returns None when the type is
+    out of stock.
+    """
+    while True:
+        key_id = key_queue.pop(conn, key_type)
+        if key_id is None:
+            return None
+        
+        key_data = conn.execute('''UPDATE keys_stock 
+                                    SET status = 'used', used_by = ?, used_at = CURRENT_TIMESTAMP
+                                    WHERE key_id = ? AND status = 'available'
+                                    RETURNING key_id, key_value''',
+                                (user_db_id, key_id)).fetchone()
+        if key_data:
+            return key_data
+
+def purchase_with_balance(user_id, key_type, price):
+    """Sell one available key for balance in a single write transaction.
+
+    The balance is debited with a conditional UPDATE (never below zero)
+    and the key is claimed FIFO by created_at; if either step fails the
+    whole transaction is rolled back.
+
+    Returns a (status, data) tuple where status is one of 'no_user',
+    'insufficient' (data = balance), 'out_of_stock' or 'ok'
+    (data = (key_value, new_balance)).
+    """
+    key_data = None
     try:
-        user = update.effective_user
-        user_id = user.id
+        with db_pool.transaction() as conn:
+            cursor = conn.cursor()
+            
+            # Deduct balance only if it covers the price
+            cursor.execute('''UPDATE users SET balance = balance - ? 
+                              WHERE telegram_id = ? AND balance >= ?
+                              RETURNING user_id, balance''',
+                           (price, user_id, price))
+            user_data = cursor.fetchone()
+            
+            if not user_data:
+                cursor.execute('SELECT balance FROM users WHERE telegram_id = ?', (user_id,))
+                balance_data = cursor.fetchone()
+                if not balance_data:
+                    return 'no_user', None
+                return 'insufficient', balance_data[0]
+            
+            user_db_id, new_balance = user_data
+            
+            # Claim the oldest available key for this product
+            key_data = claim_key(conn, key_type, user_db_id)
+            
+            if not key_data:
+                conn.rollback()
+                return 'out_of_stock', None
+            
+            key_id, key_value = key_data
+            
+            # Add to user_keys table
+            cursor.execute('''INSERT INTO user_keys (user_id, key_value, key_type) 
+                              VALUES (?, ?, ?)''',
+                           (user_db_id, key_value, key_type))
+            
+            # Create transaction record
+            cursor.execute('''INSERT INTO transactions 
+                              (user_id, amount, payment_method, status, admin_id) 
+                              VALUES (?, ?, 'balance', 'approved', 0)''',
+                           (user_db_id, price))
+            bump_daily_stats(conn, transactions=1, approved_transactions=1, revenue=price)
+    except Exception:
+        # The sale was rolled back, so the key is still available
+        if key_data:
+            key_queue.requeue(key_type, key_data[0])
+        raise
+    
+    stock_counters.adjust(key_type, -1)
+    my_keys_cache.invalidate(user_id)
+    return 'ok', (key_value, new_balance)
+
+def is_valid_key_value(key_value):
+    """Return True if a (stripped) key fits KEY_MAX_LENGTH and is printable"""
+    return 0 < len(key_value) <= KEY_MAX_LENGTH and key_value.isprintable()
+
+def add_key(key_value, key_type):
+    """Insert a key unless it already exists (case insensitive).
+
+    Returns the existing key value on a duplicate, otherwise None.
+    """
+    with db_pool.transaction() as conn:
+        existing_key = conn.execute('SELECT key_value FROM keys_stock WHERE key_value = ? COLLATE NOCASE',
+                                    (key_value,)).fetchone()
+        if existing_key:
+            return existing_key[0]
+        
+        key_id, created_at = conn.execute('''INSERT INTO keys_stock (key_value, key_type) VALUES (?, ?)
+                                             RETURNING key_id, created_at''', 
+                                          (key_value, key_type)).fetchone()
+    
+    stock_counters.adjust(key_type, 1)
+    key_queue.push(key_type, key_id, created_at)
+    return None
+
+def bulk_add_keys(key_type, key_values, admin_id):
+    """Import many keys of one type in a single write transaction.
+
+    ``key_values`` may be any iterable (e.g. a file being parsed) and is
+    consumed in chunks of KEY_IMPORT_CHUNK_SIZE. Keys are deduplicated
+    case insensitively within the batch and against keys_stock with one
+    indexed lookup per chunk, inserted with executemany, and the whole
+    import is recorded as a single admin_logs entry.
+
+    Returns (added, duplicates, rejected) where the last two are lists.
+    """
+    added = 0
+    duplicates = []
+    rejected = []
+    seen = set()
+    key_values = iter(key_values)
+    
+    with db_pool.transaction() as conn:
+        while True:
+            chunk = list(itertools.islice(key_values, KEY_IMPORT_CHUNK_SIZE))
+            if not chunk:
+                break
+            
+            candidates = []
+            for key_value in chunk:
+                key_value = key_value.strip()
+                if not key_value:
+                    continue
+                if not is_valid_key_value(key_value):
+                    rejected.append(key_value)
+                    continue
+                if key_value.lower() in seen:
+                    duplicates.append(key_value)
+                    continue
+                seen.add(key_value.lower())
+                candidates.append(key_value)
+            
+            if not candidates:
+                continue
+            
+            placeholders = ', '.join('?' * len(candidates))
+            existing = {row[0].lower() for row in conn.execute(
+                f'SELECT key_value FROM keys_stock WHERE key_value COLLATE NOCASE IN ({placeholders})',
+                candidates)}
+            
+            new_keys = []
+            for key_value in candidates:
+                if key_value.lower() in existing:
+                    duplicates.append(key_value)
+                else:
+                    new_keys.append((key_value, key_type))
+            
+            conn.executemany('INSERT INTO keys_stock (key_value, key_type) VALUES (?, ?)', new_keys)
+            added += len(new_keys)
+        
+        conn.execute('''INSERT INTO admin_logs (admin_id, action, target_user_id, details) 
+                          VALUES (?, 'bulk_add_keys', 0, ?)''',
+                     (admin_id, f"{key_type} keys: {added} added, {len(duplicates)} duplicates, "
+                                f"{len(rejected)} rejected"))
+    
+    if added:
+        stock_counters.adjust(key_type, added)
+        key_queue.invalidate(key_type)
+    
+    return added, duplicates, rejected
+
+def delete_key(key_value):
+    """Delete a key (case insensitive match) and return its (key_type, status, key_value)"""
+    with db_pool.transaction() as conn:
+        key_data = conn.execute('''SELECT key_id, key_type, status, key_value 
+                                  FROM keys_stock 
+                                  WHERE key_value = ? COLLATE NOCASE''', (key_value,)).fetchone()
+        if not key_data:
+            return None
+        
+        key_id, key_type, status, actual_key_value = key_data
+        conn.execute('DELETE FROM keys_stock WHERE key_id = ?', (key_id,))
+    
+    if status == 'available':
+        stock_counters.adjust(key_type, -1)
+        key_queue.discard(key_type, key_id)
+    return key_type, status, actual_key_value
+
+# One published set of runtime settings; never mutated once built
+SettingsSnapshot = collections.namedtuple('SettingsSnapshot', ['version', 'products', 'products_by_type',
+                                                               'products_by_id', 'payment_methods'])
+
+class RuntimeSettings:
+    """Product catalog and payment details, read from an immutable snapshot.
+    
+    Products live in the products table, payment details in the settings
+    table as '<method>_number' and '<method>_qr_code' rows over the
+    DEFAULT_PAYMENT_METHODS values. Writers commit in one transaction and
+    then publish a new snapshot by swapping ``current``, so readers just
+    take ``runtime_settings.current`` once per operation: no DB access, no
+    lock, and never half of an update.
+    
+    ``products`` holds the active products in menu order (by days);
+    ``products_by_type`` and ``products_by_id`` index every product,
+    including hidden ones, so old keys and purchases can still be labelled.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()  # serializes writers only
+        self._values = {}
+        self._products = {}
+        self.current = None
+        self._publish(self._defaults(), {
+            key_type: MappingProxyType(dict(zip(PRODUCT_COLUMNS, (None, key_type, name, days, price, 1))))
+            for key_type, name, days, price in DEFAULT_PRODUCTS
+        })
+    
+    @staticmethod
+    def _defaults():
+        values = {}
+        for method, info in DEFAULT_PAYMENT_METHODS.items():
+            values[f'{method}_number'] = info['number']
+            values[f'{method}_qr_code'] = info.get('qr_code')
+        return values
+    
+    def _publish(self, values, products):
+        payment_methods = {
+            method: MappingProxyType({
+                'name': info['name'],
+                'number': values[f'{method}_number'],
+                'qr_code': values[f'{method}_qr_code']
+            })
+            for method, info in DEFAULT_PAYMENT_METHODS.items()
+        }
+        active = sorted((product for product in products.values() if product['is_active']),
+                        key=lambda product: (product['days'], product['product_id'] or 0))
+        by_id = {product['product_id']: product for product in products.values()
+                 if product['product_id'] is not None}
+        version = self.current.version + 1 if self.current else 1
+        self._values = values
+        self._products = products
+        self.current = SettingsSnapshot(version, tuple(active), MappingProxyType(products),
+                                        MappingProxyType(by_id), MappingProxyType(payment_methods))
+    
+    @staticmethod
+    def _read_product(conn, key_type):
+        row = conn.execute(f'SELECT {", ".join(PRODUCT_COLUMNS)} FROM products WHERE key_type = ?',
+                           (key_type,)).fetchone()
+        return MappingProxyType(dict(zip(PRODUCT_COLUMNS, row)))
+    
+    def load(self):
+        """Publish the products table and the stored payment details over the defaults"""
+        values = self._defaults()
+        with db_pool.connection() as conn:
+            for setting_key, setting_value in conn.execute('SELECT setting_key, setting_value FROM settings'):
+                if setting_key in values:
+                    values[setting_key] = setting_value
+            
+            products = {}
+            for row in conn.execute(f'SELECT {", ".join(PRODUCT_COLUMNS)} FROM products'):
+                product = MappingProxyType(dict(zip(PRODUCT_COLUMNS, row)))
+                products[product['key_type']] = product
+        
+        with self._lock:
+            self._publish(values, products)
+    
+    def update(self, changes):
+        """Persist {setting_key: value} and publish it; returns the previous values"""
+        with self._lock:
+            with db_pool.transaction() as conn:
+                conn.executemany('''INSERT INTO settings (setting_key, setting_value, updated_at)
+                                    VALUES (?, ?, CURRENT_TIMESTAMP)
+                                    ON CONFLICT (setting_key) DO UPDATE SET
+                                        setting_value = excluded.setting_value,
+                                        updated_at = excluded.updated_at''',
+                                 changes.items())
+            previous = self._values
+            self._publish({**previous, **changes}, self._products)
+        return previous
+    
+    def save_product(self, key_type, **fields):
+        """Insert or update the product for key_type with the given columns and publish it.
+        
+        Returns the previous product, or None if it is new.
+        """
+        columns = list(fields)
+        with self._lock:
+            with db_pool.transaction() as conn:
+                conn.execute(f'''INSERT INTO products (key_type, {", ".join(columns)})
+                                 VALUES (?, {", ".join("?" * len(columns))})
+                                 ON CONFLICT (key_type) DO UPDATE SET
+                                     {", ".join(f"{column} = excluded.{column}" for column in columns)},
+                                     updated_at = CURRENT_TIMESTAMP''',
+                             (key_type, *fields.values()))
+                product = self._read_product(conn, key_type)
+            previous = self._products.get(key_type)
+            self._publish(self._values, {**self._products, key_type: product})
+        return previous
+
+runtime_settings = RuntimeSettings()
+
+def format_stock_lines(stock_info, with_prices=False):
+    """One '• 3-Day Key: N available' line per product on sale, optionally with its price"""
+    lines = []
+    for product in runtime_settings.current.products:
+        line = f"• {product['name']}: {stock_info.get(product['key_type'], 0)} available"
+        if with_prices:
+            line += f" - ₹{product['price']}"
+        lines.append(line)
+    return "\n".join(lines) or "• No products"
+
+def product_label(key_type):
+    """Display name for a key type, including products no longer on sale"""
+    product = runtime_settings.current.products_by_type.get(key_type)
+    return product['name'] if product else f"{key_type.upper()} Key"
+
+def product_commands(prefix):
+    """'/addkey_3d, /addkey_10d, ...' for every product on sale"""
+    return ", ".join(f"/{prefix}_{product['key_type']}" for product in runtime_settings.current.products)
+
+def key_type_filters():
+    """(label, type_code) filter buttons for /stock and /mykeys"""
+    return [("All", '*')] + [(product['key_type'].upper(), product['key_type'])
+                             for product in runtime_settings.current.products]
+
+def get_stock_page(key_type=None, status=None, anchor_id=None, backwards=False, limit=STOCK_PAGE_SIZE):
+    """Get one page of keys in (key_type, status, created_at, key_id) order.
+
+    Keyset pagination: the page starts right after (or, going backwards,
+    right before) the anchor key, so every page is an index seek no matter
+    how far into the inventory it is. ``key_type``/``status`` of None mean
+    no filter.
+
+    Returns (rows, has_prev, has_next) with rows of
+    (key_id, key_type, key_value, status, created).
+    """
+    columns = ['key_type', 'status', 'created_at', 'key_id']
+    where = []
+    params = []
+    
+    if key_type:
+        where.append('key_type = ?')
+        params.append(key_type)
+    if status:
+        where.append('status = ?')
+        params.append(status)
+    
+    with db_pool.connection() as conn:
+        anchor = None
+        if anchor_id:
+            anchor = conn.execute('''SELECT key_type, status, created_at, key_id 
+                                    FROM keys_stock WHERE key_id = ?''', (anchor_id,)).fetchone()
+        
+        if anchor:
+            # Compare only the columns that are not already fixed by a filter
+            free = [(column, value) for column, value in zip(columns, anchor)
+                    if not (column == 'key_type' and key_type) and not (column == 'status' and status)]
+            operator = '<' if backwards else '>'
+            where.append(f"({', '.join(column for column, _ in free)}) {operator} "
+                         f"({', '.join('?' * len(free))})")
+            params.extend(value for _, value in free)
+        else:
+            backwards = False
+        
+        order = 'DESC' if backwards else 'ASC'
+        rows = conn.execute(f'''SELECT key_id, key_type, key_value, status, 
+                                      strftime('%Y-%m-%d %H:%M', created_at) as created
+                               FROM keys_stock 
+                               {'WHERE ' + ' AND '.join(where) if where else ''}
+                               ORDER BY {', '.join(f'{column} {order}' for column in columns)}
+                               LIMIT ?''', params + [limit + 1]).fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    if backwards:
+        rows.reverse()
+        return rows, has_more, True
+    
+    return rows, anchor is not None, has_more
+
+def get_bot_stats(window_days=None):
+    """Collect user, revenue and transaction totals for /stats from daily_stats.
+
+    With ``window_days`` the result also has 'window' (totals for the last
+    N days including today) and 'days' (per-day rows, newest first).
+    """
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        stats = {}
+        
+        # Totals across all days
+        cursor.execute('''SELECT COALESCE(SUM(new_users), 0), COALESCE(SUM(transactions), 0),
+                                 COALESCE(SUM(revenue), 0)
+                          FROM daily_stats''')
+        stats['total_users'], stats['total_transactions'], stats['total_revenue'] = cursor.fetchone()
+        
+        # Get total blocked users (partial index)
+        cursor.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 1')
+        stats['blocked_users'] = cursor.fetchone()[0]
+        
+        # Get today's transactions
+        cursor.execute('''SELECT approved_transactions, revenue FROM daily_stats 
+                          WHERE day = DATE('now')''')
+        today_data = cursor.fetchone() or (0, 0)
+        stats['today_transactions'] = today_data[0]
+        stats['today_revenue'] = today_data[1]
+        
+        if window_days:
+            cursor.execute('''SELECT day, new_users, approved_transactions, revenue 
+                              FROM daily_stats 
+                              WHERE day >= DATE('now', ?) 
+                              ORDER BY day DESC''', (f'-{window_days - 1} days',))
+            stats['days'] = cursor.fetchall()
+            stats['window'] = (
+                sum(row[1] for row in stats['days']),
+                sum(row[2] for row in stats['days']),
+                sum(row[3] for row in stats['days'])
+            )
+    
+    stats['total_admins'] = len(get_all_admins())
+    return stats
+
+def get_user_ids(user_id):
+    """Get (user_id, unique_id) for a telegram user"""
+    with db_pool.connection() as conn:
+        return conn.execute('SELECT user_id, unique_id FROM users WHERE telegram_id = ?', (user_id,)).fetchone()
+
+def create_pending_transaction(user_db_id, amount, payment_method, file_id):
+    """Save a payment screenshot as a pending transaction and return its ID"""
+    with db_pool.transaction() as conn:
+        cursor = conn.execute('''INSERT INTO transactions 
+                                 (user_id, amount, payment_method, screenshot, status) 
+                                 VALUES (?, ?, ?, ?, 'pending')''',
+                              (user_db_id, amount, payment_method, file_id))
+        bump_daily_stats(conn, transactions=1)
+    
+    return cursor.lastrowid
+
+def get_transaction(transaction_id):
+    """Get (transaction_id, user_id, amount, status, telegram_id, username) for a transaction"""
+    with db_pool.connection() as conn:
+        return conn.execute('''SELECT t.transaction_id, t.user_id, t.amount, t.status, 
+                                     u.telegram_id, u.username
+                              FROM transactions t
+                              JOIN users u ON t.user_id = u.user_id
+                              WHERE t.transaction_id = ?''', (transaction_id,)).fetchone()
+
+def approve_transaction(transaction_id, admin_id):
+    """Approve a pending transaction and credit the user in one write transaction.
+
+    Returns a (status, data) tuple where status is 'not_found', 'not_pending'
+    (data = current status) or 'ok' (data = (user_db_id, amount,
+    telegram_id, username, old_balance, new_balance)).
+    """
+    with db_pool.transaction() as conn:
+        cursor = conn.cursor()
+        
+        # Get transaction details
+        cursor.execute('''SELECT t.transaction_id, t.user_id, t.amount, t.status, 
+                                 u.telegram_id, u.username, u.balance, u.unique_id,
+                                 DATE(t.created_at)
+                          FROM transactions t
+                          JOIN users u ON t.user_id = u.user_id
+                          WHERE t.transaction_id = ?''', (transaction_id,))
+        
+        transaction_data = cursor.fetchone()
+        
+        if not transaction_data:
+            return 'not_found', None
+        
+        (trans_id, user_db_id, amount, status, user_telegram_id, 
+         username, user_balance, unique_id, created_day) = transaction_data
+        
+        if status != 'pending':
+            return 'not_pending', status
+        
+        # Update transaction status
+        cursor.execute('''UPDATE transactions 
+                          SET status = 'approved', admin_id = ?
+                          WHERE transaction_id = ?''',
+                       (admin_id, transaction_id))
+        
+        # Update user balance
+        new_balance = user_balance + amount
+        cursor.execute('UPDATE users SET balance = ? WHERE user_id = ?',
+                       (new_balance, user_db_id))
+        
+        # Revenue counts on the day the payment was made, like the backfill
+        bump_daily_stats(conn, day=created_day, approved_transactions=1, revenue=amount)
+    
+    return 'ok', (user_db_id, amount, user_telegram_id, username, user_balance, new_balance)
+
+def reject_transaction(transaction_id, admin_id):
+    """Reject a transaction if it is still pending.
+
+    Returns a (status, data) tuple like approve_transaction: 'not_found',
+    'not_pending' (data = current status) or 'ok'. A payment approved
+    after /reject_ was sent can no longer be rejected.
+    """
+    with db_pool.transaction() as conn:
+        rejected = conn.execute('''UPDATE transactions 
+                                    SET status = 'rejected', admin_id = ?
+                                    WHERE transaction_id = ? AND status = 'pending'
+                                    RETURNING transaction_id''',
+                                (admin_id, transaction_id)).fetchone()
+        if rejected:
+            return 'ok', None
+        
+        row = conn.execute('SELECT status FROM transactions WHERE transaction_id = ?',
+                           (transaction_id,)).fetchone()
+    
+    return ('not_pending', row[0]) if row else ('not_found', None)
+
+def get_user_account(user_id):
+    """Get (unique_id, balance, is_blocked) for a telegram user"""
+    with db_pool.connection() as conn:
+        return conn.execute('SELECT unique_id, balance, is_blocked FROM users WHERE telegram_id = ?',
+                            (user_id,)).fetchone()
+
+class FirstPageCache:
+    """Small LRU of first /mykeys pages keyed by (telegram_id, type filter).
+
+    Entries are dropped for a user whenever they register, buy a key or
+    their block status changes, so a cached page is never stale. ``put`` takes the
+    ``generation`` read before the DB query and ignores pages loaded while
+    an invalidation happened.
+    """
+
+    def __init__(self, size=MY_KEYS_CACHE_SIZE):
+        self.size = size
+        self._pages = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.generation = 0
+
+    def get(self, key):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, page, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._pages[key] = page
+            self._pages.move_to_end(key)
+            while len(self._pages) > self.size:
+                self._pages.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self.generation += 1
+            for key in [key for key in self._pages if key[0] == user_id]:
+                del self._pages[key]
+
+my_keys_cache = FirstPageCache()
+
+class ConversationState:
+    """Write-behind persistence for context.user_data and context.chat_data.
+    
+    A user's (and chat's) stored state is loaded into the live PTB dicts
+    the first time they send an update after startup. Updates only mark
+    their dicts dirty; a flush task writes the ones whose JSON changed
+    every CONVERSATION_FLUSH_INTERVAL seconds in one transaction, so
+    handlers keep using context.user_data as a plain dict.
+    """
+    
+    def __init__(self):
+        self._loaded = set()
+        self._live = {}  # (scope, id) -> the PTB dict
+        self._written = {}  # (scope, id) -> JSON last stored
+        self._dirty = set()
+        self._flusher = None
+    
+    def needs_load(self, user_id, chat_id):
+        return ('user', user_id) not in self._loaded or ('chat', chat_id) not in self._loaded
+    
+    def attach(self, scope, key_id, data, stored):
+        """Start tracking a live dict, filling it from the stored state"""
+        key = (scope, key_id)
+        self._loaded.add(key)
+        if data is None or key in self._live:
+            return
+        if stored:
+            data.update(stored)
+            self._written[key] = json.dumps(stored, sort_keys=True)
+        self._live[key] = data
+    
+    def touch(self, user_id, chat_id):
+        self._dirty.add(('user', user_id))
+        self._dirty.add(('chat', chat_id))
+    
+    async def flush(self):
+        dirty, self._dirty = self._dirty, set()
+        changed = []
+        emptied = []
+        for key in dirty:
+            data = self._live.get(key)
+            if data is None:
+                continue
+            try:
+                payload = json.dumps(data, sort_keys=True) if data else None
+            except (TypeError, ValueError) as e:
+                logger.error(f"Cannot persist {key[0]} data for {key[1]}: {e}")
+                continue
+            if payload == self._written.get(key):
+                continue
+            if payload is None:
+                emptied.append(key)
+            else:
+                changed.append((*key, payload))
+        
+        if not changed and not emptied:
+            return
+        
+        try:
+            await run_db(save_conversation_state, changed, emptied)
+        except Exception:
+            # Try again on the next flush
+            self._dirty.update(dirty)
+            raise
+        
+        for scope, key_id, payload in changed:
+            self._written[(scope, key_id)] = payload
+        for key in emptied:
+            self._written.pop(key, None)
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(CONVERSATION_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing conversation state: {e}")
+    
+    def start(self):
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        """Stop the flush task and write what is still pending"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            try:
+                await self._flusher
+            except asyncio.CancelledError:
+                pass
+            self._flusher = None
+        await self.flush()
+
+conversation_state = ConversationState()
+
+def get_user_keys_page(user_id, key_type=None, anchor_id=None, backwards=False, limit=MY_KEYS_PAGE_SIZE):
+    """Get one page of a user's purchased keys, newest first.
+
+    Keyset pagination on (purchased_at, user_key_id) within the user's
+    index range, so every page costs the same however many keys they own.
+    Only the first page counts the keys; later pages return a total of None.
+
+    Returns (user_data, total, rows, has_prev, has_next) where user_data is
+    (user_id, unique_id, is_blocked) or None and rows are
+    (user_key_id, key_value, key_type, purchase_time, status).
+    """
+    with db_pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id, unique_id, is_blocked FROM users WHERE telegram_id = ?', (user_id,))
+        user_data = cursor.fetchone()
+        
+        if not user_data:
+            return None, 0, [], False, False
+        
+        user_db_id = user_data[0]
+        where = ['user_id = ?']
+        params = [user_db_id]
+        
+        if key_type:
+            where.append('key_type = ?')
+            params.append(key_type)
+        
+        anchor = None
+        if anchor_id:
+            anchor = cursor.execute('''SELECT purchased_at, user_key_id FROM user_keys 
+                                      WHERE user_key_id = ? AND user_id = ?''',
+                                   (anchor_id, user_db_id)).fetchone()
+        
+        # The count grows with the user's keys, so only the first page pays it
+        total = None
+        if not anchor:
+            total = cursor.execute(f"SELECT COUNT(*) FROM user_keys WHERE {' AND '.join(where)}", params).fetchone()[0]
+        
+        if anchor:
+            where.append(f"(purchased_at, user_key_id) {'>' if backwards else '<'} (?, ?)")
+            params.extend(anchor)
+        else:
+            backwards = False
+        
+        order = 'ASC' if backwards else 'DESC'
         
-        conn = sqlite3.connect('atoplay_bot.db')
+        # Get user's purchased keys
+        rows = cursor.execute(f'''SELECT user_key_id, key_value, key_type, 
+                                        strftime('%Y-%m-%d %H:%M', purchased_at) as purchase_time,
+                                        status
+                                 FROM user_keys 
+                                 WHERE {' AND '.join(where)}
+                                 ORDER BY purchased_at {order}, user_key_id {order}
+                                 LIMIT ?''', params + [limit + 1]).fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    if backwards:
+        rows.reverse()
+        return user_data, total, rows, has_more, True
+    
+    return user_data, total, rows, anchor is not None, has_more
+
+def get_user_summary(user_id):
+    """Get (telegram_id, username, user_id) for a telegram user"""
+    with db_pool.connection() as conn:
+        return conn.execute('SELECT telegram_id, username, user_id FROM users WHERE telegram_id = ?',
+                            (user_id,)).fetchone()
+
+def set_user_blocked(user_id, reason=None):
+    """Block a user with a reason, or unblock when reason is None"""
+    with db_pool.connection() as conn:
+        if reason is None:
+            conn.execute('''UPDATE users 
+                              SET is_blocked = 0, blocked_reason = NULL, blocked_at = NULL
+                              WHERE telegram_id = ?''',
+                         (user_id,))
+        else:
+            conn.execute('''UPDATE users 
+                              SET is_blocked = 1, blocked_reason = ?, blocked_at = CURRENT_TIMESTAMP
+                              WHERE telegram_id = ?''',
+                         (reason, user_id))
+    
+    my_keys_cache.invalidate(user_id)
+
+def get_user_details(user_id):
+    """Get the /userinfo row plus (purchases, spent, keys) totals for a telegram user"""
+    with db_pool.connection() as conn:
         cursor = conn.cursor()
         
-        cursor.execute('SELECT balance, unique_id, is_blocked, is_admin FROM users WHERE telegram_id = ?', (user_id,))
+        # Get user details
+        cursor.execute('''SELECT telegram_id, username, unique_id, balance, 
+                                 is_blocked, blocked_reason, blocked_at, is_admin,
+                                 strftime('%Y-%m-%d %H:%M', blocked_at) as blocked_time,
+                                 user_id
+                          FROM users WHERE telegram_id = ?''', (user_id,))
         user_data = cursor.fetchone()
         
+        if not user_data:
+            return None, None
+        
+        user_db_id = user_data[-1]
+        
+        # Get user's purchase history
+        cursor.execute('''SELECT COUNT(*), SUM(amount) 
+                          FROM transactions 
+                          WHERE user_id = ? AND status = 'approved' ''', (user_db_id,))
+        purchase_data = cursor.fetchone()
+        
+        # Get user's keys
+        cursor.execute('SELECT COUNT(*) FROM user_keys WHERE user_id = ?', (user_db_id,))
+        keys_count = cursor.fetchone()[0] or 0
+    
+    return user_data[:-1], (purchase_data[0] or 0, purchase_data[1] or 0, keys_count)
+
+def get_admin_candidate(user_id):
+    """Get (telegram_id, username, is_admin, user_id) for a telegram user"""
+    with db_pool.connection() as conn:
+        return conn.execute('SELECT telegram_id, username, is_admin, user_id FROM users WHERE telegram_id = ?',
+                            (user_id,)).fetchone()
+
+def set_user_admin(user_id, added_by=None):
+    """Grant admin rights (added_by = granting admin), or revoke when added_by is None"""
+    with db_pool.connection() as conn:
+        if added_by is None:
+            conn.execute('UPDATE users SET is_admin = 0, added_by = NULL WHERE telegram_id = ?',
+                         (user_id,))
+            admin_cache.revoke(user_id)
+        else:
+            row = conn.execute('''UPDATE users SET is_admin = 1, added_by = ? WHERE telegram_id = ?
+                                  RETURNING username''',
+                               (added_by, user_id)).fetchone()
+            if row:
+                admin_cache.grant(user_id, row[0])
+
+def create_broadcast_job(admin_id, message, status_chat_id, status_message_id):
+    """Create a running broadcast job over all reachable users and return its ID"""
+    with db_pool.transaction() as conn:
+        total_users = conn.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 0 AND bot_blocked_at IS NULL').fetchone()[0]
+        return conn.execute('''INSERT INTO broadcast_jobs
+                                (admin_id, message, total_users, status_chat_id, status_message_id, updated_at)
+                                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                                RETURNING job_id''',
+                            (admin_id, message, total_users, status_chat_id, status_message_id)).fetchone()[0]
+
+def get_broadcast_job(job_id):
+    """Get (message, status, last_user_id, total_users, sent, blocked, failed, status_chat_id, status_message_id)"""
+    with db_pool.connection() as conn:
+        return conn.execute('''SELECT message, status, last_user_id, total_users, sent_count, blocked_count,
+                                       failed_count, status_chat_id, status_message_id
+                                FROM broadcast_jobs WHERE job_id = ?''', (job_id,)).fetchone()
+
+def get_running_broadcast_ids():
+    """Get the IDs of broadcasts that have not finished"""
+    with db_pool.connection() as conn:
+        return [row[0] for row in conn.execute("SELECT job_id FROM broadcast_jobs WHERE status = 'running' ORDER BY job_id")]
+
+def get_broadcast_batch(after_user_id, limit=BROADCAST_BATCH_SIZE):
+    """Get the next (user_id, telegram_id) rows to broadcast to, by user_id"""
+    with db_pool.connection() as conn:
+        return conn.execute('''SELECT user_id, telegram_id FROM users
+                                WHERE user_id > ? AND is_blocked = 0 AND bot_blocked_at IS NULL
+                                ORDER BY user_id LIMIT ?''', (after_user_id, limit)).fetchall()
+
+def save_broadcast_progress(job_id, last_user_id, sent, blocked, failed, blocked_telegram_ids):
+    """Advance a broadcast past one batch and return the job's status.
+
+    Users who blocked the bot are marked in the same transaction so later
+    broadcasts skip them. The returned status is 'cancelled' once
+    /cancelbroadcast has been used.
+    """
+    with db_pool.transaction() as conn:
+        conn.executemany('UPDATE users SET bot_blocked_at = CURRENT_TIMESTAMP WHERE telegram_id = ?',
+                         [(telegram_id,) for telegram_id in blocked_telegram_ids])
+        return conn.execute('''UPDATE broadcast_jobs
+                                SET last_user_id = ?, sent_count = sent_count + ?, blocked_count = blocked_count + ?,
+                                    failed_count = failed_count + ?, updated_at = CURRENT_TIMESTAMP
+                                WHERE job_id = ?
+                                RETURNING status''',
+                            (last_user_id, sent, blocked, failed, job_id)).fetchone()[0]
+
+def finish_broadcast_job(job_id):
+    """Mark a broadcast done unless it was cancelled meanwhile"""
+    with db_pool.connection() as conn:
+        conn.execute("""UPDATE broadcast_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP
+                        WHERE job_id = ? AND status = 'running'""", (job_id,))
+
+def get_conversation_state(user_id, chat_id):
+    """Get the stored {scope: data} for a user and chat"""
+    with db_pool.connection() as conn:
+        rows = conn.execute('''SELECT scope, data FROM conversation_state
+                               WHERE (scope = 'user' AND id = ?) OR (scope = 'chat' AND id = ?)''',
+                            (user_id, chat_id)).fetchall()
+    return {scope: json.loads(data) for scope, data in rows}
+
+def save_conversation_state(changed, emptied):
+    """Write changed (scope, id, json) rows and drop emptied (scope, id) rows"""
+    with db_pool.transaction() as conn:
+        conn.executemany('''INSERT INTO conversation_state (scope, id, data, updated_at)
+                            VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                            ON CONFLICT (scope, id) DO UPDATE SET
+                                data = excluded.data, updated_at = excluded.updated_at''', changed)
+        conn.executemany('DELETE FROM conversation_state WHERE scope = ? AND id = ?', emptied)
+
+def cancel_broadcast_jobs():
+    """Cancel every running broadcast and return their IDs"""
+    with db_pool.connection() as conn:
+        return [row[0] for row in conn.execute('''UPDATE broadcast_jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+                                                  WHERE status = 'running'
+                                                  RETURNING job_id''')]
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    update_logger.info("Start command received from user: %s", update.effective_user.id)
+    
+    try:
+        user = update.effective_user
+        user_id = user.id
+        
+        user_data = await run_db(get_user_profile, user_id)
+        
         # Check if user is blocked
         if user_data and user_data[2] == 1:
             await update.message.reply_text("❌ You are blocked from using this bot!")
-            conn.close()
             return
         
         if not user_data:
-            unique_id = str(uuid.uuid4())[:8].upper()
             is_admin_user = 1 if user_id in ADMIN_IDS else 0
-            cursor.execute('INSERT INTO users (telegram_id, username, unique_id, balance, is_blocked, is_admin) VALUES (?, ?, ?, ?, 0, ?)', 
-                          (user_id, user.username, unique_id, 0, is_admin_user))
-            conn.commit()
+            unique_id = await run_db(register_user, user_id, user.username, is_admin_user)
             
             welcome_text = f"""👋 Welcome to Atoplay Shop!
 
@@ -249,7 +1817,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 Use /buy to purchase keys!
 Use /mykeys to see your purchased keys!"""
         else:
-            balance, unique_id, is_blocked, is_admin_user = user_data
+            balance, unique_id, is_blocked, is_admin_user, bot_blocked_at = user_data
+            
+            # They blocked the bot during a broadcast and have come back
+            if bot_blocked_at:
+                await run_db(clear_bot_blocked, user_id)
             
             welcome_text = f"""👋 Welcome back {user.first_name}!
 
@@ -263,26 +1835,11 @@ Use /buy to purchase keys!
 Use /balance to check your balance!
 Use /mykeys to see your purchased keys!"""
         
-        conn.close()
-        
         # Different keyboard for admin vs regular user
-        if is_admin(user_id):
-            keyboard = [
-                [KeyboardButton("🛒 Buy Keys"), KeyboardButton("🔧 Admin Panel")],
-                [KeyboardButton("💳 Check Balance"), KeyboardButton("🔑 My Keys")],
-                [KeyboardButton("📞 Contact"), KeyboardButton("📢 Channel")]
-            ]
-        else:
-            keyboard = [
-                [KeyboardButton("🛒 Buy Keys")],
-                [KeyboardButton("💳 Check Balance"), KeyboardButton("🔑 My Keys")],
-                [KeyboardButton("📞 Contact"), KeyboardButton("📢 Channel")]
-            ]
-        
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup = ADMIN_MENU_KEYBOARD if is_admin(user_id) else USER_MENU_KEYBOARD
         
         await update.message.reply_text(welcome_text, reply_markup=reply_markup)
-        logger.info(f"Welcome message sent to user: {user_id}")
+        update_logger.info("Welcome message sent to user: %s", user_id)
         
     except Exception as e:
         logger.error(f"Error in start command: {e}")
@@ -298,28 +1855,33 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Get stock information
     stock_info = get_stock_info()
-    products = get_products()
+    products = runtime_settings.current.products
+    example = products[0]['key_type'] if products else '3d'
+    add_key_lines = "\n".join(f"• /addkey_{product['key_type']} KEY - Add {product['name'].lower()}"
+                              for product in products)
+    price_lines = "\n".join(f"• /price_{product['key_type']} NEW_PRICE - Change {product['name'].lower()} price"
+                            for product in products)
     
     text = f"""🔧 ADMIN PANEL
 
 📊 Stock Status:
-• 3-Day Keys: {stock_info.get('3d', 0)} available - ₹{PRODUCT_PRICES['3d']}
-• 10-Day Keys: {stock_info.get('10d', 0)} available - ₹{PRODUCT_PRICES['10d']}
-• 30-Day Keys: {stock_info.get('30d', 0)} available - ₹{PRODUCT_PRICES['30d']}
+{format_stock_lines(stock_info, with_prices=True)}
 
 🛠️ KEY MANAGEMENT:
 📝 Add Keys:
-• /addkey_3d KEY - Add 3-day key
-• /addkey_10d KEY - Add 10-day key  
-• /addkey_30d KEY - Add 30-day key
+{add_key_lines}
+• /addkey_{example} + one key per line - Bulk add
+• Send a .txt/.csv file with caption /addkey_{example} - Import file
 
 🗑️ Delete Key:
 • /delkey KEY - Delete any key
 
 💰 PRICE MANAGEMENT:
-• /price_3d NEW_PRICE - Change 3-day price
-• /price_10d NEW_PRICE - Change 10-day price
-• /price_30d NEW_PRICE - Change 30-day price
+{price_lines}
+
+📦 PRODUCT MANAGEMENT:
+• /addproduct TYPE DAYS PRICE [NAME] - Add or update a product
+• /removeproduct TYPE - Hide a product from the buy menu
 
 👤 USER MANAGEMENT:
 • /block USER_ID REASON - Block a user
@@ -336,33 +1898,94 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • /listadmins - List all admins
 
 📊 STOCK CHECK:
-• /stock - Show all keys
+• /stock - Show all keys (with page and filter buttons)
 • /stats - Show statistics
+• /stats 7d or /stats 30d - Statistics for a window
+• /metrics - Handler and DB latency
+• /rebuildstats - Rebuild stats history (Super Admin)
 
 📋 Examples:
-• /addkey_3d ABC123
+• /addkey_{example} ABC123
 • /delkey XYZ789
-• /price_3d 300
+• /price_{example} 300
+• /addproduct 90d 90 3000 90-Day Key
 • /block 123456 "Spamming"
 • /setupi newnumber@upi"""
     
     await update.message.reply_text(text)
 
+def render_buy_menu():
+    """Build the /buy menu text and keyboard from the catalog, stock and payment details"""
+    # Get stock information
+    stock_info = get_stock_info()
+    settings = runtime_settings.current
+    payment_methods = settings.payment_methods
+    
+    # Two buttons per row: products, then Add Balance; Cancel on its own row
+    buttons = [InlineKeyboardButton(f"{product['name']} - ₹{product['price']}",
+                                    callback_data=f"product_{product['product_id']}")
+               for product in settings.products]
+    buttons.append(InlineKeyboardButton("💳 Add Balance", callback_data='add_balance'))
+    keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    keyboard.append([InlineKeyboardButton("❌ Cancel", callback_data='cancel')])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    # Get UPI QR code if available
+    upi_info = payment_methods.get('upi', {})
+    upi_qr_info = ""
+    if upi_info.get('qr_code'):
+        upi_qr_info = "\n📱 UPI QR: Available (Send /setqr to update)"
+    
+    product_lines = "\n".join(f"{number}. Atoplay {product['name']} - ₹{product['price']}"
+                              for number, product in enumerate(settings.products, 1))
+    
+    text = f"""🛒 Select Product:
+
+{product_lines}
+
+📦 Current Stock:
+{format_stock_lines(stock_info)}
+
+💸 Payment Methods:
+• Easypaisa: {payment_methods.get('easypaisa', {}).get('number', 'N/A')}
+• Binance: {payment_methods.get('binance', {}).get('number', 'N/A')}
+• UPI: {upi_info.get('number', 'N/A')}{upi_qr_info}"""
+    
+    return text, reply_markup
+
+class BuyMenuCache:
+    """The rendered /buy menu, shared by every caller until it changes.
+    
+    It is rebuilt when runtime_settings publishes new products or payment
+    details, or stock_counters.version moves. Versions are read before
+    rendering, so a change during a render only causes one more.
+    """
+    
+    def __init__(self):
+        self._menu = None  # (settings_version, stock_version, text, reply_markup)
+        self.renders = 0
+    
+    def get(self):
+        menu = self._menu
+        settings_version = runtime_settings.current.version
+        stock_version = stock_counters.version
+        if menu is None or menu[0] != settings_version or menu[1] != stock_version:
+            text, reply_markup = render_buy_menu()
+            menu = self._menu = (settings_version, stock_version, text, reply_markup)
+            self.renders += 1
+        return menu[2], menu[3]
+
+buy_menu = BuyMenuCache()
+
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.info(f"Buy command received from user: {update.effective_user.id}")
+    update_logger.info("Buy command received from user: %s", update.effective_user.id)
     
     try:
         user = update.effective_user
         user_id = user.id
         
         # Check if user is blocked
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT is_blocked FROM users WHERE telegram_id = ?', (user_id,))
-        user_data = cursor.fetchone()
-        conn.close()
-        
-        if user_data and user_data[0] == 1:
+        if await run_db(is_user_blocked, user_id):
             await update.message.reply_text("❌ You are blocked from using this bot!")
             return
         
@@ -375,197 +1998,132 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE):
             message = update.message
             reply_func = message.reply_text
         
-        # Get stock information
-        stock_info = get_stock_info()
-        products = get_products()
-        
-        keyboard = [
-            [
-                InlineKeyboardButton(f"3-Day Key - ₹{PRODUCT_PRICES['3d']}", callback_data='product_3d'),
-                InlineKeyboardButton(f"10-Day Key - ₹{PRODUCT_PRICES['10d']}", callback_data='product_10d')
-            ],
-            [
-                InlineKeyboardButton(f"30-Day Key - ₹{PRODUCT_PRICES['30d']}", callback_data='product_30d'),
-                InlineKeyboardButton("💳 Add Balance", callback_data='add_balance')
-            ],
-            [
-                InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-            ]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Get UPI QR code if available
-        upi_info = PAYMENT_METHODS.get('upi', {})
-        upi_qr_info = ""
-        if upi_info.get('qr_code'):
-            upi_qr_info = "\n📱 UPI QR: Available (Send /setqr to update)"
-        
-        text = f"""🛒 Select Product:
-
-1. 3-Day Atoplay Key - ₹{PRODUCT_PRICES['3d']}
-2. 10-Day Atoplay Key - ₹{PRODUCT_PRICES['10d']}
-3. 30-Day Atoplay Key - ₹{PRODUCT_PRICES['30d']}
-
-📦 Current Stock:
-• 3-Day Keys: {stock_info.get('3d', 0)} available
-• 10-Day Keys: {stock_info.get('10d', 0)} available
-• 30-Day Keys: {stock_info.get('30d', 0)} available
-
-💸 Payment Methods:
-• Easypaisa: {PAYMENT_METHODS.get('easypaisa', {}).get('number', 'N/A')}
-• Binance: {PAYMENT_METHODS.get('binance', {}).get('number', 'N/A')}
-• UPI: {upi_info.get('number', 'N/A')}{upi_qr_info}"""
+        text, reply_markup = buy_menu.get()
         
         await reply_func(text, reply_markup=reply_markup)
-        logger.info(f"Buy menu shown to user: {user_id}")
+        update_logger.info("Buy menu shown to user: %s", user_id)
         
     except Exception as e:
         logger.error(f"Error in buy command: {e}")
         await update.message.reply_text("⚠️ An error occurred. Please try again.")
 
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def cancel_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Close an inline menu"""
     try:
-        query = update.callback_query
-        await query.answer()
-        
-        user_id = query.from_user.id
-        data = query.data
-        
-        logger.info(f"Callback from user: {user_id}, data: {data}")
-        
-        # Handle cancel
-        if data == 'cancel':
-            try:
-                await query.edit_message_text("❌ Cancelled!")
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-            return
-        
-        # Handle add balance
-        if data == 'add_balance':
-            keyboard = [
-                [
-                    InlineKeyboardButton("₹500", callback_data='amount_500'),
-                    InlineKeyboardButton("₹1000", callback_data='amount_1000'),
-                    InlineKeyboardButton("₹2000", callback_data='amount_2000')
-                ],
-                [
-                    InlineKeyboardButton("Other Amount", callback_data='amount_other'),
-                    InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            try:
-                await query.edit_message_text(
-                    "💳 Add Balance\n\nSelect amount or choose 'Other Amount':",
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-            return
-        
-        # Handle product selection
-        products = get_products()
-        if data in products:
-            product = products[data]
-            context.user_data['selected_product'] = product
-            context.user_data['product_id'] = data
-            
-            conn = sqlite3.connect('atoplay_bot.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT balance FROM users WHERE telegram_id = ?', (user_id,))
-            result = cursor.fetchone()
-            user_balance = result[0] if result else 0
-            conn.close()
-            
-            # Get stock for this specific product
-            stock_info = get_stock_info()
-            key_type = '3d' if product['days'] == 3 else ('10d' if product['days'] == 10 else '30d')
-            available_stock = stock_info.get(key_type, 0)
-            
-            if available_stock == 0:
-                try:
-                    await query.edit_message_text(f"""❌ Out of Stock!
+        await update.callback_query.edit_message_text("❌ Cancelled!")
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+
+async def add_balance_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the add balance amounts"""
+    try:
+        await update.callback_query.edit_message_text(
+            "💳 Add Balance\n\nSelect amount or choose 'Other Amount':",
+            reply_markup=ADD_BALANCE_KEYBOARD
+        )
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+
+async def product_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle product selection"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    
+    # Callback data is product_<product_id>; menus sent before the product
+    # catalog still carry product_<key_type>
+    suffix = query.data[len('product_'):]
+    try:
+        product = runtime_settings.current.products_by_id.get(int(suffix))
+    except ValueError:
+        product = runtime_settings.current.products_by_type.get(suffix)
+    
+    if not product or not product['is_active']:
+        try:
+            await query.edit_message_text("❌ This product is no longer available! Use /buy to see current products.")
+        except Exception as e:
+            logger.error(f"Error editing message: {e}")
+        return
+    
+    # Plain dict: user_data is persisted as JSON
+    context.user_data['selected_product'] = dict(product)
+    context.user_data['product_id'] = product['product_id']
+    
+    user_balance = await run_db(get_user_balance, user_id)
+    
+    # Get stock for this specific product
+    stock_info = get_stock_info()
+    available_stock = stock_info.get(product['key_type'], 0)
+    
+    if available_stock == 0:
+        try:
+            await query.edit_message_text(f"""❌ Out of Stock!
 
 {product['name']} is currently out of stock.
 
 📞 Contact @Aarifseller for availability.
 Or choose another product.""")
-                except Exception as e:
-                    logger.error(f"Error editing message: {e}")
-                return
-            
-            if user_balance >= product['price']:
-                keyboard = [
-                    [
-                        InlineKeyboardButton("💳 Use Balance", callback_data='use_balance'),
-                        InlineKeyboardButton("💸 New Payment", callback_data='new_payment')
-                    ],
-                    [InlineKeyboardButton("❌ Cancel", callback_data='cancel')]
-                ]
-                text = f"""🛒 Product: {product['name']}
+        except Exception as e:
+            logger.error(f"Error editing message: {e}")
+        return
+    
+    if user_balance >= product['price']:
+        reply_markup = BALANCE_CHOICE_KEYBOARD
+        text = f"""🛒 Product: {product['name']}
 💰 Price: ₹{product['price']}
 📦 Available: {available_stock} keys
 
 💳 Your Balance: ₹{user_balance}
 
 Choose payment method:"""
-            else:
-                text = f"""🛒 Product: {product['name']}
+    else:
+        text = f"""🛒 Product: {product['name']}
 💰 Price: ₹{product['price']}
 📦 Available: {available_stock} keys
 
 💸 Please select payment method:"""
-                keyboard = [
-                    [
-                        InlineKeyboardButton("Easypaisa", callback_data='payment_easypaisa'),
-                        InlineKeyboardButton("Binance", callback_data='payment_binance')
-                    ],
-                    [
-                        InlineKeyboardButton("UPI", callback_data='payment_upi'),
-                        InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                    ]
-                ]
-            
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            try:
-                await query.edit_message_text(text, reply_markup=reply_markup)
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-            logger.info(f"Product {product['name']} selected by user: {user_id}")
-            return
+        reply_markup = PAYMENT_METHOD_KEYBOARD
+    
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+    update_logger.info("Product %s selected by user: %s", product['name'], user_id)
+
+async def payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle payment method selection"""
+    query = update.callback_query
+    user_id = query.from_user.id
+    payment_method = query.data.replace('payment_', '')
+    
+    payment_methods = runtime_settings.current.payment_methods
+    if payment_method not in payment_methods:
+        return
+    
+    context.user_data['payment_method'] = payment_method
+    payment_info = payment_methods[payment_method]
+    
+    # Set flag to await screenshot
+    context.user_data['awaiting_screenshot'] = True
+    
+    # Check if this is for product purchase
+    if 'selected_product' in context.user_data:
+        product = context.user_data.get('selected_product')
+        amount = product['price']
+        purpose = "Product Purchase"
         
-        # Handle payment method selection
-        if data.startswith('payment_'):
-            payment_method = data.replace('payment_', '')
-            
-            if payment_method in PAYMENT_METHODS:
-                context.user_data['payment_method'] = payment_method
-                payment_info = PAYMENT_METHODS[payment_method]
-                
-                # Set flag to await screenshot
-                context.user_data['awaiting_screenshot'] = True
-                
-                # Check if this is for product purchase
-                if 'selected_product' in context.user_data:
-                    product = context.user_data.get('selected_product')
-                    amount = product['price']
-                    purpose = "Product Purchase"
-                    
-                    text = f"""💳 Payment Details:
-
-🔸 Product: {product['name']}
+        text = f"""💳 Payment Details:
+
+🔸 Product: {escape_markdown(product['name'])}
 🔸 Purpose: {purpose}
 🔸 Method: {payment_info['name']}
 🔸 Number/ID: `{payment_info['number']}`
 🔸 Amount: ₹{amount}"""
-                    
-                    # Add QR code info for UPI
-                    if payment_method == 'upi' and payment_info.get('qr_code'):
-                        text += f"\n📱 QR Code Available"
-                    
-                    text += f"""
+        
+        # Add QR code info for UPI
+        if payment_method == 'upi' and payment_info.get('qr_code'):
+            text += f"\n📱 QR Code Available"
+        
+        text += f"""
 
 📋 Instructions:
 1. Send ₹{amount} to above {payment_info['name']} number
@@ -578,24 +2136,24 @@ Choose payment method:"""
 • Date & Time
 
 📸 After payment, send the screenshot now."""
-                
-                # If adding balance
-                elif 'amount' in context.user_data and context.user_data.get('is_adding_balance', False):
-                    amount = context.user_data.get('amount')
-                    purpose = "Add Balance"
-                    
-                    text = f"""💳 Payment Details:
+    
+    # If adding balance
+    elif 'amount' in context.user_data and context.user_data.get('is_adding_balance', False):
+        amount = context.user_data.get('amount')
+        purpose = "Add Balance"
+        
+        text = f"""💳 Payment Details:
 
 🔸 Purpose: {purpose}
 🔸 Method: {payment_info['name']}
 🔸 Number/ID: `{payment_info['number']}`
 🔸 Amount: ₹{amount}"""
-                    
-                    # Add QR code info for UPI
-                    if payment_method == 'upi' and payment_info.get('qr_code'):
-                        text += f"\n📱 QR Code Available"
-                    
-                    text += f"""
+        
+        # Add QR code info for UPI
+        if payment_method == 'upi' and payment_info.get('qr_code'):
+            text += f"\n📱 QR Code Available"
+        
+        text += f"""
 
 📋 Instructions:
 1. Send ₹{amount} to above {payment_info['name']} number
@@ -608,86 +2166,71 @@ Choose payment method:"""
 • Date & Time
 
 📸 After payment, send the screenshot now."""
-                
-                keyboard = [[InlineKeyboardButton("❌ Cancel", callback_data='cancel')]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                try:
-                    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-                except Exception as e:
-                    logger.error(f"Error editing message: {e}")
-                logger.info(f"Payment method {payment_method} selected by user: {user_id}")
-            return
+    
+    try:
+        await query.edit_message_text(text, reply_markup=CANCEL_KEYBOARD, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+    update_logger.info("Payment method %s selected by user: %s", payment_method, user_id)
+
+async def amount_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle amount selection for balance"""
+    query = update.callback_query
+    data = query.data
+    
+    if data == 'amount_other':
+        try:
+            await query.edit_message_text(
+                "💳 Add Balance\n\nPlease enter the amount you want to add (in INR).\nExample: 750\n\nMinimum: ₹100"
+            )
+        except Exception as e:
+            logger.error(f"Error editing message: {e}")
+        context.user_data['awaiting_amount'] = True
+        return
+    
+    amount = int(data.replace('amount_', ''))
+    context.user_data['amount'] = amount
+    context.user_data['is_adding_balance'] = True
+    
+    try:
+        await query.edit_message_text(
+            f"💳 Add Balance: ₹{amount}\n\nPlease select payment method:",
+            reply_markup=PAYMENT_METHOD_KEYBOARD
+        )
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+
+async def new_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pay for the selected product with a new payment instead of balance"""
+    product = context.user_data.get('selected_product')
+    if product:
+        context.user_data['amount'] = product['price']
+        context.user_data['is_adding_balance'] = False
+    
+    try:
+        await update.callback_query.edit_message_text(
+            "💸 Please select payment method:",
+            reply_markup=PAYMENT_METHOD_KEYBOARD
+        )
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        query = update.callback_query
+        await query.answer()
         
-        # Handle amount selection for balance
-        if data.startswith('amount_'):
-            if data == 'amount_other':
-                try:
-                    await query.edit_message_text(
-                        "💳 Add Balance\n\nPlease enter the amount you want to add (in INR).\nExample: 750\n\nMinimum: ₹100"
-                    )
-                except Exception as e:
-                    logger.error(f"Error editing message: {e}")
-                context.user_data['awaiting_amount'] = True
-                return
-            
-            amount = int(data.replace('amount_', ''))
-            context.user_data['amount'] = amount
-            context.user_data['is_adding_balance'] = True
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("Easypaisa", callback_data='payment_easypaisa'),
-                    InlineKeyboardButton("Binance", callback_data='payment_binance')
-                ],
-                [
-                    InlineKeyboardButton("UPI", callback_data='payment_upi'),
-                    InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            try:
-                await query.edit_message_text(
-                    f"💳 Add Balance: ₹{amount}\n\nPlease select payment method:",
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-            return
+        user_id = query.from_user.id
+        data = query.data
         
-        # Handle use balance
-        if data == 'use_balance':
-            await process_balance_purchase(update, context)
-            return
+        update_logger.info("Callback from user: %s, data: %s", user_id, data)
         
-        # Handle new payment
-        if data == 'new_payment':
-            product = context.user_data.get('selected_product')
-            if product:
-                context.user_data['amount'] = product['price']
-                context.user_data['is_adding_balance'] = False
-            
-            keyboard = [
-                [
-                    InlineKeyboardButton("Easypaisa", callback_data='payment_easypaisa'),
-                    InlineKeyboardButton("Binance", callback_data='payment_binance')
-                ],
-                [
-                    InlineKeyboardButton("UPI", callback_data='payment_upi'),
-                    InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                ]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            try:
-                await query.edit_message_text(
-                    "💸 Please select payment method:",
-                    reply_markup=reply_markup
-                )
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-            return
+        # Exact match first, then the 'stock:' / 'payment_' style prefix
+        handler = (CALLBACK_ROUTES.get(data)
+                   or CALLBACK_ROUTES.get(data.partition(':')[0] + ':')
+                   or CALLBACK_ROUTES.get(data.partition('_')[0] + '_'))
+        if handler:
+            await handler(update, context)
             
     except Exception as e:
         logger.error(f"Error in callback handler: {e}")
@@ -697,35 +2240,28 @@ async def process_balance_purchase(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     user_id = query.from_user.id
     
-    if 'selected_product' not in context.user_data:
+    product = context.user_data.get('selected_product')
+    
+    if not product or 'key_type' not in product:
         try:
             await query.edit_message_text("❌ No product selected!")
         except Exception as e:
             logger.error(f"Error editing message: {e}")
         return
     
-    product = context.user_data.get('selected_product')
-    
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
     try:
-        # Get user balance and info
-        cursor.execute('SELECT user_id, balance, unique_id FROM users WHERE telegram_id = ?', (user_id,))
-        user_data = cursor.fetchone()
+        status, result = await run_db(purchase_with_balance, user_id, product['key_type'], product['price'])
         
-        if not user_data:
+        if status == 'no_user':
             try:
                 await query.edit_message_text("❌ User not found!")
             except Exception as e:
                 logger.error(f"Error editing message: {e}")
-            conn.close()
             return
         
-        user_db_id, user_balance, unique_id = user_data
-        
         # Check if user has enough balance
-        if user_balance < product['price']:
+        if status == 'insufficient':
+            user_balance = result
             try:
                 await query.edit_message_text(f"""❌ Insufficient Balance!
 
@@ -735,18 +2271,9 @@ async def process_balance_purchase(update: Update, context: ContextTypes.DEFAULT
 💸 Please add balance or use another payment method.""")
             except Exception as e:
                 logger.error(f"Error editing message: {e}")
-            conn.close()
             return
         
-        # Get stock for this product
-        key_type = '3d' if product['days'] == 3 else ('10d' if product['days'] == 10 else '30d')
-        cursor.execute('''SELECT key_id, key_value FROM keys_stock 
-                          WHERE key_type = ? AND status = 'available' 
-                          LIMIT 1''', (key_type,))
-        
-        key_data = cursor.fetchone()
-        
-        if not key_data:
+        if status == 'out_of_stock':
             try:
                 await query.edit_message_text(f"""❌ Out of Stock!
 
@@ -756,41 +2283,16 @@ async def process_balance_purchase(update: Update, context: ContextTypes.DEFAULT
 Or choose another product.""")
             except Exception as e:
                 logger.error(f"Error editing message: {e}")
-            conn.close()
             return
         
-        key_id, key_value = key_data
-        
-        # Deduct balance
-        new_balance = user_balance - product['price']
-        cursor.execute('UPDATE users SET balance = ? WHERE user_id = ?',
-                       (new_balance, user_db_id))
-        
-        # Update key status
-        cursor.execute('''UPDATE keys_stock 
-                          SET status = 'used', used_by = ?, used_at = CURRENT_TIMESTAMP
-                          WHERE key_id = ?''',
-                       (user_db_id, key_id))
-        
-        # Add to user_keys table
-        cursor.execute('''INSERT INTO user_keys (user_id, key_value, key_type) 
-                          VALUES (?, ?, ?)''',
-                       (user_db_id, key_value, key_type))
-        
-        # Create transaction record
-        cursor.execute('''INSERT INTO transactions 
-                          (user_id, amount, payment_method, status, admin_id) 
-                          VALUES (?, ?, 'balance', 'approved', 0)''',
-                       (user_db_id, product['price']))
-        
-        conn.commit()
+        key_value, new_balance = result
         
         # Send key to user
         key_message = f"""✅ Purchase Successful!
 
 🎉 Congratulations! Your purchase is complete.
 
-📦 Product: {product['name']}
+📦 Product: {escape_markdown(product['name'])}
 💰 Price: ₹{product['price']}
 💳 New Balance: ₹{new_balance}
 🔑 Your Key: `{key_value}`
@@ -810,12 +2312,13 @@ Or choose another product.""")
 📢 Join: @SnakeEngine105"""
         
         try:
-            await query.edit_message_text(key_message, parse_mode='Markdown')
+            with sending_priority(SEND_PRIORITY_KEY_DELIVERY):
+                await query.edit_message_text(key_message, parse_mode='Markdown')
         except Exception as e:
             logger.error(f"Error editing message: {e}")
         
         # Log the purchase
-        logger.info(f"User {user_id} purchased {product['name']} with balance. Key: {key_value}")
+        logger.info("User %s purchased %s with balance. Key: %s", user_id, product['name'], key_value)
         
         # Clear user data
         context.user_data.clear()
@@ -826,8 +2329,6 @@ Or choose another product.""")
             await query.edit_message_text("❌ An error occurred during purchase. Please try again.")
         except:
             pass
-    finally:
-        conn.close()
 
 async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle text messages for various purposes"""
@@ -836,73 +2337,57 @@ async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE
             user_id = update.message.from_user.id
             text = update.message.text
             
-            logger.info(f"Text message from user: {user_id}, text: {text}")
+            update_logger.info("Text message from user: %s, text: %s", user_id, text)
             
             # Check if user is blocked
-            conn = sqlite3.connect('atoplay_bot.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT is_blocked FROM users WHERE telegram_id = ?', (user_id,))
-            user_data = cursor.fetchone()
-            conn.close()
-            
-            if user_data and user_data[0] == 1 and text not in ["/start"]:
+            if await run_db(is_user_blocked, user_id) and text not in ["/start"]:
                 await update.message.reply_text("❌ You are blocked from using this bot!")
                 return
             
             # Handle menu button presses for ALL users
-            if text == "🛒 Buy Keys":
-                return await buy(update, context)
-            elif text == "💳 Check Balance":
-                await check_balance(update, context)
-            elif text == "🔑 My Keys":
-                await my_keys(update, context)
-            elif text == "🔧 Admin Panel":
-                await admin_panel(update, context)
-            elif text == "📞 Contact":
-                await update.message.reply_text("📞 Contact: @Aarifseller\n📢 Channel: @SnakeEngine105")
-            elif text == "📢 Channel":
-                await update.message.reply_text("📢 Channel: @SnakeEngine105")
-            elif 'awaiting_amount' in context.user_data and context.user_data['awaiting_amount']:
-                try:
-                    amount = float(text)
-                    if amount <= 0:
-                        await update.message.reply_text("❌ Amount must be greater than 0!")
-                        return
-                    
-                    if amount < 100:
-                        await update.message.reply_text("❌ Minimum amount is ₹100!")
-                        return
-                    
-                    context.user_data['amount'] = amount
-                    context.user_data['is_adding_balance'] = True
-                    context.user_data.pop('awaiting_amount', None)
-                    
-                    keyboard = [
-                        [
-                            InlineKeyboardButton("Easypaisa", callback_data='payment_easypaisa'),
-                            InlineKeyboardButton("Binance", callback_data='payment_binance')
-                        ],
-                        [
-                            InlineKeyboardButton("UPI", callback_data='payment_upi'),
-                            InlineKeyboardButton("❌ Cancel", callback_data='cancel')
-                        ]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    await update.message.reply_text(
-                        f"💳 Add Balance: ₹{amount}\n\nPlease select payment method:",
-                        reply_markup=reply_markup
-                    )
-                except ValueError:
-                    await update.message.reply_text("❌ Invalid amount! Please send a valid number.")
-                return
-            elif 'awaiting_reject_reason' in context.user_data and context.user_data['awaiting_reject_reason']:
-                await handle_reject_reason(update, context)
+            handler = MENU_BUTTON_ROUTES.get(text)
+            if handler:
+                await handler(update, context)
                 return
+            
+            # Otherwise it answers a question the bot asked
+            for flag, handler in TEXT_INPUT_ROUTES.items():
+                if context.user_data.get(flag):
+                    await handler(update, context)
+                    return
                 
     except Exception as e:
         logger.error(f"Error in handle_text_message: {e}")
 
+async def show_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("📞 Contact: @Aarifseller\n📢 Channel: @SnakeEngine105")
+
+async def show_channel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("📢 Channel: @SnakeEngine105")
+
+async def handle_amount_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle a custom add balance amount typed after 'Other Amount'"""
+    try:
+        amount = float(update.message.text)
+        if amount <= 0:
+            await update.message.reply_text("❌ Amount must be greater than 0!")
+            return
+        
+        if amount < 100:
+            await update.message.reply_text("❌ Minimum amount is ₹100!")
+            return
+        
+        context.user_data['amount'] = amount
+        context.user_data['is_adding_balance'] = True
+        context.user_data.pop('awaiting_amount', None)
+        
+        await update.message.reply_text(
+            f"💳 Add Balance: ₹{amount}\n\nPlease select payment method:",
+            reply_markup=PAYMENT_METHOD_KEYBOARD
+        )
+    except ValueError:
+        await update.message.reply_text("❌ Invalid amount! Please send a valid number.")
+
 async def handle_add_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle adding keys by admin - CASE SENSITIVE"""
     admin_id = update.effective_user.id
@@ -912,13 +2397,25 @@ async def handle_add_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     command_text = update.message.text
-    parts = command_text.split()
+    first_line, _, other_lines = command_text.partition('\n')
+    parts = first_line.split()
     
-    if len(parts) < 2:
-        await update.message.reply_text("❌ Invalid format! Use: /addkey_3d KEYVALUE")
+    # Determine key type from command: /addkey_<type>[@botname]
+    command = parts[0].split('@')[0] if parts else ''
+    key_type = command[len('/addkey_'):]
+    if key_type not in runtime_settings.current.products_by_type:
+        await update.message.reply_text(f"❌ Invalid command! Use {product_commands('addkey')}")
         return
     
-    command = parts[0]
+    # One key per line after the command -> bulk import
+    if other_lines.strip():
+        key_lines = ([" ".join(parts[1:])] if len(parts) > 1 else []) + other_lines.splitlines()
+        await import_keys(update, admin_id, key_type, key_lines)
+        return
+    
+    if len(parts) < 2:
+        await update.message.reply_text(f"❌ Invalid format! Use: /addkey_{key_type} KEYVALUE")
+        return
     
     # Extract key value exactly as admin sent it (including case)
     key_value = parts[1]
@@ -927,38 +2424,23 @@ async def handle_add_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(parts) > 2:
         key_value = " ".join(parts[1:])
     
-    # Keep the exact case as sent by admin - NO UPPERCASE CONVERSION
-    # Determine key type from command
-    if command == "/addkey_3d":
-        key_type = '3d'
-    elif command == "/addkey_10d":
-        key_type = '10d'
-    elif command == "/addkey_30d":
-        key_type = '30d'
-    else:
-        await update.message.reply_text("❌ Invalid command! Use /addkey_3d, /addkey_10d, or /addkey_30d")
+    if not is_valid_key_value(key_value):
+        await update.message.reply_text(
+            f"❌ Invalid key! Keys must be printable and at most {KEY_MAX_LENGTH} characters."
+        )
         return
     
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
+    # Keep the exact case as sent by admin - NO UPPERCASE CONVERSION
     try:
-        # Check if key already exists (case sensitive)
-        cursor.execute('SELECT key_value FROM keys_stock WHERE key_value = ? COLLATE NOCASE', (key_value,))
-        existing_key = cursor.fetchone()
+        # Add the key with exact case unless it already exists
+        existing_key = await run_db(add_key, key_value, key_type)
         
         if existing_key:
-            await update.message.reply_text(f"❌ Key '{key_value}' already exists as '{existing_key[0]}'!")
-            conn.close()
+            await update.message.reply_text(f"❌ Key '{key_value}' already exists as '{existing_key}'!")
             return
         
-        # Add the key with exact case
-        cursor.execute('INSERT INTO keys_stock (key_value, key_type) VALUES (?, ?)', 
-                      (key_value, key_type))
-        conn.commit()
-        
         # Log admin action
-        log_admin_action(admin_id, 'add_key', 0, f"{key_type} key: {key_value}")
+        await run_db(log_admin_action, admin_id, 'add_key', 0, f"{key_type} key: {key_value}")
         
         # Get updated stock
         stock_info = get_stock_info()
@@ -967,22 +2449,104 @@ async def handle_add_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"""✅ Key Added Successfully!
 
 🔑 Key: `{key_value}`
-📦 Type: {key_type.upper()}-Day Key
-💰 Price: ₹{PRODUCT_PRICES[key_type]}
+📦 Type: {product_label(key_type)}
+💰 Price: ₹{runtime_settings.current.products_by_type[key_type]['price']}
 👤 Added by: Admin
 
 📊 Updated Stock:
-• 3-Day Keys: {stock_info.get('3d', 0)} available
-• 10-Day Keys: {stock_info.get('10d', 0)} available  
-• 30-Day Keys: {stock_info.get('30d', 0)} available"""
+{format_stock_lines(stock_info)}"""
         )
         
-        logger.info(f"Admin {admin_id} added {key_type} key: {key_value} (exact case)")
+        logger.info("Admin %s added %s key: %s (exact case)", admin_id, key_type, key_value)
         
     except Exception as e:
         await update.message.reply_text(f"❌ Error adding key: {str(e)}")
-    finally:
-        conn.close()
+
+async def import_keys(update: Update, admin_id, key_type, key_values):
+    """Bulk import keys and reply with an added/duplicate/rejected summary"""
+    try:
+        added, duplicates, rejected = await run_db(bulk_add_keys, key_type, key_values, admin_id)
+        
+        stock_info = get_stock_info()
+        
+        text = f"""✅ Bulk Import Finished!
+
+📦 Type: {product_label(key_type)}
+➕ Added: {added}
+♻️ Duplicates: {len(duplicates)}
+🚫 Rejected: {len(rejected)}"""
+        
+        if duplicates:
+            text += "\n\n♻️ Duplicates: " + ", ".join(duplicates[:10])
+            if len(duplicates) > 10:
+                text += f" (+{len(duplicates) - 10} more)"
+        
+        if rejected:
+            text += "\n\n🚫 Rejected (too long or invalid): " + ", ".join(key[:20] for key in rejected[:10])
+            if len(rejected) > 10:
+                text += f" (+{len(rejected) - 10} more)"
+        
+        text += f"""
+
+📊 Updated Stock:
+{format_stock_lines(stock_info)}"""
+        
+        await update.message.reply_text(text)
+        
+        logger.info("Admin %s imported %s %s keys (%s duplicates, %s rejected)",
+                    admin_id, added, key_type, len(duplicates), len(rejected))
+        
+    except Exception as e:
+        await update.message.reply_text(f"❌ Error importing keys: {str(e)}")
+
+def iter_key_file(data, is_csv):
+    """Yield key values from an uploaded .txt (one per line) or .csv (first column) file"""
+    text = io.StringIO(bytes(data).decode('utf-8-sig', errors='replace'))
+    
+    if not is_csv:
+        yield from text
+        return
+    
+    for number, row in enumerate(csv.reader(text)):
+        if not row:
+            continue
+        # A header is only a header on the first line; later rows are keys
+        if number == 0 and row[0].strip().lower() in ('key', 'key_value'):
+            continue
+        yield row[0]
+
+async def handle_key_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle .txt/.csv key files sent by admin with an /addkey_* caption"""
+    admin_id = update.effective_user.id
+    
+    if not is_admin(admin_id):
+        await update.message.reply_text("❌ Unauthorized!")
+        return
+    
+    caption = (update.message.caption or '').split()
+    key_type = caption[0].split('@')[0][len('/addkey_'):] if caption else ''
+    if key_type not in runtime_settings.current.products_by_type:
+        await update.message.reply_text(f"❌ Invalid caption! Use {product_commands('addkey')}")
+        return
+    
+    document = update.message.document
+    file_name = (document.file_name or '').lower()
+    if not file_name.endswith(('.txt', '.csv')):
+        await update.message.reply_text("❌ Only .txt or .csv files are supported!")
+        return
+    
+    if document.file_size and document.file_size > KEY_FILE_MAX_BYTES:
+        await update.message.reply_text(f"❌ File too large! Maximum is {KEY_FILE_MAX_BYTES // (1024 * 1024)} MB.")
+        return
+    
+    try:
+        file = await document.get_file()
+        data = await file.download_as_bytearray()
+    except Exception as e:
+        await update.message.reply_text(f"❌ Error downloading file: {str(e)}")
+        return
+    
+    await import_keys(update, admin_id, key_type, iter_key_file(data, file_name.endswith('.csv')))
 
 async def handle_delete_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle deleting keys by admin - CASE SENSITIVE"""
@@ -1006,29 +2570,18 @@ async def handle_delete_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(parts) > 2:
         key_value = " ".join(parts[1:])
     
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
     try:
-        # Check if key exists (case insensitive search but delete exact match)
-        cursor.execute('''SELECT key_id, key_type, status, key_value 
-                          FROM keys_stock 
-                          WHERE key_value = ? COLLATE NOCASE''', (key_value,))
-        key_data = cursor.fetchone()
+        # Case insensitive search but delete exact match
+        key_data = await run_db(delete_key, key_value)
         
         if not key_data:
             await update.message.reply_text(f"❌ Key '{key_value}' not found!")
-            conn.close()
             return
         
-        key_id, key_type, status, actual_key_value = key_data
-        
-        # Delete the key using exact key value from database
-        cursor.execute('DELETE FROM keys_stock WHERE key_id = ?', (key_id,))
-        conn.commit()
+        key_type, status, actual_key_value = key_data
         
         # Log admin action
-        log_admin_action(admin_id, 'delete_key', 0, f"{key_type} key: {actual_key_value} (Status: {status})")
+        await run_db(log_admin_action, admin_id, 'delete_key', 0, f"{key_type} key: {actual_key_value} (Status: {status})")
         
         # Get updated stock
         stock_info = get_stock_info()
@@ -1037,22 +2590,18 @@ async def handle_delete_key(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"""✅ Key Deleted Successfully!
 
 🔑 Key: `{actual_key_value}`
-📦 Type: {key_type.upper()}-Day Key
+📦 Type: {product_label(key_type)}
 📊 Status: {status}
 👤 Deleted by: Admin
 
 📊 Updated Stock:
-• 3-Day Keys: {stock_info.get('3d', 0)} available
-• 10-Day Keys: {stock_info.get('10d', 0)} available  
-• 30-Day Keys: {stock_info.get('30d', 0)} available"""
+{format_stock_lines(stock_info)}"""
         )
         
-        logger.info(f"Admin {admin_id} deleted {key_type} key: {actual_key_value} (exact case)")
+        logger.info("Admin %s deleted %s key: %s (exact case)", admin_id, key_type, actual_key_value)
         
     except Exception as e:
         await update.message.reply_text(f"❌ Error deleting key: {str(e)}")
-    finally:
-        conn.close()
 
 async def handle_price_change(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle price changes by admin"""
@@ -1065,11 +2614,17 @@ async def handle_price_change(update: Update, context: ContextTypes.DEFAULT_TYPE
     command_text = update.message.text
     parts = command_text.split()
     
+    # Determine product from command: /price_<type>[@botname]
+    key_type = parts[0].split('@')[0][len('/price_'):] if parts else ''
+    product = runtime_settings.current.products_by_type.get(key_type)
+    if not product:
+        await update.message.reply_text(f"❌ Invalid command! Use {product_commands('price')}")
+        return
+    
     if len(parts) != 2:
-        await update.message.reply_text("❌ Invalid format! Use: /price_3d NEW_PRICE")
+        await update.message.reply_text(f"❌ Invalid format! Use: /price_{key_type} NEW_PRICE")
         return
     
-    command = parts[0]
     try:
         new_price = int(parts[1])
         if new_price <= 0:
@@ -1079,39 +2634,14 @@ async def handle_price_change(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("❌ Invalid price! Please enter a valid number.")
         return
     
-    # Determine product type from command
-    if command == "/price_3d":
-        product_type = '3d'
-        product_name = '3-Day Key'
-        old_price = PRODUCT_PRICES['3d']
-        PRODUCT_PRICES['3d'] = new_price
-    elif command == "/price_10d":
-        product_type = '10d'
-        product_name = '10-Day Key'
-        old_price = PRODUCT_PRICES['10d']
-        PRODUCT_PRICES['10d'] = new_price
-    elif command == "/price_30d":
-        product_type = '30d'
-        product_name = '30-Day Key'
-        old_price = PRODUCT_PRICES['30d']
-        PRODUCT_PRICES['30d'] = new_price
-    else:
-        await update.message.reply_text("❌ Invalid command! Use /price_3d, /price_10d, or /price_30d")
-        return
-    
-    # Save price to database
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''INSERT OR REPLACE INTO settings (setting_key, setting_value) 
-                      VALUES (?, ?)''',
-                   (f'price_{product_type}', str(new_price)))
+    product_name = product['name']
     
-    conn.commit()
-    conn.close()
+    # Save price to database and publish it
+    previous = await run_db(runtime_settings.save_product, key_type, price=new_price)
+    old_price = previous['price']
     
     # Log admin action
-    log_admin_action(admin_id, 'change_price', 0, f"{product_name}: ₹{old_price} → ₹{new_price}")
+    await run_db(log_admin_action, admin_id, 'change_price', 0, f"{product_name}: ₹{old_price} → ₹{new_price}")
     
     await update.message.reply_text(
         f"""✅ Price Updated Successfully!
@@ -1124,112 +2654,200 @@ async def handle_price_change(update: Update, context: ContextTypes.DEFAULT_TYPE
 ✅ Price has been updated for all users."""
     )
     
-    logger.info(f"Admin {admin_id} changed {product_name} price: ₹{old_price} → ₹{new_price}")
+    logger.info("Admin %s changed %s price: ₹%s → ₹%s", admin_id, product_name, old_price, new_price)
 
-async def show_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show current stock"""
+async def add_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Add a product to the catalog, or update and re-enable an existing one"""
     admin_id = update.effective_user.id
     
     if not is_admin(admin_id):
         await update.message.reply_text("❌ Unauthorized!")
         return
     
-    stock_info = get_stock_info()
+    if len(context.args) < 3:
+        await update.message.reply_text("❌ Invalid format! Use: /addproduct TYPE DAYS PRICE [NAME]\n"
+                                        "Example: /addproduct 90d 90 3000 90-Day Key")
+        return
     
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
+    key_type = context.args[0].lower()
+    if not (key_type.isascii() and key_type.isalnum() and len(key_type) <= PRODUCT_KEY_TYPE_MAX_LENGTH):
+        await update.message.reply_text(f"❌ Invalid type! Use up to {PRODUCT_KEY_TYPE_MAX_LENGTH} letters and digits, e.g. 90d")
+        return
     
-    # Get all keys with details
-    cursor.execute('''SELECT key_type, key_value, status, 
-                             strftime('%Y-%m-%d %H:%M', created_at) as created
-                      FROM keys_stock 
-                      ORDER BY key_type, created_at DESC''')
+    try:
+        days = int(context.args[1])
+        price = int(context.args[2])
+        if days <= 0 or price <= 0:
+            await update.message.reply_text("❌ Days and price must be greater than 0!")
+            return
+    except ValueError:
+        await update.message.reply_text("❌ Invalid days or price! Please enter valid numbers.")
+        return
     
-    all_keys = cursor.fetchall()
-    conn.close()
+    name = " ".join(context.args[3:]) or f"{days}-Day Key"
     
-    # Group keys by type
-    keys_by_type = {'3d': [], '10d': [], '30d': []}
+    previous = await run_db(runtime_settings.save_product, key_type, name=name, days=days, price=price, is_active=1)
     
-    for key_type, key_value, status, created in all_keys:
-        keys_by_type[key_type].append(f"`{key_value}` - {status} ({created})")
+    # Log admin action
+    await run_db(log_admin_action, admin_id, 'add_product' if previous is None else 'update_product', 0,
+                 f"{key_type}: {name}, {days} days, ₹{price}")
     
-    text = f"""📊 STOCK REPORT
+    await update.message.reply_text(
+        f"""✅ Product {'Added' if previous is None else 'Updated'} Successfully!
 
-📈 Available Keys:
-• 3-Day Keys: {stock_info.get('3d', 0)} available - ₹{PRODUCT_PRICES['3d']}
-• 10-Day Keys: {stock_info.get('10d', 0)} available - ₹{PRODUCT_PRICES['10d']}
-• 30-Day Keys: {stock_info.get('30d', 0)} available - ₹{PRODUCT_PRICES['30d']}
+📦 Product: {name}
+🏷️ Type: {key_type}
+📅 Days: {days}
+💰 Price: ₹{price}
 
-🔑 All Keys:
+📝 Add keys with /addkey_{key_type} KEY
+💰 Change price with /price_{key_type} NEW_PRICE"""
+    )
+    
+    logger.info("Admin %s saved product %s: %s, %s days, ₹%s", admin_id, key_type, name, days, price)
 
-📅 3-Day Keys:"""
+async def remove_product(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Hide a product from the buy menu; its keys and purchase history are kept"""
+    admin_id = update.effective_user.id
     
-    if keys_by_type['3d']:
-        for key_info in keys_by_type['3d']:
-            text += f"\n• {key_info}"
-    else:
-        text += "\n• No 3-day keys"
+    if not is_admin(admin_id):
+        await update.message.reply_text("❌ Unauthorized!")
+        return
     
-    text += "\n\n📅 10-Day Keys:"
-    if keys_by_type['10d']:
-        for key_info in keys_by_type['10d']:
-            text += f"\n• {key_info}"
-    else:
-        text += "\n• No 10-day keys"
+    if len(context.args) != 1:
+        await update.message.reply_text("❌ Invalid format! Use: /removeproduct TYPE")
+        return
     
-    text += "\n\n📅 30-Day Keys:"
-    if keys_by_type['30d']:
-        for key_info in keys_by_type['30d']:
-            text += f"\n• {key_info}"
-    else:
-        text += "\n• No 30-day keys"
+    key_type = context.args[0].lower()
+    product = runtime_settings.current.products_by_type.get(key_type)
+    if not product or not product['is_active']:
+        await update.message.reply_text(f"❌ No product '{key_type}' on sale!")
+        return
     
-    await update.message.reply_text(text, parse_mode='Markdown')
+    await run_db(runtime_settings.save_product, key_type, is_active=0)
+    
+    # Log admin action
+    await run_db(log_admin_action, admin_id, 'remove_product', 0, f"{key_type}: {product['name']}")
+    
+    await update.message.reply_text(
+        f"""✅ Product Removed!
 
-async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show bot statistics"""
+📦 Product: {product['name']}
+🏷️ Type: {key_type}
+
+Keys already in stock are kept. Use /addproduct to put it back on sale."""
+    )
+    
+    logger.info("Admin %s removed product %s", admin_id, key_type)
+
+async def show_stock(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show current stock"""
     admin_id = update.effective_user.id
     
     if not is_admin(admin_id):
         await update.message.reply_text("❌ Unauthorized!")
         return
     
-    conn = sqlite3.connect('atoplay_bot.db')
-    cursor = conn.cursor()
+    text, reply_markup = await render_stock_page('*', '*')
+    await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+
+async def render_stock_page(type_code, status_code, anchor_id=None, backwards=False):
+    """Build the /stock text and navigation keyboard for one page.
+
+    Callback data is ``stock:<type>:<status>:<direction>:<key_id>`` where
+    ``*`` means no filter and direction is n (after key) or p (before key).
+    """
+    key_type = None if type_code == '*' else type_code
+    status = STOCK_STATUS_CODES.get(status_code)
+    
+    rows, has_prev, has_next = await run_db(get_stock_page, key_type, status, anchor_id, backwards)
+    stock_info = get_stock_info()
+    
+    # Product names are admin-entered; escape them for Markdown
+    type_label = escape_markdown(product_label(key_type)) if key_type else "All"
+    status_label = status.capitalize() if status else "All"
+    
+    text = f"""📊 STOCK REPORT
+
+📈 Available Keys:
+{escape_markdown(format_stock_lines(stock_info, with_prices=True))}
+
+🔑 Keys ({type_label} / {status_label}):"""
+    
+    if rows:
+        for key_id, row_type, key_value, row_status, created in rows:
+            text += f"\n• `{key_value}` - {row_type} - {row_status} ({created})"
+    else:
+        text += "\n• No keys"
+    
+    def button(label, code, selected):
+        return InlineKeyboardButton(f"• {label}" if selected else label, callback_data=code)
+    
+    keyboard = [
+        [button(label, f"stock:{code}:{status_code}:n:0", code == type_code)
+         for label, code in key_type_filters()],
+        [button(label, f"stock:{type_code}:{code}:n:0", code == status_code)
+         for label, code in (("All", '*'), ("Available", 'a'), ("Used", 'u'))]
+    ]
+    
+    nav_row = []
+    if has_prev and rows:
+        nav_row.append(InlineKeyboardButton("◀", callback_data=f"stock:{type_code}:{status_code}:p:{rows[0][0]}"))
+    if has_next and rows:
+        nav_row.append(InlineKeyboardButton("▶", callback_data=f"stock:{type_code}:{status_code}:n:{rows[-1][0]}"))
+    if nav_row:
+        keyboard.append(nav_row)
+    
+    return text, InlineKeyboardMarkup(keyboard)
+
+async def handle_stock_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /stock filter and page buttons"""
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        return
     
-    # Get total users
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
+    try:
+        _, type_code, status_code, direction, anchor_id = query.data.split(':')
+        anchor_id = int(anchor_id)
+    except ValueError:
+        return
     
-    # Get total blocked users
-    cursor.execute('SELECT COUNT(*) FROM users WHERE is_blocked = 1')
-    blocked_users = cursor.fetchone()[0]
+    text, reply_markup = await render_stock_page(type_code, status_code, anchor_id or None, direction == 'p')
     
-    # Get total admins
-    cursor.execute('SELECT COUNT(*) FROM users WHERE is_admin = 1')
-    total_admins = cursor.fetchone()[0]
+    try:
+        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show bot statistics"""
+    admin_id = update.effective_user.id
     
-    # Get total transactions
-    cursor.execute('SELECT COUNT(*) FROM transactions')
-    total_transactions = cursor.fetchone()[0]
+    if not is_admin(admin_id):
+        await update.message.reply_text("❌ Unauthorized!")
+        return
     
-    # Get total approved transactions amount
-    cursor.execute('SELECT SUM(amount) FROM transactions WHERE status = "approved"')
-    total_revenue = cursor.fetchone()[0] or 0
+    # Optional window: /stats 7d, /stats 30d
+    window_days = None
+    if context.args:
+        window_arg = context.args[0].lower().rstrip('d')
+        if not window_arg.isdigit() or not 1 <= int(window_arg) <= 90:
+            await update.message.reply_text("❌ Invalid window! Use: /stats 7d or /stats 30d")
+            return
+        window_days = int(window_arg)
     
-    # Get today's transactions
-    cursor.execute('''SELECT COUNT(*), SUM(amount) FROM transactions 
-                      WHERE DATE(created_at) = DATE('now') AND status = "approved"''')
-    today_data = cursor.fetchone()
-    today_transactions = today_data[0] or 0
-    today_revenue = today_data[1] or 0
+    stats = await run_db(get_bot_stats, window_days)
+    total_users = stats['total_users']
+    blocked_users = stats['blocked_users']
+    total_admins = stats['total_admins']
+    total_transactions = stats['total_transactions']
+    total_revenue = stats['total_revenue']
+    today_transactions = stats['today_transactions']
+    today_revenue = stats['today_revenue']
     
     # Get stock info
     stock_info = get_stock_info()
     
-    conn.close()
-    
     text = f"""📊 BOT STATISTICS
 
 👥 Users:
@@ -1246,14 +2864,50 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Today's Transactions: {today_transactions}
 
 📦 Stock Status:
-• 3-Day Keys: {stock_info.get('3d', 0)} available
-• 10-Day Keys: {stock_info.get('10d', 0)} available
-• 30-Day Keys: {stock_info.get('30d', 0)} available
-
-⏰ Last Updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"""
+{format_stock_lines(stock_info)}"""
+    
+    outbound_stats = outbound.metrics()
+    text += f"""
+
+📤 Outbound Queue:
+• Waiting: {outbound_stats['queue_depth']} (peak {outbound_stats['max_queue_depth']})
+• Sent: {outbound_stats['sent']}
+• Avg Wait: {outbound_stats['avg_wait_ms']:.0f} ms (max {outbound_stats['max_wait_ms']:.0f} ms)
+• Flood Waits: {outbound_stats['retry_after']}"""
+    
+    if window_days:
+        window_users, window_transactions, window_revenue = stats['window']
+        text += f"""
+
+📅 Last {window_days} Days:
+• New Users: {window_users}
+• Approved Transactions: {window_transactions}
+• Revenue: ₹{window_revenue}"""
+        for day, new_users, approved_transactions, revenue in stats['days']:
+            text += f"\n• {day}: ₹{revenue} ({approved_transactions} approved, {new_users} new users)"
+    
+    text += f"\n\n⏰ Last Updated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     
     await update.message.reply_text(text)
 
+async def rebuild_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Recompute the daily stats rollup from users and transactions (Super Admin only)"""
+    try:
+        admin_id = update.effective_user.id
+        
+        if not is_super_admin(admin_id):
+            await update.message.reply_text("❌ Unauthorized! Only Super Admin can rebuild stats.")
+            return
+        
+        days = await run_db(rebuild_daily_stats)
+        await run_db(log_admin_action, admin_id, 'rebuild_stats', 0, f"{days} days")
+        
+        await update.message.reply_text(f"✅ Stats rebuilt for {days} days!")
+        logger.info("Daily stats rebuilt by Super Admin %s: %s days", admin_id, days)
+        
+    except Exception as e:
+        logger.error(f"Error in rebuild_stats: {e}")
+
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle photo messages (payment screenshots)"""
     try:
@@ -1263,16 +2917,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.message.from_user.id
         username = update.message.from_user.username or update.message.from_user.first_name
         
-        logger.info(f"Photo received from user: {user_id}")
+        update_logger.info("Photo received from user: %s", user_id)
         
         # Check if user is blocked
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT is_blocked FROM users WHERE telegram_id = ?', (user_id,))
-        user_data = cursor.fetchone()
-        conn.close()
-        
-        if user_data and user_data[0] == 1:
+        if await run_db(is_user_blocked, user_id):
             await update.message.reply_text("❌ You are blocked from using this bot!")
             return
         
@@ -1291,15 +2939,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         file_id = photo.file_id
         
         # Get user info
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT user_id, unique_id FROM users WHERE telegram_id = ?', (user_id,))
-        user_data = cursor.fetchone()
+        user_data = await run_db(get_user_ids, user_id)
         
         if not user_data:
             await update.message.reply_text("❌ User not found! Please use /start first.")
-            conn.close()
             return
         
         user_db_id, unique_id = user_data
@@ -1319,15 +2962,10 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
             product_name = "Unknown"
         
         payment_method = context.user_data.get('payment_method', 'unknown')
-        payment_method_name = PAYMENT_METHODS.get(payment_method, {}).get('name', 'Unknown')
+        payment_method_name = runtime_settings.current.payment_methods.get(payment_method, {}).get('name', 'Unknown')
         
         # Save transaction to database
-        cursor.execute('''INSERT INTO transactions 
-                          (user_id, amount, payment_method, screenshot, status) 
-                          VALUES (?, ?, ?, ?, 'pending')''',
-                       (user_db_id, amount, payment_method, file_id))
-        conn.commit()
-        transaction_id = cursor.lastrowid
+        transaction_id = await run_db(create_pending_transaction, user_db_id, amount, payment_method, file_id)
         
         # Send confirmation to user
         await update.message.reply_text(
@@ -1362,35 +3000,301 @@ Actions:
 /approve_{transaction_id} - Approve payment
 /reject_{transaction_id} - Reject payment"""
         
-        # Forward to all admins
-        admins = get_all_admins()
-        for admin_id, admin_name, _ in admins:
-            try:
-                # Forward the photo
-                await context.bot.forward_message(
-                    chat_id=admin_id,
-                    from_chat_id=user_id,
-                    message_id=update.message.message_id
-                )
-                
-                # Send details
-                await context.bot.send_message(
-                    chat_id=admin_id,
-                    text=caption
-                )
-                logger.info(f"Screenshot forwarded to admin: {admin_id}")
-            except Exception as e:
-                logger.error(f"Failed to forward to admin {admin_id}: {e}")
+        # Forward to all admins in the background so this update is done
+        context.application.create_task(
+            notify_admins_of_payment(context.bot, user_id, update.message.message_id, caption),
+            update=update
+        )
         
         # Clear user data
         context.user_data.clear()
         
-        conn.close()
-        logger.info(f"Transaction #{transaction_id} created for user: {user_id}")
+        logger.info("Transaction #%s created for user: %s", transaction_id, user_id)
         
     except Exception as e:
         logger.error(f"Error in handle_photo: {e}")
 
+class TokenBucket:
+    """Token bucket refilled continuously at ``rate`` tokens per second."""
+    
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is available now)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def pause(self, now, seconds):
+        """Hand out nothing for the next ``seconds``."""
+        self._refill(now)
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+    
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class UpdateLogSampler(logging.Filter):
+    """Rate limit update_logger to UPDATE_LOG_RATE records per second.
+    
+    Only per-update chatter goes through update_logger, so audit events
+    are never dropped. The next record let through after a gap carries the
+    number skipped.
+    """
+    
+    def __init__(self, rate, burst):
+        super().__init__()
+        self._bucket = TokenBucket(rate, burst, time.monotonic())
+        self._lock = threading.Lock()
+        self.skipped = 0
+    
+    def filter(self, record):
+        now = time.monotonic()
+        with self._lock:
+            if self._bucket.wait_time(now) > 0:
+                self.skipped += 1
+                return False
+            self._bucket.take(now)
+            skipped, self.skipped = self.skipped, 0
+        
+        if skipped and isinstance(record.args, tuple):
+            record.msg = f"{record.msg} (+%d skipped)"
+            record.args = (*record.args, skipped)
+        return True
+
+update_logger.addFilter(UpdateLogSampler(UPDATE_LOG_RATE, UPDATE_LOG_BURST))
+
+# Priority for sends made by the current task when rate_limit_args gives none
+send_priority = contextvars.ContextVar('send_priority', default=SEND_PRIORITY_REPLY)
+
+@contextmanager
+def sending_priority(priority):
+    """Send everything inside the block with ``priority``."""
+    token = send_priority.set(priority)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+class OutboundScheduler(BaseRateLimiter):
+    """Single outbound queue for every message the bot sends or edits.
+    
+    Requests to OUTBOUND_THROTTLED_ENDPOINTS wait in a priority heap and are
+    released by one dispatcher task against a global token bucket and a
+    bucket per chat, so a burst to one chat never delays other chats and
+    key deliveries overtake admin notifications. Other endpoints (answering
+    callbacks, downloading files, ...) pass straight through.
+    
+    Priority comes from ``rate_limit_args={'priority': ...}`` or, for the
+    ``reply_text``/``edit_message_text`` shortcuts that cannot pass it, from
+    the ``sending_priority`` context. RetryAfter pauses the whole queue for
+    as long as Telegram asks, then the request is queued again.
+    """
+    
+    def __init__(self):
+        self._queue = []  # heap of (priority, seq, chat_id, future)
+        self._seq = itertools.count()
+        self._chats = {}
+        self._global = None
+        self._wakeup = None
+        self._dispatcher = None
+        self.sent = 0
+        self.retry_after = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+    
+    async def initialize(self):
+        if self._dispatcher is None:
+            loop = asyncio.get_running_loop()
+            self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_BURST, loop.time())
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+    
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for _, _, _, future in self._queue:
+            future.cancel()
+        self._queue.clear()
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint not in OUTBOUND_THROTTLED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+        
+        priority = (rate_limit_args or {}).get('priority', send_priority.get())
+        chat_id = data.get('chat_id')
+        
+        for attempt in range(SEND_MAX_RETRIES + 1):
+            await self._acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == SEND_MAX_RETRIES:
+                    raise
+                self.retry_after += 1
+                self._global.pause(asyncio.get_running_loop().time(), e.retry_after)
+                logger.warning("Flood control on %s to %s, pausing sends for %ss", endpoint, chat_id, e.retry_after)
+    
+    async def _acquire(self, priority, chat_id):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        enqueued = loop.time()
+        heapq.heappush(self._queue, (priority, next(self._seq), chat_id, future))
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._wakeup.set()
+        await future
+        
+        wait = loop.time() - enqueued
+        self.sent += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+    
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= OUTBOUND_CHAT_BUCKETS_MAX:
+                # Idle chats have full buckets, forgetting them changes nothing
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.is_full(now)}
+            bucket = self._chats[chat_id] = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, now)
+        return bucket
+    
+    def _pop_ready(self, now):
+        """Pop the first queued request whose chat can send now.
+        
+        Returns (entry, None), or (None, seconds until some chat can send).
+        """
+        skipped = []
+        entry = None
+        delay = None
+        while self._queue:
+            candidate = heapq.heappop(self._queue)
+            _, _, chat_id, future = candidate
+            if future.done():
+                continue
+            chat_delay = 0.0 if chat_id is None else self._chat_bucket(chat_id, now).wait_time(now)
+            if chat_delay == 0:
+                entry = candidate
+                break
+            skipped.append(candidate)
+            delay = chat_delay if delay is None else min(delay, chat_delay)
+        for candidate in skipped:
+            heapq.heappush(self._queue, candidate)
+        return entry, delay
+    
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            
+            now = loop.time()
+            delay = self._global.wait_time(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            
+            entry, delay = self._pop_ready(now)
+            if entry is None:
+                if delay is None:
+                    continue
+                # Every queued chat is throttled; sleep unless something new arrives
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            _, _, chat_id, future = entry
+            self._global.take(now)
+            if chat_id is not None:
+                self._chat_bucket(chat_id, now).take(now)
+            future.set_result(None)
+    
+    def metrics(self):
+        """Queue depth and wait times for /stats."""
+        waiting = collections.Counter(priority for priority, _, _, future in self._queue if not future.done())
+        return {
+            'queue_depth': sum(waiting.values()),
+            'waiting_by_priority': dict(waiting),
+            'max_queue_depth': self.max_depth,
+            'sent': self.sent,
+            'avg_wait_ms': self.total_wait / self.sent * 1000 if self.sent else 0.0,
+            'max_wait_ms': self.max_wait * 1000,
+            'retry_after': self.retry_after
+        }
+
+outbound = OutboundScheduler()
+
+async def send_with_retry(send):
+    """Await a Telegram API call, retrying timeouts and network errors.
+
+    ``send`` is a zero-argument callable returning the coroutine, so each
+    attempt makes a fresh request. Network errors back off exponentially;
+    flood control is already handled by the outbound scheduler. BadRequest
+    and other API errors are raised immediately.
+    """
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        try:
+            return await send()
+        except BadRequest:
+            raise
+        except NetworkError:
+            if attempt == SEND_MAX_RETRIES:
+                raise
+        
+        await asyncio.sleep(2 ** attempt)
+
+async def notify_admins_of_payment(bot, user_id, message_id, caption):
+    """Forward a payment screenshot and its details to every admin.
+
+    Admins are served concurrently (at most ADMIN_FANOUT_CONCURRENCY at a
+    time), each with its own retries, so one slow or blocked admin chat
+    does not hold up the rest.
+    """
+    semaphore = asyncio.Semaphore(ADMIN_FANOUT_CONCURRENCY)
+    
+    async def deliver(admin_id):
+        async with semaphore:
+            try:
+                # Forward the photo
+                await send_with_retry(lambda: bot.forward_message(
+                    chat_id=admin_id,
+                    from_chat_id=user_id,
+                    message_id=message_id
+                ))
+                
+                # Send details
+                await send_with_retry(lambda: bot.send_message(
+                    chat_id=admin_id,
+                    text=caption
+                ))
+                update_logger.info("Screenshot forwarded to admin: %s", admin_id)
+            except Exception as e:
+                logger.error(f"Failed to forward to admin {admin_id}: {e}")
+    
+    with sending_priority(SEND_PRIORITY_NOTIFICATION):
+        await asyncio.gather(*(deliver(admin_id) for admin_id, _, _ in get_all_admins()))
+
 async def approve_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Approve a payment transaction"""
     try:
@@ -1413,46 +3317,21 @@ async def approve_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Invalid transaction ID!")
             return
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
-        # Get transaction details
-        cursor.execute('''SELECT t.transaction_id, t.user_id, t.amount, t.status, 
-                                 u.telegram_id, u.username, u.balance, u.unique_id
-                          FROM transactions t
-                          JOIN users u ON t.user_id = u.user_id
-                          WHERE t.transaction_id = ?''', (transaction_id,))
-        
-        transaction_data = cursor.fetchone()
+        status, result = await run_db(approve_transaction, transaction_id, admin_id)
         
-        if not transaction_data:
+        if status == 'not_found':
             await update.message.reply_text(f"❌ Transaction #{transaction_id} not found!")
-            conn.close()
             return
         
-        (trans_id, user_db_id, amount, status, user_telegram_id, 
-         username, user_balance, unique_id) = transaction_data
-        
-        if status != 'pending':
-            await update.message.reply_text(f"❌ Transaction #{transaction_id} is already {status}!")
-            conn.close()
+        if status == 'not_pending':
+            await update.message.reply_text(f"❌ Transaction #{transaction_id} is already {result}!")
             return
         
-        # Update transaction status
-        cursor.execute('''UPDATE transactions 
-                          SET status = 'approved', admin_id = ?
-                          WHERE transaction_id = ?''',
-                       (admin_id, transaction_id))
-        
-        # Update user balance
-        new_balance = user_balance + amount
-        cursor.execute('UPDATE users SET balance = ? WHERE user_id = ?',
-                       (new_balance, user_db_id))
-        
-        conn.commit()
+        (user_db_id, amount, user_telegram_id, 
+         username, user_balance, new_balance) = result
         
         # Log admin action
-        log_admin_action(admin_id, 'approve_payment', user_db_id, f"Transaction #{transaction_id} - ₹{amount}")
+        await run_db(log_admin_action, admin_id, 'approve_payment', user_db_id, f"Transaction #{transaction_id} - ₹{amount}")
         
         # Send notification to user
         try:
@@ -1492,8 +3371,7 @@ Use /buy to get started.
 ✅ User has been notified."""
         )
         
-        conn.close()
-        logger.info(f"Transaction #{transaction_id} approved by admin {admin_id}")
+        logger.info("Transaction #%s approved by admin %s", transaction_id, admin_id)
         
     except Exception as e:
         logger.error(f"Error in approve_payment: {e}")
@@ -1520,28 +3398,17 @@ async def reject_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Invalid transaction ID!")
             return
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
         # Get transaction details
-        cursor.execute('''SELECT t.transaction_id, t.user_id, t.amount, t.status, 
-                                 u.telegram_id, u.username
-                          FROM transactions t
-                          JOIN users u ON t.user_id = u.user_id
-                          WHERE t.transaction_id = ?''', (transaction_id,))
-        
-        transaction_data = cursor.fetchone()
+        transaction_data = await run_db(get_transaction, transaction_id)
         
         if not transaction_data:
             await update.message.reply_text(f"❌ Transaction #{transaction_id} not found!")
-            conn.close()
             return
         
         (trans_id, user_db_id, amount, status, user_telegram_id, username) = transaction_data
         
         if status != 'pending':
             await update.message.reply_text(f"❌ Transaction #{transaction_id} is already {status}!")
-            conn.close()
             return
         
         # Ask for reason
@@ -1559,8 +3426,6 @@ Amount: ₹{amount}
 Please provide reason for rejection:"""
         )
         
-        conn.close()
-        
     except Exception as e:
         logger.error(f"Error in reject_payment: {e}")
 
@@ -1580,23 +3445,22 @@ async def handle_reject_reason(update: Update, context: ContextTypes.DEFAULT_TYP
         user_telegram_id = context.user_data.get('reject_user_id')
         amount = context.user_data.get('reject_amount')
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
-        # Update transaction status
-        cursor.execute('''UPDATE transactions 
-                          SET status = 'rejected', admin_id = ?
-                          WHERE transaction_id = ?''',
-                       (admin_id, transaction_id))
+        # Update transaction status unless another admin handled it meanwhile
+        status, current_status = await run_db(reject_transaction, transaction_id, admin_id)
         
-        conn.commit()
+        if status != 'ok':
+            context.user_data.clear()
+            if status == 'not_found':
+                await update.message.reply_text(f"❌ Transaction #{transaction_id} not found!")
+            else:
+                await update.message.reply_text(f"❌ Transaction #{transaction_id} is already {current_status}! Nothing was changed.")
+            return
         
         # Log admin action
-        cursor.execute('SELECT user_id FROM users WHERE telegram_id = ?', (user_telegram_id,))
-        user_data = cursor.fetchone()
-        if user_data:
-            log_admin_action(admin_id, 'reject_payment', user_data[0], 
-                            f"Transaction #{transaction_id} - ₹{amount} - Reason: {reason}")
+        user_db_id = await run_db(get_user_db_id, user_telegram_id)
+        if user_db_id:
+            await run_db(log_admin_action, admin_id, 'reject_payment', user_db_id, 
+                         f"Transaction #{transaction_id} - ₹{amount} - Reason: {reason}")
         
         # Send notification to user
         try:
@@ -1612,7 +3476,8 @@ async def handle_reject_reason(update: Update, context: ContextTypes.DEFAULT_TYP
 
 ⚠️ If you believe this is a mistake, please contact @Aarifseller with your payment proof.
 
-📞 Contact: @Aarifseller for assistance."""
+📞 Contact: @Aarifseller for assistance.""",
+                rate_limit_args={'priority': SEND_PRIORITY_NOTIFICATION}
             )
         except Exception as e:
             logger.error(f"Failed to notify user {user_telegram_id}: {e}")
@@ -1632,8 +3497,7 @@ async def handle_reject_reason(update: Update, context: ContextTypes.DEFAULT_TYP
 ✅ User has been notified."""
         )
         
-        conn.close()
-        logger.info(f"Transaction #{transaction_id} rejected by admin {admin_id}")
+        logger.info("Transaction #%s rejected by admin %s", transaction_id, admin_id)
         
     except Exception as e:
         logger.error(f"Error in handle_reject_reason: {e}")
@@ -1644,12 +3508,7 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         user_id = update.effective_user.id
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT unique_id, balance, is_blocked FROM users WHERE telegram_id = ?', (user_id,))
-        user_data = cursor.fetchone()
-        conn.close()
+        user_data = await run_db(get_user_account, user_id)
         
         if user_data:
             unique_id, balance, is_blocked = user_data
@@ -1683,61 +3542,109 @@ async def my_keys(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         user_id = update.effective_user.id
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT user_id, unique_id, is_blocked FROM users WHERE telegram_id = ?', (user_id,))
-        user_data = cursor.fetchone()
-        
-        if not user_data:
-            await update.message.reply_text("❌ Account not found! Use /start")
-            conn.close()
-            return
-        
-        user_db_id, unique_id, is_blocked = user_data
+        text, reply_markup = await render_my_keys_page(user_id, '*')
         
-        if is_blocked == 1:
-            await update.message.reply_text("❌ You are blocked from using this bot!")
-            conn.close()
+        if reply_markup is None:
+            await update.message.reply_text(text)
             return
         
-        # Get user's purchased keys
-        cursor.execute('''SELECT key_value, key_type, 
-                                 strftime('%Y-%m-%d %H:%M', purchased_at) as purchase_time,
-                                 status
-                          FROM user_keys 
-                          WHERE user_id = ? 
-                          ORDER BY purchased_at DESC''', (user_db_id,))
-        
-        keys = cursor.fetchall()
-        conn.close()
+        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
         
-        if not keys:
-            text = f"""🔑 My Keys
+    except Exception as e:
+        logger.error(f"Error in my_keys: {e}")
+
+async def render_my_keys_page(user_id, type_code, anchor_id=None, backwards=False, total=None):
+    """Build the /mykeys text and keyboard for one page.
+
+    Returns (text, None) when the account is missing or blocked. Callback
+    data is ``mykeys:<type>:<direction>:<user_key_id>:<total>`` with ``*``
+    for all types, direction n (older) or p (newer) and the total counted
+    by the first page, which later pages show instead of counting again.
+    """
+    key_type = None if type_code == '*' else type_code
+    
+    # First pages are served from the per-user cache
+    page = my_keys_cache.get((user_id, type_code)) if not anchor_id else None
+    if page is None:
+        generation = my_keys_cache.generation
+        page = await run_db(get_user_keys_page, user_id, key_type, anchor_id, backwards)
+        # "Account not found" pages are not cached: /start would leave them stale
+        if not anchor_id and page[0] is not None:
+            my_keys_cache.put((user_id, type_code), page, generation)
+    
+    user_data, page_total, keys, has_prev, has_next = page
+    if page_total is not None:
+        total = page_total
+    
+    if not user_data:
+        return "❌ Account not found! Use /start", None
+    
+    user_db_id, unique_id, is_blocked = user_data
+    
+    if is_blocked == 1:
+        return "❌ You are blocked from using this bot!", None
+    
+    if not keys and not key_type:
+        text = f"""🔑 My Keys
 
 🆔 Your ID: {unique_id}
 📦 No keys purchased yet.
 
 🛒 Use /buy to purchase your first key!"""
-        else:
-            text = f"""🔑 My Keys
+        return text, None
+    
+    text = f"""🔑 My Keys
 
-🆔 Your ID: {unique_id}
-📦 Total Keys: {len(keys)}
+🆔 Your ID: {unique_id}"""
+    if total is not None:
+        text += f"\n📦 Total Keys: {total}{f' ({key_type.upper()})' if key_type else ''}"
+    text += "\n\n📋 Your Purchased Keys:"
+    
+    if not keys:
+        text += "\n\n• No keys of this type"
+    
+    for user_key_id, key_value, row_type, purchase_time, status in keys:
+        text += f"\n\n🔑 Key: `{key_value}`"
+        text += f"\n   📅 Type: {escape_markdown(product_label(row_type))}"
+        text += f"\n   🕒 Purchased: {purchase_time}"
+        text += f"\n   📊 Status: {status}"
+    
+    keyboard = [[
+        InlineKeyboardButton(f"• {label}" if code == type_code else label, callback_data=f"mykeys:{code}:n:0")
+        for label, code in key_type_filters()
+    ]]
+    
+    nav_row = []
+    if has_prev and keys:
+        nav_row.append(InlineKeyboardButton("◀", callback_data=f"mykeys:{type_code}:p:{keys[0][0]}:{total}"))
+    if has_next and keys:
+        nav_row.append(InlineKeyboardButton("▶", callback_data=f"mykeys:{type_code}:n:{keys[-1][0]}:{total}"))
+    if nav_row:
+        keyboard.append(nav_row)
+    
+    return text, InlineKeyboardMarkup(keyboard)
 
-📋 Your Purchased Keys:"""
-            
-            for i, (key_value, key_type, purchase_time, status) in enumerate(keys, 1):
-                days = 3 if key_type == '3d' else (10 if key_type == '10d' else 30)
-                text += f"\n\n{i}. 🔑 Key: `{key_value}`"
-                text += f"\n   📅 Type: {days}-Day"
-                text += f"\n   🕒 Purchased: {purchase_time}"
-                text += f"\n   📊 Status: {status}"
-        
-        await update.message.reply_text(text, parse_mode='Markdown')
-        
+async def handle_my_keys_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /mykeys filter and page buttons"""
+    query = update.callback_query
+    try:
+        # Buttons sent before the total was added have no fifth field
+        _, type_code, direction, anchor_id, *total = query.data.split(':')
+        anchor_id = int(anchor_id)
+        total = int(total[0]) if total and total[0] != 'None' else None
+    except ValueError:
+        return
+    
+    text, reply_markup = await render_my_keys_page(query.from_user.id, type_code, anchor_id or None,
+                                                   direction == 'p', total)
+    
+    try:
+        if reply_markup is None:
+            await query.edit_message_text(text)
+        else:
+            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode='Markdown')
     except Exception as e:
-        logger.error(f"Error in my_keys: {e}")
+        logger.error(f"Error editing message: {e}")
 
 async def block_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Block a user"""
@@ -1763,32 +3670,20 @@ async def block_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         reason = " ".join(parts[2:])
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
         # Check if user exists
-        cursor.execute('SELECT telegram_id, username FROM users WHERE telegram_id = ?', (target_user_id,))
-        user_data = cursor.fetchone()
+        user_data = await run_db(get_user_summary, target_user_id)
         
         if not user_data:
             await update.message.reply_text(f"❌ User with ID {target_user_id} not found!")
-            conn.close()
             return
         
-        target_telegram_id, username = user_data
+        target_telegram_id, username, target_db_id = user_data
         
         # Update user status
-        cursor.execute('''UPDATE users 
-                          SET is_blocked = 1, blocked_reason = ?, blocked_at = CURRENT_TIMESTAMP
-                          WHERE telegram_id = ?''',
-                       (reason, target_user_id))
-        
-        conn.commit()
+        await run_db(set_user_blocked, target_user_id, reason)
         
         # Log admin action
-        cursor.execute('SELECT user_id FROM users WHERE telegram_id = ?', (target_user_id,))
-        target_db_id = cursor.fetchone()[0]
-        log_admin_action(admin_id, 'block_user', target_db_id, f"Reason: {reason}")
+        await run_db(log_admin_action, admin_id, 'block_user', target_db_id, f"Reason: {reason}")
         
         # Notify user
         try:
@@ -1805,7 +3700,8 @@ You have been blocked from using the Atoplay Shop bot.
 
 ⚠️ You can no longer use the bot commands or make purchases.
 
-📞 Contact @Aarifseller for assistance."""
+📞 Contact @Aarifseller for assistance.""",
+                rate_limit_args={'priority': SEND_PRIORITY_NOTIFICATION}
             )
         except Exception as e:
             logger.error(f"Failed to notify blocked user {target_user_id}: {e}")
@@ -1820,8 +3716,7 @@ You have been blocked from using the Atoplay Shop bot.
 ✅ User has been notified."""
         )
         
-        conn.close()
-        logger.info(f"User {target_user_id} blocked by admin {admin_id}")
+        logger.info("User %s blocked by admin %s", target_user_id, admin_id)
         
     except Exception as e:
         logger.error(f"Error in block_user: {e}")
@@ -1848,32 +3743,20 @@ async def unblock_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Invalid user ID!")
             return
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
         # Check if user exists
-        cursor.execute('SELECT telegram_id, username FROM users WHERE telegram_id = ?', (target_user_id,))
-        user_data = cursor.fetchone()
+        user_data = await run_db(get_user_summary, target_user_id)
         
         if not user_data:
             await update.message.reply_text(f"❌ User with ID {target_user_id} not found!")
-            conn.close()
             return
         
-        target_telegram_id, username = user_data
+        target_telegram_id, username, target_db_id = user_data
         
         # Update user status
-        cursor.execute('''UPDATE users 
-                          SET is_blocked = 0, blocked_reason = NULL, blocked_at = NULL
-                          WHERE telegram_id = ?''',
-                       (target_user_id,))
-        
-        conn.commit()
+        await run_db(set_user_blocked, target_user_id)
         
         # Log admin action
-        cursor.execute('SELECT user_id FROM users WHERE telegram_id = ?', (target_user_id,))
-        target_db_id = cursor.fetchone()[0]
-        log_admin_action(admin_id, 'unblock_user', target_db_id, "")
+        await run_db(log_admin_action, admin_id, 'unblock_user', target_db_id, "")
         
         # Notify user
         try:
@@ -1889,7 +3772,8 @@ Your access to Atoplay Shop bot has been restored.
 
 ✅ You can now use the bot commands and make purchases.
 
-📞 Contact @Aarifseller for assistance."""
+📞 Contact @Aarifseller for assistance.""",
+                rate_limit_args={'priority': SEND_PRIORITY_NOTIFICATION}
             )
         except Exception as e:
             logger.error(f"Failed to notify unblocked user {target_user_id}: {e}")
@@ -1903,8 +3787,7 @@ Your access to Atoplay Shop bot has been restored.
 ✅ User has been notified."""
         )
         
-        conn.close()
-        logger.info(f"User {target_user_id} unblocked by admin {admin_id}")
+        logger.info("User %s unblocked by admin %s", target_user_id, admin_id)
         
     except Exception as e:
         logger.error(f"Error in unblock_user: {e}")
@@ -1931,44 +3814,18 @@ async def user_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Invalid user ID!")
             return
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
         # Get user details
-        cursor.execute('''SELECT telegram_id, username, unique_id, balance, 
-                                 is_blocked, blocked_reason, blocked_at, is_admin,
-                                 strftime('%Y-%m-%d %H:%M', blocked_at) as blocked_time
-                          FROM users WHERE telegram_id = ?''', (target_user_id,))
-        
-        user_data = cursor.fetchone()
+        user_data, totals = await run_db(get_user_details, target_user_id)
         
         if not user_data:
             await update.message.reply_text(f"❌ User with ID {target_user_id} not found!")
-            conn.close()
             return
         
         (telegram_id, username, unique_id, balance, is_blocked, 
          blocked_reason, blocked_at, is_admin_user, blocked_time) = user_data
         
-        # Get user's purchase history
-        cursor.execute('''SELECT COUNT(*), SUM(amount) 
-                          FROM transactions 
-                          WHERE user_id = (SELECT user_id FROM users WHERE telegram_id = ?)
-                          AND status = 'approved' ''', (target_user_id,))
-        
-        purchase_data = cursor.fetchone()
-        total_purchases = purchase_data[0] or 0
-        total_spent = purchase_data[1] or 0
-        
-        # Get user's keys
-        cursor.execute('''SELECT COUNT(*) 
-                          FROM user_keys 
-                          WHERE user_id = (SELECT user_id FROM users WHERE telegram_id = ?)''', 
-                       (target_user_id,))
-        
-        keys_count = cursor.fetchone()[0] or 0
-        
-        conn.close()
+        # Get user's purchase history and keys
+        total_purchases, total_spent, keys_count = totals
         
         text = f"""📋 USER INFORMATION
 
@@ -2020,12 +3877,11 @@ async def setup_upi(update: Update, context: ContextTypes.DEFAULT_TYPE):
         new_upi = parts[1].strip()
         
         # Update UPI number
-        if 'upi' in PAYMENT_METHODS:
-            old_upi = PAYMENT_METHODS['upi'].get('number', 'N/A')
-            PAYMENT_METHODS['upi']['number'] = new_upi
+        previous = await run_db(runtime_settings.update, {'upi_number': new_upi})
+        old_upi = previous['upi_number']
         
         # Log admin action
-        log_admin_action(admin_id, 'change_upi', 0, f"UPI: {old_upi} → {new_upi}")
+        await run_db(log_admin_action, admin_id, 'change_upi', 0, f"UPI: {old_upi} → {new_upi}")
         
         await update.message.reply_text(
             f"""✅ UPI Updated Successfully!
@@ -2037,7 +3893,7 @@ async def setup_upi(update: Update, context: ContextTypes.DEFAULT_TYPE):
 ✅ UPI number has been updated for all users."""
         )
         
-        logger.info(f"Admin {admin_id} changed UPI: {old_upi} → {new_upi}")
+        logger.info("Admin %s changed UPI: %s → %s", admin_id, old_upi, new_upi)
         
     except Exception as e:
         logger.error(f"Error in setup_upi: {e}")
@@ -2084,16 +3940,14 @@ async def handle_qr_code_setup(update: Update, context: ContextTypes.DEFAULT_TYP
         photo = update.message.photo[-1]
         file_id = photo.file_id
         
-        # Update QR code in PAYMENT_METHODS
-        if 'upi' in PAYMENT_METHODS:
-            old_qr = PAYMENT_METHODS['upi'].get('qr_code', 'None')
-            PAYMENT_METHODS['upi']['qr_code'] = file_id
+        # Update QR code
+        await run_db(runtime_settings.update, {'upi_qr_code': file_id})
         
         # Clear the flag
         context.user_data.pop('awaiting_qr_code', None)
         
         # Log admin action
-        log_admin_action(admin_id, 'change_qr', 0, "UPI QR code updated")
+        await run_db(log_admin_action, admin_id, 'change_qr', 0, "UPI QR code updated")
         
         await update.message.reply_text(
             f"""✅ QR Code Updated Successfully!
@@ -2104,7 +3958,7 @@ async def handle_qr_code_setup(update: Update, context: ContextTypes.DEFAULT_TYP
 ✅ QR code is now available for users."""
         )
         
-        logger.info(f"Admin {admin_id} updated UPI QR code")
+        logger.info("Admin %s updated UPI QR code", admin_id)
         
     except Exception as e:
         logger.error(f"Error in handle_qr_code_setup: {e}")
@@ -2131,39 +3985,25 @@ async def add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Invalid user ID!")
             return
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
         # Check if user exists
-        cursor.execute('SELECT telegram_id, username FROM users WHERE telegram_id = ?', (new_admin_id,))
-        user_data = cursor.fetchone()
+        user_data = await run_db(get_admin_candidate, new_admin_id)
         
         if not user_data:
             await update.message.reply_text(f"❌ User with ID {new_admin_id} not found!")
-            conn.close()
             return
         
-        target_telegram_id, username = user_data
+        target_telegram_id, username, is_admin_user, target_db_id = user_data
         
         # Check if already admin
-        cursor.execute('SELECT is_admin FROM users WHERE telegram_id = ?', (new_admin_id,))
-        is_admin_user = cursor.fetchone()
-        
-        if is_admin_user and is_admin_user[0] == 1:
+        if is_admin_user == 1:
             await update.message.reply_text(f"❌ User @{username} is already an admin!")
-            conn.close()
             return
         
         # Make user admin
-        cursor.execute('UPDATE users SET is_admin = 1, added_by = ? WHERE telegram_id = ?',
-                       (admin_id, new_admin_id))
-        
-        conn.commit()
+        await run_db(set_user_admin, new_admin_id, admin_id)
         
         # Log admin action
-        cursor.execute('SELECT user_id FROM users WHERE telegram_id = ?', (new_admin_id,))
-        target_db_id = cursor.fetchone()[0]
-        log_admin_action(admin_id, 'add_admin', target_db_id, f"Added new admin: {username}")
+        await run_db(log_admin_action, admin_id, 'add_admin', target_db_id, f"Added new admin: {username}")
         
         # Notify new admin
         try:
@@ -2187,7 +4027,8 @@ You have been promoted to Admin in Atoplay Shop bot.
 
 ⚠️ Use your powers responsibly!
 
-📞 Contact Super Admin for assistance."""
+📞 Contact Super Admin for assistance.""",
+                rate_limit_args={'priority': SEND_PRIORITY_NOTIFICATION}
             )
         except Exception as e:
             logger.error(f"Failed to notify new admin {new_admin_id}: {e}")
@@ -2202,8 +4043,7 @@ You have been promoted to Admin in Atoplay Shop bot.
 ✅ New admin has been notified."""
         )
         
-        conn.close()
-        logger.info(f"Admin {new_admin_id} added by Super Admin {admin_id}")
+        logger.info("Admin %s added by Super Admin %s", new_admin_id, admin_id)
         
     except Exception as e:
         logger.error(f"Error in add_admin: {e}")
@@ -2235,35 +4075,24 @@ async def remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ You cannot remove yourself as admin!")
             return
         
-        conn = sqlite3.connect('atoplay_bot.db')
-        cursor = conn.cursor()
-        
         # Check if user exists and is admin
-        cursor.execute('SELECT telegram_id, username, is_admin FROM users WHERE telegram_id = ?', (target_admin_id,))
-        user_data = cursor.fetchone()
+        user_data = await run_db(get_admin_candidate, target_admin_id)
         
         if not user_data:
             await update.message.reply_text(f"❌ User with ID {target_admin_id} not found!")
-            conn.close()
             return
         
-        target_telegram_id, username, is_admin_user = user_data
+        target_telegram_id, username, is_admin_user, target_db_id = user_data
         
         if is_admin_user != 1:
             await update.message.reply_text(f"❌ User @{username} is not an admin!")
-            conn.close()
             return
         
         # Remove admin privileges
-        cursor.execute('UPDATE users SET is_admin = 0, added_by = NULL WHERE telegram_id = ?',
-                       (target_admin_id,))
-        
-        conn.commit()
+        await run_db(set_user_admin, target_admin_id)
         
         # Log admin action
-        cursor.execute('SELECT user_id FROM users WHERE telegram_id = ?', (target_admin_id,))
-        target_db_id = cursor.fetchone()[0]
-        log_admin_action(admin_id, 'remove_admin', target_db_id, f"Removed admin: {username}")
+        await run_db(log_admin_action, admin_id, 'remove_admin', target_db_id, f"Removed admin: {username}")
         
         # Notify removed admin
         try:
@@ -2279,7 +4108,8 @@ Your admin privileges have been removed from Atoplay Shop bot.
 
 ⚠️ You no longer have access to admin commands.
 
-📞 Contact Super Admin for more information."""
+📞 Contact Super Admin for more information.""",
+                rate_limit_args={'priority': SEND_PRIORITY_NOTIFICATION}
             )
         except Exception as e:
             logger.error(f"Failed to notify removed admin {target_admin_id}: {e}")
@@ -2294,12 +4124,102 @@ Your admin privileges have been removed from Atoplay Shop bot.
 ✅ Admin has been notified."""
         )
         
-        conn.close()
-        logger.info(f"Admin {target_admin_id} removed by Super Admin {admin_id}")
+        logger.info("Admin %s removed by Super Admin %s", target_admin_id, admin_id)
         
     except Exception as e:
         logger.error(f"Error in remove_admin: {e}")
 
+def format_latency(seconds):
+    return "∞" if seconds == float('inf') else f"{seconds * 1000:g} ms"
+
+def format_histograms(histograms):
+    """'• name: calls, errors, avg, p95' for the METRICS_TOP busiest (by total time)"""
+    busiest = sorted((item for item in histograms.items() if item[1].count),
+                     key=lambda item: item[1].total, reverse=True)[:METRICS_TOP]
+    return "\n".join(
+        f"• {name}: {histogram.count} calls, {histogram.errors} errors, "
+        f"avg {histogram.total / histogram.count * 1000:.1f} ms, "
+        f"p95 ≤ {format_latency(histogram.quantile(0.95))}"
+        for name, histogram in busiest
+    ) or "• No calls yet"
+
+async def show_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show handler and DB call latency plus internal counters"""
+    admin_id = update.effective_user.id
+    
+    if not is_admin(admin_id):
+        await update.message.reply_text("❌ Unauthorized!")
+        return
+    
+    outbound_stats = outbound.metrics()
+    uptime = time.perf_counter() - STARTUP_STARTED
+    startup = ", ".join(f"{phase} {seconds * 1000:.0f} ms" for phase, seconds in startup_timings.items())
+    
+    text = f"""📈 METRICS (uptime {uptime / 60:.0f} min)
+
+⏱️ Handlers (busiest first):
+{format_histograms(instrumentation.handlers)}
+
+🗄️ DB Calls (busiest first):
+{format_histograms(instrumentation.db)}
+
+📤 Outbound: {outbound_stats['queue_depth']} queued, {outbound_stats['sent']} sent, avg wait {outbound_stats['avg_wait_ms']:.1f} ms, {outbound_stats['retry_after']} RetryAfter
+🛒 Buy menu renders: {buy_menu.renders}
+👑 Admin cache: {admin_cache.hits} hits, {admin_cache.misses} misses
+🚀 Startup: {startup or 'N/A'}"""
+    
+    await update.message.reply_text(text)
+
+def render_prometheus_metrics():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    
+    for family, label, histograms in (('atoplay_handler', 'handler', instrumentation.handlers),
+                                      ('atoplay_db_call', 'call', instrumentation.db)):
+        items = sorted(histograms.items())
+        lines.append(f"# TYPE {family}_seconds histogram")
+        for name, histogram in items:
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + (float('inf'),), histogram.buckets):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else f'{bound:g}'
+                lines.append(f'{family}_seconds_bucket{{{label}="{name}",le="{le}"}} {cumulative}')
+            lines.append(f'{family}_seconds_sum{{{label}="{name}"}} {histogram.total}')
+            lines.append(f'{family}_seconds_count{{{label}="{name}"}} {histogram.count}')
+        lines.append(f"# TYPE {family}_errors_total counter")
+        for name, histogram in items:
+            lines.append(f'{family}_errors_total{{{label}="{name}"}} {histogram.errors}')
+    
+    outbound_stats = outbound.metrics()
+    for metric, kind, value in (('atoplay_outbound_queue_depth', 'gauge', outbound_stats['queue_depth']),
+                                ('atoplay_outbound_sent_total', 'counter', outbound_stats['sent']),
+                                ('atoplay_outbound_retry_after_total', 'counter', outbound_stats['retry_after']),
+                                ('atoplay_buy_menu_renders_total', 'counter', buy_menu.renders),
+                                ('atoplay_admin_cache_hits_total', 'counter', admin_cache.hits),
+                                ('atoplay_admin_cache_misses_total', 'counter', admin_cache.misses)):
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.append(f"{metric} {value}")
+    
+    lines.append("# TYPE atoplay_stock_available gauge")
+    for key_type, available in sorted(get_stock_info().items()):
+        lines.append(f'atoplay_stock_available{{key_type="{key_type}"}} {available}')
+    
+    return "\n".join(lines) + "\n"
+
+async def serve_metrics(reader, writer):
+    """Answer one HTTP request on the localhost metrics port"""
+    try:
+        await reader.readuntil(b'\r\n\r\n')
+        body = render_prometheus_metrics().encode()
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                     b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
 async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """List all admins"""
     try:
@@ -2323,96 +4243,442 @@ async def list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text += "\n\n🛠️ Super Admin Commands:"
             text += "\n• /addadmin USER_ID - Add new admin"
             text += "\n• /removeadmin USER_ID - Remove admin"
+            text += "\n• /broadcast MESSAGE - Message all users"
+            text += "\n• /cancelbroadcast - Stop a running broadcast"
         
         await update.message.reply_text(text)
         
     except Exception as e:
         logger.error(f"Error in list_admins: {e}")
 
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Log errors"""
-    logger.error(f"Update {update} caused error {context.error}")
+async def mark_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record when the first update of any kind reached the handlers"""
+    mark_startup('first update')
 
-def main():
-    # First delete old database and create new one
-    init_db()
-    add_sample_keys()
+async def restore_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Load a user's saved conversation state before their first update is handled"""
+    user_id = update.effective_user.id if update.effective_user else None
+    chat_id = update.effective_chat.id if update.effective_chat else None
     
-    print("=" * 50)
-    print("🤖 Bot starting...")
-    print(f"📱 Token: {TOKEN[:10]}...")
-    print("=" * 50)
+    if conversation_state.needs_load(user_id, chat_id):
+        stored = await run_db(get_conversation_state, user_id, chat_id)
+        conversation_state.attach('user', user_id, context.user_data, stored.get('user'))
+        conversation_state.attach('chat', chat_id, context.chat_data, stored.get('chat'))
+
+async def track_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Queue the state this update may have changed for the next flush"""
+    conversation_state.touch(update.effective_user.id if update.effective_user else None,
+                             update.effective_chat.id if update.effective_chat else None)
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Handle up to UPDATE_CONCURRENCY updates at once, in order per user.
     
-    try:
-        # Create application with build method
-        application = Application.builder().token(TOKEN).build()
+    The first update from a user runs normally; updates from the same user
+    that arrive while it runs are queued behind it and run by the same
+    task, in arrival order. A double tapped button therefore sees the
+    state left by the first tap, other users are not held up, and one busy
+    user never occupies more than one slot.
+    """
+    
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._backlogs = {}  # user_id -> deque of queued update coroutines
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            await coroutine
+            return
         
-        # Add error handler
-        application.add_error_handler(error_handler)
+        backlog = self._backlogs.get(user.id)
+        if backlog is not None:
+            backlog.append(coroutine)
+            return
         
-        # Basic command handlers
-        application.add_handler(CommandHandler('start', start))
-        application.add_handler(CommandHandler('buy', buy))
-        application.add_handler(CommandHandler('balance', check_balance))
-        application.add_handler(CommandHandler('mykeys', my_keys))
-        application.add_handler(CommandHandler('admin', admin_panel))
-        application.add_handler(CommandHandler('stats', show_stats))
-        application.add_handler(CommandHandler('stock', show_stock))
-        application.add_handler(CommandHandler('listadmins', list_admins))
+        backlog = self._backlogs[user.id] = collections.deque()
+        try:
+            while True:
+                try:
+                    await coroutine
+                except Exception as e:
+                    logger.error(f"Error processing update from user {user.id}: {e}")
+                if not backlog:
+                    break
+                coroutine = backlog.popleft()
+        finally:
+            del self._backlogs[user.id]
+            for pending in backlog:
+                pending.close()
+
+# Running broadcasts. They are plain tasks rather than Application.create_task
+# ones so stopping the bot cancels them instead of waiting for them to finish;
+# the job stays 'running' in broadcast_jobs and resumes on the next start.
+broadcast_tasks = set()
+
+def start_broadcast(bot, job_id):
+    task = asyncio.create_task(run_broadcast(bot, job_id))
+    broadcast_tasks.add(task)
+    task.add_done_callback(broadcast_tasks.discard)
+
+def format_broadcast_status(job_id, status, total_users, sent, blocked, failed):
+    status_names = {'running': '⏳ Running', 'done': '✅ Done', 'cancelled': '🛑 Cancelled'}
+    return f"""📢 Broadcast #{job_id}
+
+📊 Status: {status_names.get(status, status)}
+👥 Progress: {sent + blocked + failed}/{total_users}
+✅ Sent: {sent}
+🚫 Blocked Bot: {blocked}
+❌ Failed: {failed}"""
+
+async def run_broadcast(bot, job_id):
+    """Send a broadcast job to every reachable user, resuming from its cursor.
+
+    Users are read in keyset batches of BROADCAST_BATCH_SIZE and sent to by
+    BROADCAST_CONCURRENCY workers paced at BROADCAST_RATE, at the lowest
+    send priority. Progress is saved and the status message edited after
+    each batch, so a restart repeats at most one batch.
+    """
+    job = await run_db(get_broadcast_job, job_id)
+    if not job:
+        return
+    (message, status, last_user_id, total_users, sent, blocked, failed,
+     status_chat_id, status_message_id) = job
+    
+    loop = asyncio.get_running_loop()
+    pacer = TokenBucket(BROADCAST_RATE, 1, loop.time())
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    
+    async def deliver(telegram_id):
+        async with semaphore:
+            while True:
+                delay = pacer.wait_time(loop.time())
+                if not delay:
+                    break
+                await asyncio.sleep(delay)
+            pacer.take(loop.time())
+            
+            try:
+                await send_with_retry(lambda: bot.send_message(chat_id=telegram_id, text=message))
+                return 'sent'
+            except Forbidden:
+                return 'blocked'
+            except Exception as e:
+                logger.warning("Broadcast #%s failed for %s: %s", job_id, telegram_id, e)
+                return 'failed'
+    
+    async def update_status():
+        try:
+            await bot.edit_message_text(
+                chat_id=status_chat_id,
+                message_id=status_message_id,
+                text=format_broadcast_status(job_id, status, total_users, sent, blocked, failed),
+                rate_limit_args={'priority': SEND_PRIORITY_NOTIFICATION}
+            )
+        except Exception as e:
+            logger.error(f"Error editing broadcast status: {e}")
+    
+    logger.info("Broadcast #%s running from user #%s", job_id, last_user_id)
+    
+    try:
+        with sending_priority(SEND_PRIORITY_BULK):
+            while status == 'running':
+                batch = await run_db(get_broadcast_batch, last_user_id)
+                if not batch:
+                    await run_db(finish_broadcast_job, job_id)
+                    status = 'done'
+                    break
+                
+                results = await asyncio.gather(*(deliver(telegram_id) for _, telegram_id in batch))
+                blocked_ids = [telegram_id for (_, telegram_id), result in zip(batch, results) if result == 'blocked']
+                batch_sent = results.count('sent')
+                batch_failed = results.count('failed')
+                
+                last_user_id = batch[-1][0]
+                status = await run_db(save_broadcast_progress, job_id, last_user_id,
+                                      batch_sent, len(blocked_ids), batch_failed, blocked_ids)
+                sent += batch_sent
+                blocked += len(blocked_ids)
+                failed += batch_failed
+                
+                if status == 'running':
+                    await update_status()
         
-        # Admin command handlers for adding keys
-        application.add_handler(CommandHandler('addkey_3d', handle_add_key))
-        application.add_handler(CommandHandler('addkey_10d', handle_add_key))
-        application.add_handler(CommandHandler('addkey_30d', handle_add_key))
+        await update_status()
+        logger.info("Broadcast #%s %s: %s sent, %s blocked, %s failed", job_id, status, sent, blocked, failed)
         
-        # Admin command handlers for deleting keys
-        application.add_handler(CommandHandler('delkey', handle_delete_key))
+    except asyncio.CancelledError:
+        logger.info("Broadcast #%s paused at user #%s", job_id, last_user_id)
+        raise
+    except Exception as e:
+        logger.error(f"Error in broadcast #{job_id}: {e}")
+
+async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send a message to every user (Super Admin only)"""
+    try:
+        admin_id = update.effective_user.id
         
-        # Admin command handlers for price changes
-        application.add_handler(CommandHandler('price_3d', handle_price_change))
-        application.add_handler(CommandHandler('price_10d', handle_price_change))
-        application.add_handler(CommandHandler('price_30d', handle_price_change))
+        if not is_super_admin(admin_id):
+            await update.message.reply_text("❌ Unauthorized! Only Super Admin can broadcast.")
+            return
         
-        # Admin user management commands
-        application.add_handler(CommandHandler('block', block_user))
-        application.add_handler(CommandHandler('unblock', unblock_user))
-        application.add_handler(CommandHandler('userinfo', user_info))
+        # Take the raw text so line breaks in the message are kept
+        parts = update.message.text.split(None, 1)
+        if len(parts) < 2:
+            await update.message.reply_text("""📢 Broadcast a message to all users
+
+Usage: /broadcast MESSAGE
+
+Blocked users and users who blocked the bot are skipped.
+Use /cancelbroadcast to stop a running broadcast.""")
+            return
         
-        # Admin payment methods commands
-        application.add_handler(CommandHandler('setupi', setup_upi))
-        application.add_handler(CommandHandler('setqr', set_qr_code))
+        running = await run_db(get_running_broadcast_ids)
+        if running:
+            await update.message.reply_text(f"⚠️ Broadcast #{running[0]} is still running! Use /cancelbroadcast to stop it.")
+            return
         
-        # Super Admin commands
-        application.add_handler(CommandHandler('addadmin', add_admin))
-        application.add_handler(CommandHandler('removeadmin', remove_admin))
+        status_message = await update.message.reply_text("📢 Broadcast starting...")
+        job_id = await run_db(create_broadcast_job, admin_id, parts[1],
+                              status_message.chat_id, status_message.message_id)
+        await run_db(log_admin_action, admin_id, 'broadcast', 0, f"Broadcast #{job_id}")
         
-        # Admin payment approval handlers
-        application.add_handler(MessageHandler(filters.Regex(r'^/approve_\d+$'), approve_payment))
-        application.add_handler(MessageHandler(filters.Regex(r'^/reject_\d+$'), reject_payment))
+        start_broadcast(context.bot, job_id)
+        logger.info("Broadcast #%s started by Super Admin %s", job_id, admin_id)
         
-        # Handle block/unblock via user info
-        application.add_handler(MessageHandler(filters.Regex(r'^/block_\d+'), block_user))
-        application.add_handler(MessageHandler(filters.Regex(r'^/unblock_\d+'), unblock_user))
+    except Exception as e:
+        logger.error(f"Error in broadcast: {e}")
+
+async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Stop running broadcasts after their current batch (Super Admin only)"""
+    try:
+        admin_id = update.effective_user.id
         
-        # Handle text messages for ALL users (including admin menu buttons)
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+        if not is_super_admin(admin_id):
+            await update.message.reply_text("❌ Unauthorized! Only Super Admin can cancel broadcasts.")
+            return
         
-        # SINGLE callback query handler for ALL callbacks
-        application.add_handler(CallbackQueryHandler(callback_handler))
+        job_ids = await run_db(cancel_broadcast_jobs)
+        if not job_ids:
+            await update.message.reply_text("ℹ️ No broadcast is running.")
+            return
         
-        # Photo handler for payment screenshots and QR codes
-        application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+        for job_id in job_ids:
+            await run_db(log_admin_action, admin_id, 'cancel_broadcast', 0, f"Broadcast #{job_id}")
         
-        print("✅ All handlers registered successfully!")
-        print("⏳ Starting polling...")
+        await update.message.reply_text(f"🛑 Broadcast #{', #'.join(map(str, job_ids))} cancelled!")
+        logger.info("Broadcasts %s cancelled by Super Admin %s", job_ids, admin_id)
         
-        # Start polling with simple parameters
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    except Exception as e:
+        logger.error(f"Error in cancel_broadcast: {e}")
+
+def mark_startup(phase):
+    """Record and log how long startup took to reach ``phase`` (first call only)"""
+    if phase not in startup_timings:
+        startup_timings[phase] = time.perf_counter() - STARTUP_STARTED
+        logger.info("Startup: %s after %.0f ms", phase, startup_timings[phase] * 1000)
+
+async def post_init(application):
+    """Start background work once the bot is initialized"""
+    mark_startup('bot initialized')
+    conversation_state.start()
+    
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await asyncio.start_server(serve_metrics, '127.0.0.1', METRICS_PORT)
+        logger.info("Serving Prometheus metrics on 127.0.0.1:%s", METRICS_PORT)
+    
+    # Count stock before polling starts: a sale or /addkey committed while
+    # the count runs would otherwise be lost or counted twice
+    await run_db(stock_counters.rebuild)
+    
+    # Restart broadcasts that were running when the bot stopped
+    for job_id in await run_db(get_running_broadcast_ids):
+        start_broadcast(application.bot, job_id)
+
+async def post_stop(application):
+    """Stop background work and save what it has pending"""
+    # Broadcast progress is saved per batch, so they can just be cancelled
+    for task in list(broadcast_tasks):
+        task.cancel()
+    await asyncio.gather(*broadcast_tasks, return_exceptions=True)
+    
+    await conversation_state.stop()
+    
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+
+def instrument_handlers(application):
+    """Time every registered handler and every callback/menu/text route"""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrumentation.wrap_handler(handler.callback)
+    
+    for routes in (CALLBACK_ROUTES, MENU_BUTTON_ROUTES, TEXT_INPUT_ROUTES):
+        for key, callback in routes.items():
+            routes[key] = instrumentation.wrap_handler(callback)
+
+async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Log errors"""
+    logger.error(f"Update {update} caused error {context.error}")
+
+# callback_data -> handler. Keys ending in ':' or '_' match every
+# callback_data with that prefix ('stock:...', 'payment_upi').
+CALLBACK_ROUTES = {
+    'cancel': cancel_callback,
+    'add_balance': add_balance_callback,
+    'use_balance': process_balance_purchase,
+    'new_payment': new_payment_callback,
+    'product_': product_callback,
+    'payment_': payment_callback,
+    'amount_': amount_callback,
+    'stock:': handle_stock_callback,
+    'mykeys:': handle_my_keys_callback
+}
+
+# Reply keyboard button label -> handler
+MENU_BUTTON_ROUTES = {
+    "🛒 Buy Keys": buy,
+    "💳 Check Balance": check_balance,
+    "🔑 My Keys": my_keys,
+    "🔧 Admin Panel": admin_panel,
+    "📞 Contact": show_contact,
+    "📢 Channel": show_channel
+}
+
+# user_data flag -> handler for the free text the bot is waiting for
+TEXT_INPUT_ROUTES = {
+    'awaiting_amount': handle_amount_input,
+    'awaiting_reject_reason': handle_reject_reason
+}
+
+def build_application(builder, update_processor=None):
+    """Finish ``builder`` and register every handler; shared by main() and bench_bot.py"""
+    application = (
+        builder
+        .concurrent_updates(update_processor or PerUserUpdateProcessor(UPDATE_CONCURRENCY))
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
+    
+    # Add error handler
+    application.add_error_handler(error_handler)
+    
+    # Time the first update, restore saved conversation state before
+    # handlers run and track it after
+    application.add_handler(TypeHandler(Update, mark_first_update), group=-2)
+    application.add_handler(TypeHandler(Update, restore_conversation), group=-1)
+    application.add_handler(TypeHandler(Update, track_conversation), group=1)
+    
+    # Basic command handlers
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('buy', buy))
+    application.add_handler(CommandHandler('balance', check_balance))
+    application.add_handler(CommandHandler('mykeys', my_keys))
+    application.add_handler(CommandHandler('admin', admin_panel))
+    application.add_handler(CommandHandler('stats', show_stats))
+    application.add_handler(CommandHandler('rebuildstats', rebuild_stats))
+    application.add_handler(CommandHandler('stock', show_stock))
+    application.add_handler(CommandHandler('listadmins', list_admins))
+    application.add_handler(CommandHandler('metrics', show_metrics))
+    
+    # Admin command handlers for adding keys (/addkey_<type> for any catalog product)
+    application.add_handler(MessageHandler(filters.Regex(r'^/addkey_\w+'), handle_add_key))
+    
+    # Bulk key import from uploaded .txt/.csv files
+    application.add_handler(MessageHandler(filters.Document.ALL & filters.CaptionRegex(r'^/addkey_'), handle_key_file))
+    
+    # Admin command handlers for deleting keys
+    application.add_handler(CommandHandler('delkey', handle_delete_key))
+    
+    # Admin command handlers for price changes (/price_<type>)
+    application.add_handler(MessageHandler(filters.Regex(r'^/price_\w+'), handle_price_change))
+    
+    # Admin product catalog commands
+    application.add_handler(CommandHandler('addproduct', add_product))
+    application.add_handler(CommandHandler('removeproduct', remove_product))
+    
+    # Admin user management commands
+    application.add_handler(CommandHandler('block', block_user))
+    application.add_handler(CommandHandler('unblock', unblock_user))
+    application.add_handler(CommandHandler('userinfo', user_info))
+    
+    # Admin payment methods commands
+    application.add_handler(CommandHandler('setupi', setup_upi))
+    application.add_handler(CommandHandler('setqr', set_qr_code))
+    
+    # Super Admin commands
+    application.add_handler(CommandHandler('addadmin', add_admin))
+    application.add_handler(CommandHandler('removeadmin', remove_admin))
+    application.add_handler(CommandHandler('broadcast', broadcast))
+    application.add_handler(CommandHandler('cancelbroadcast', cancel_broadcast))
+    
+    # Admin payment approval handlers
+    application.add_handler(MessageHandler(filters.Regex(r'^/approve_\d+$'), approve_payment))
+    application.add_handler(MessageHandler(filters.Regex(r'^/reject_\d+$'), reject_payment))
+    
+    # Handle block/unblock via user info
+    application.add_handler(MessageHandler(filters.Regex(r'^/block_\d+'), block_user))
+    application.add_handler(MessageHandler(filters.Regex(r'^/unblock_\d+'), unblock_user))
+    
+    # Handle text messages for ALL users (including admin menu buttons)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+    
+    # SINGLE callback query handler for ALL callbacks
+    application.add_handler(CallbackQueryHandler(callback_handler))
+    
+    # Photo handler for payment screenshots and QR codes
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    
+    instrument_handlers(application)
+    return application
+
+def main():
+    # Schema check (a single read once migrated) and the in-memory snapshots
+    migrate_db()
+    runtime_settings.load()
+    admin_cache.load()
+    if not admin_cache.items():
+        logger.warning("No admins in the database. Run `python 1atoplay-telegram-bot.py seed` once.")
+    mark_startup('database ready')
+    
+    try:
+        # Create application with build method
+        application = build_application(Application.builder().token(TOKEN).rate_limiter(outbound))
+        mark_startup('handlers registered')
+        
+        if WEBHOOK_URL:
+            # Embedded HTTP server; PTB rejects requests without the secret token
+            logger.info("Starting webhook on %s:%s/%s (token %s...)", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, TOKEN[:10])
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=ALLOWED_UPDATES
+            )
+        else:
+            logger.info("Starting polling (token %s...)", TOKEN[:10])
+            application.run_polling(allowed_updates=ALLOWED_UPDATES)
         
     except Exception as e:
         print(f"❌ CRITICAL ERROR: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        db_executor.shutdown(wait=True)
+        db_pool.close_all()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if sys.argv[1:] == ['seed']:
+        seed_db()
+    else:
+        main()
\ No newline at end of file
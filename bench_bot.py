@@ -0,0 +1,880 @@
+"""Load test and invariant checks for 1atoplay-telegram-bot.py.
+
+`python bench_bot.py` drives the bot's handlers with simulated users on a
+temporary database and compares the latencies with a saved baseline;
+`python bench_bot.py CHECK` runs one of BENCH_CHECKS instead. The Bot API
+is answered locally by RecordingRequest, so no token or network is needed.
+"""
+import argparse
+import asyncio
+import collections
+import importlib.util
+import io
+import itertools
+import json
+import os
+import re
+import signal
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, redirect_stdout
+import httpx
+from telegram import Update
+from telegram.ext import Application, ContextTypes, SimpleUpdateProcessor
+from telegram.request import BaseRequest
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '1atoplay-telegram-bot.py')
+
+def load_bot():
+    """Import the bot script as a module (its file name is not importable)"""
+    spec = importlib.util.spec_from_file_location('atoplay_bot', BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+bot = load_bot()
+
+# Simulated users, and how much slower than the baseline still passes
+BENCH_USERS = 1000
+BENCH_CONCURRENCY = 64
+BENCH_TOLERANCE = 0.3
+BENCH_BASELINE_PATH = 'bench_baseline.json'
+BENCH_KEY_TYPE = '3d'
+BENCH_FIRST_USER_ID = 10**9
+BENCH_TOKEN = '123456:bench'
+
+# `purchases` check: purchases fired at once by each user who can afford one key
+BENCH_PURCHASE_ATTEMPTS = 5
+
+# `loop` check: event loop lag while /rebuildstats scans this many transactions
+BENCH_REPORT_TRANSACTIONS = 300000
+BENCH_REPORT_RUNS = 5
+BENCH_LOOP_INTERVAL = 0.001
+BENCH_LOOP_MAX_LAG = 0.005  # allowed p99 lag on top of the idle loop's
+
+# `conversation` check: purchase-flow rounds per user, and the allowed
+# per-update cost of restoring and tracking conversation state
+BENCH_CONVERSATION_ROUNDS = 5
+BENCH_CONVERSATION_MAX_COST = 0.00002
+
+# `webhook` check: longest wait for the reply to one update
+BENCH_REPLY_TIMEOUT = 5
+
+# `concurrency` check: simulated users active at once in each throughput run,
+# /balance updates each, simulated Bot API round trip, and the speedup over
+# one-at-a-time processing required from 8 users up
+BENCH_CONCURRENCY_LEVELS = (1, 8, 64)
+BENCH_UPDATES_PER_USER = 5
+BENCH_API_LATENCY = 0.01
+BENCH_MIN_SPEEDUP = 2
+
+# `startup` check: bot processes started per case, and the longest allowed
+# median from process launch to the reply to the first polled update
+BENCH_STARTUP_RUNS = 3
+BENCH_STARTUP_TARGET = 2.0
+STARTUP_REPORT_PREFIX = 'STARTUP '
+
+class RecordingRequest(BaseRequest):
+    """Bot API stand-in for the benchmark: answers every call locally, no network.
+    
+    Sent and edited texts (and captions) are kept per chat in ``texts``, and
+    an event put in ``replied[chat_id]`` is set on the next one. getUpdates
+    long-polls the updates passed to feed(). Every call takes ``latency``
+    seconds, like a round trip to the Bot API.
+    """
+    
+    def __init__(self):
+        self.texts = collections.defaultdict(list)
+        self.calls = collections.Counter()
+        self.parameters = {}  # endpoint -> parameters of its last call
+        self.replied = {}
+        self._updates = collections.deque()
+        self._updates_ready = None
+        self._message_ids = itertools.count(1)
+        self.latency = 0
+    
+    def feed(self, update):
+        self._updates.append(update)
+        if self._updates_ready is not None:
+            self._updates_ready.set()
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        parameters = request_data.parameters if request_data else {}
+        self.calls[endpoint] += 1
+        self.parameters[endpoint] = parameters
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        
+        if endpoint == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif endpoint == 'getUpdates':
+            if not self._updates:
+                self._updates_ready = asyncio.Event()
+                try:
+                    await asyncio.wait_for(self._updates_ready.wait(), parameters.get('timeout') or 0)
+                except asyncio.TimeoutError:
+                    pass
+            result = [self._updates.popleft() for _ in range(len(self._updates))]
+        elif endpoint == 'copyMessage':
+            result = {'message_id': next(self._message_ids)}
+        elif endpoint.startswith(('send', 'forward', 'edit')):
+            chat_id = parameters.get('chat_id', 0)
+            text = parameters.get('text') or parameters.get('caption') or ''
+            self.texts[chat_id].append(text)
+            if text and chat_id in self.replied:
+                self.replied.pop(chat_id).set()
+            result = {'message_id': next(self._message_ids), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+        else:
+            result = True
+        
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+def bench_message(update_id, user_id, text=None, photo=False):
+    """Raw Bot API update for a private message (a command, button text or photo)"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'bench{user_id}'}
+    }
+    if text:
+        message['text'] = text
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if photo:
+        message['photo'] = [{'file_id': f'photo{user_id}', 'file_unique_id': f'p{user_id}', 'width': 640, 'height': 480}]
+    return {'update_id': update_id, 'message': message}
+
+def bench_callback(update_id, user_id, data):
+    """Raw Bot API update for an inline button press"""
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'bench{user_id}'}
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'from': user,
+            'message': {'message_id': update_id, 'date': int(time.time()),
+                        'chat': {'id': user_id, 'type': 'private'}, 'from': user, 'text': 'menu'}
+        }
+    }
+
+async def run_concurrently(items, concurrency, work):
+    """Await ``work(item)`` for every item with at most ``concurrency`` in flight, in order"""
+    pending = iter(items)
+    
+    async def worker():
+        for item in pending:
+            await work(item)
+    
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+async def run_benchmark_load(users, concurrency):
+    """Drive the full application with simulated users; returns ({step: [seconds]}, elapsed seconds).
+    
+    Each user starts, opens /buy, tops up ₹1000 by UPI and sends a screenshot;
+    the super admin approves every payment in turn; then each user buys a
+    BENCH_KEY_TYPE key with the balance. ``concurrency`` users are active at once.
+    """
+    request = RecordingRequest()
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN)
+                                    .request(request).get_updates_request(RecordingRequest()))
+    latencies = collections.defaultdict(list)
+    update_ids = itertools.count(1)
+    user_ids = [BENCH_FIRST_USER_ID + i for i in range(users)]
+    product_id = bot.runtime_settings.current.products_by_type[BENCH_KEY_TYPE]['product_id']
+    
+    async def send(step, payload):
+        update = Update.de_json(payload, application.bot)
+        started = time.perf_counter()
+        await application.process_update(update)
+        latencies[step].append(time.perf_counter() - started)
+    
+    async def top_up(user_id):
+        await send('start', bench_message(next(update_ids), user_id, '/start'))
+        await send('buy', bench_message(next(update_ids), user_id, '/buy'))
+        await send('add_balance', bench_callback(next(update_ids), user_id, 'add_balance'))
+        await send('amount', bench_callback(next(update_ids), user_id, 'amount_1000'))
+        await send('payment_method', bench_callback(next(update_ids), user_id, 'payment_upi'))
+        await send('handle_photo', bench_message(next(update_ids), user_id, photo=True))
+    
+    async def purchase(user_id):
+        await send('product', bench_callback(next(update_ids), user_id, f'product_{product_id}'))
+        await send('process_balance_purchase', bench_callback(next(update_ids), user_id, 'use_balance'))
+    
+    async with application:
+        await application.start()
+        bot.conversation_state.start()
+        started = time.perf_counter()
+        
+        await run_concurrently(user_ids, concurrency, top_up)
+        
+        # One admin approves the payments one by one, as they would in the chat
+        for user_id in user_ids:
+            transaction_id = re.search(r'Transaction ID: #?(\d+)', "\n".join(request.texts[user_id])).group(1)
+            await send('approve_payment', bench_message(next(update_ids), bot.ADMIN_IDS[0], f'/approve_{transaction_id}'))
+        
+        await run_concurrently(user_ids, concurrency, purchase)
+        
+        elapsed = time.perf_counter() - started
+        await bot.conversation_state.stop()
+        await application.stop()
+    
+    return latencies, elapsed
+
+def summarize_benchmark(latencies, elapsed, users, concurrency):
+    """p50/p95/p99 in ms per step and overall, plus updates per second"""
+    def percentiles(values):
+        if len(values) < 2:
+            values = values * 2
+        cuts = statistics.quantiles(values, n=100, method='inclusive')
+        return {'count': len(values), 'p50_ms': cuts[49] * 1000, 'p95_ms': cuts[94] * 1000, 'p99_ms': cuts[98] * 1000}
+    
+    everything = [seconds for values in latencies.values() for seconds in values]
+    return {
+        'users': users,
+        'concurrency': concurrency,
+        'updates': len(everything),
+        'seconds': elapsed,
+        'updates_per_second': len(everything) / elapsed,
+        **{key: value for key, value in percentiles(everything).items() if key != 'count'},
+        'steps': {step: percentiles(values) for step, values in latencies.items()}
+    }
+
+def compare_benchmark(results, baseline, tolerance):
+    """Return a line per metric that is more than ``tolerance`` worse than the baseline"""
+    regressions = []
+    
+    slowest = baseline['updates_per_second'] * (1 - tolerance)
+    if results['updates_per_second'] < slowest:
+        regressions.append(f"updates/s {results['updates_per_second']:.0f} < {slowest:.0f} "
+                           f"(baseline {baseline['updates_per_second']:.0f})")
+    
+    for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+        limit = baseline[metric] * (1 + tolerance)
+        if results[metric] > limit:
+            regressions.append(f"{metric} {results[metric]:.2f} > {limit:.2f} (baseline {baseline[metric]:.2f})")
+    
+    return regressions
+
+def seed_bench_users(user_ids, balance):
+    """Create registered bench users that start with ``balance``"""
+    with bot.db_pool.transaction() as conn:
+        conn.executemany('''INSERT INTO users (telegram_id, username, unique_id, balance, is_blocked, is_admin, created_at)
+                            VALUES (?, ?, ?, ?, 0, 0, CURRENT_TIMESTAMP)''',
+                         [(user_id, f'bench{user_id}', f'B{user_id}', balance) for user_id in user_ids])
+
+def get_sales_ledger(key_type):
+    """Totals the purchases check reconciles: (min balance, total balance,
+    used keys, user_keys rows, distinct user_keys values, available keys)"""
+    with bot.db_pool.connection() as conn:
+        return conn.execute('''SELECT (SELECT MIN(balance) FROM users),
+                                     (SELECT SUM(balance) FROM users),
+                                     (SELECT COUNT(*) FROM keys_stock WHERE key_type = ? AND status = 'used'),
+                                     (SELECT COUNT(*) FROM user_keys),
+                                     (SELECT COUNT(DISTINCT key_value) FROM user_keys),
+                                     (SELECT COUNT(*) FROM keys_stock WHERE key_type = ? AND status = 'available')''',
+                            (key_type, key_type)).fetchone()
+
+async def bench_purchases(args):
+    """Concurrent balance purchases against a small stock.
+    
+    Every user can afford exactly one key and fires BENCH_PURCHASE_ATTEMPTS
+    purchases at once; there are keys for half of the users. Returns a line
+    per broken invariant: a key sold twice, a negative or wrongly debited
+    balance, or a sale lost from the stock counters.
+    """
+    price = bot.runtime_settings.current.products_by_type[BENCH_KEY_TYPE]['price']
+    user_ids = [BENCH_FIRST_USER_ID + i for i in range(args.users)]
+    seed_bench_users(user_ids, price + price // 2)
+    bot.bulk_add_keys(BENCH_KEY_TYPE, [f'BENCH-{i}' for i in range(max(args.users // 2, 1))], bot.ADMIN_IDS[0])
+    # Includes the sample keys from seed_db
+    stock = bot.stock_counters.snapshot()[BENCH_KEY_TYPE]
+    starting_balance = (price + price // 2) * args.users
+    
+    outcomes = collections.Counter()
+    sold = []
+    
+    async def attempt(user_id):
+        status, data = await bot.run_db(bot.purchase_with_balance, user_id, BENCH_KEY_TYPE, price)
+        outcomes[status] += 1
+        if status == 'ok':
+            sold.append(data[0])
+    
+    # A user's attempts are adjacent, so they are in flight at the same time
+    attempts = [user_id for user_id in user_ids for _ in range(BENCH_PURCHASE_ATTEMPTS)]
+    started = time.perf_counter()
+    await run_concurrently(attempts, args.concurrency, attempt)
+    elapsed = time.perf_counter() - started
+    
+    min_balance, total_balance, used, user_keys, distinct_keys, available = await bot.run_db(get_sales_ledger, BENCH_KEY_TYPE)
+    
+    print(f"🛒 {len(attempts)} purchases by {args.users} users, concurrency {args.concurrency}, "
+          f"{stock} keys: {len(attempts) / elapsed:.0f} purchases/s")
+    print("   " + ", ".join(f"{status} {count}" for status, count in sorted(outcomes.items())))
+    
+    failures = []
+    if len(set(sold)) != len(sold) or distinct_keys != user_keys:
+        failures.append(f"keys sold twice: {len(sold) - len(set(sold))} returned, "
+                        f"{user_keys - distinct_keys} in user_keys")
+    if min_balance < 0:
+        failures.append(f"negative balance: {min_balance}")
+    if outcomes['ok'] != stock or used != stock or user_keys != stock:
+        failures.append(f"{stock} keys, but {outcomes['ok']} sales, {used} used keys, {user_keys} user_keys rows")
+    if starting_balance - total_balance != outcomes['ok'] * price:
+        failures.append(f"debited ₹{starting_balance - total_balance} for {outcomes['ok']} sales at ₹{price}")
+    if bot.stock_counters.snapshot().get(BENCH_KEY_TYPE, 0) != available:
+        failures.append(f"stock counter {bot.stock_counters.snapshot().get(BENCH_KEY_TYPE, 0)} != {available} available")
+    return failures
+
+def seed_bench_transactions(count):
+    """Approved transactions spread over the last year, for the report checks"""
+    with bot.db_pool.transaction() as conn:
+        conn.executemany('''INSERT INTO transactions (user_id, amount, payment_method, status, admin_id, created_at)
+                            VALUES (?, 100, 'upi', 'approved', 0, DATETIME('now', ?))''',
+                         ((number % 1000 + 1, f'-{number % 365} days') for number in range(count)))
+
+async def sample_loop_lag(done):
+    """How late each BENCH_LOOP_INTERVAL sleep wakes up, until ``done()`` is true"""
+    lags = []
+    while not done():
+        started = time.perf_counter()
+        await asyncio.sleep(BENCH_LOOP_INTERVAL)
+        lags.append(time.perf_counter() - started - BENCH_LOOP_INTERVAL)
+    return lags
+
+async def bench_loop(args):
+    """Event loop lag while a heavy admin report runs.
+    
+    /rebuildstats over BENCH_REPORT_TRANSACTIONS rows is sent through the
+    application BENCH_REPORT_RUNS times while a ticker measures how late
+    the loop wakes up. Fails if its p99 lag grows by more than
+    BENCH_LOOP_MAX_LAG over an idle loop.
+    """
+    seed_bench_transactions(BENCH_REPORT_TRANSACTIONS)
+    
+    # What one report would block the loop for if it ran on it
+    started = time.perf_counter()
+    bot.rebuild_daily_stats()
+    report_seconds = time.perf_counter() - started
+    
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN)
+                                    .request(RecordingRequest()).get_updates_request(RecordingRequest()))
+    
+    async def run_reports():
+        for update_id in range(1, BENCH_REPORT_RUNS + 1):
+            update = Update.de_json(bench_message(update_id, bot.ADMIN_IDS[0], '/rebuildstats'), application.bot)
+            await application.process_update(update)
+    
+    async with application:
+        idle_until = time.perf_counter() + report_seconds * BENCH_REPORT_RUNS
+        idle = await sample_loop_lag(lambda: time.perf_counter() > idle_until)
+        reports = asyncio.ensure_future(run_reports())
+        busy = await sample_loop_lag(reports.done)
+        await reports
+    
+    idle_p99 = statistics.quantiles(idle, n=100, method='inclusive')[98]
+    busy_p99 = statistics.quantiles(busy, n=100, method='inclusive')[98]
+    print(f"⏱️ /rebuildstats over {BENCH_REPORT_TRANSACTIONS} transactions: {report_seconds * 1000:.0f} ms each, "
+          f"run {BENCH_REPORT_RUNS} times")
+    print(f"   loop lag p99: idle {idle_p99 * 1000:.2f} ms, during reports {busy_p99 * 1000:.2f} ms "
+          f"(max {max(busy) * 1000:.2f} ms)")
+    
+    if busy_p99 > idle_p99 + BENCH_LOOP_MAX_LAG:
+        return [f"loop lag p99 {busy_p99 * 1000:.2f} ms during reports, idle {idle_p99 * 1000:.2f} ms"]
+    return []
+
+async def bench_admins(args):
+    """Promotions and demotions take effect on the very next update.
+    
+    Each user sends /stock as a regular user, after the super admin's
+    /addadmin and after /removeadmin, all through the application. Fails
+    on any reply that does not match the role the user should have, or if
+    bot.admin_cache ends up different from the users table.
+    """
+    request = RecordingRequest()
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN)
+                                    .request(request).get_updates_request(RecordingRequest()))
+    user_ids = [BENCH_FIRST_USER_ID + i for i in range(args.users)]
+    update_ids = itertools.count(1)
+    failures = []
+    
+    async def send(user_id, text):
+        await application.process_update(Update.de_json(bench_message(next(update_ids), user_id, text), application.bot))
+    
+    async def expect_stock(user_id, allowed):
+        await send(user_id, '/stock')
+        reply = request.texts[user_id][-1]
+        if reply.startswith("📊 STOCK REPORT") != allowed:
+            failures.append(f"user {user_id} {'refused' if allowed else 'allowed'} /stock: {reply[:40]!r}")
+    
+    async def promote_and_demote(user_id):
+        await send(user_id, '/start')
+        await expect_stock(user_id, False)
+        await send(bot.ADMIN_IDS[0], f'/addadmin {user_id}')
+        await expect_stock(user_id, True)
+        await send(bot.ADMIN_IDS[0], f'/removeadmin {user_id}')
+        await expect_stock(user_id, False)
+    
+    async with application:
+        hits, misses = bot.admin_cache.hits, bot.admin_cache.misses
+        await run_concurrently(user_ids, args.concurrency, promote_and_demote)
+        hits, misses = bot.admin_cache.hits - hits, bot.admin_cache.misses - misses
+    
+    cached = sorted(bot.admin_cache.items())
+    bot.admin_cache.load()
+    if sorted(bot.admin_cache.items()) != cached:
+        failures.append(f"admin_cache has {len(cached)} admins, the users table {len(bot.admin_cache.items())}")
+    
+    started = time.perf_counter()
+    for user_id in user_ids * 100:
+        bot.is_admin(user_id)
+    lookup_seconds = (time.perf_counter() - started) / (len(user_ids) * 100)
+    
+    print(f"👮 {len(user_ids)} users promoted and demoted, concurrency {args.concurrency}: "
+          f"{hits} role check hits, {misses} misses")
+    print(f"   is_admin: {lookup_seconds * 1e9:.0f} ns per lookup")
+    return failures
+
+async def bench_conversation(args):
+    """Per-update cost and durability of the write-behind conversation state.
+    
+    Users walk the add-balance flow BENCH_CONVERSATION_ROUNDS times through
+    the application with the flush task running, stopping halfway through
+    the last round. Then restore_conversation + track_conversation are
+    timed on their own for users already loaded. Fails if that costs more
+    than BENCH_CONVERSATION_MAX_COST per update, if state was loaded more
+    than once per user, or if the stored state differs from user_data.
+    """
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN)
+                                    .request(RecordingRequest()).get_updates_request(RecordingRequest()))
+    user_ids = [BENCH_FIRST_USER_ID + i for i in range(args.users)]
+    update_ids = itertools.count(1)
+    loads = bot.instrumentation.db['get_conversation_state']
+    loads_before = loads.count
+    
+    async def send(payload):
+        await application.process_update(Update.de_json(payload, application.bot))
+    
+    async def walk_flow(user_id):
+        await send(bench_message(next(update_ids), user_id, '/start'))
+        for _ in range(BENCH_CONVERSATION_ROUNDS - 1):
+            for data in ('add_balance', 'amount_1000', 'payment_upi', 'cancel'):
+                await send(bench_callback(next(update_ids), user_id, data))
+        for data in ('add_balance', 'amount_1000', 'payment_upi'):
+            await send(bench_callback(next(update_ids), user_id, data))
+    
+    async with application:
+        bot.conversation_state.start()
+        await run_concurrently(user_ids, args.concurrency, walk_flow)
+        
+        # The hooks alone, as every later update of a loaded user runs them
+        updates = [Update.de_json(bench_callback(next(update_ids), user_id, 'noop'), application.bot)
+                   for user_id in user_ids]
+        contexts = [ContextTypes.DEFAULT_TYPE.from_update(update, application) for update in updates]
+        started = time.perf_counter()
+        for update, context in zip(updates * 10, contexts * 10):
+            await bot.restore_conversation(update, context)
+            await bot.track_conversation(update, context)
+        per_update = (time.perf_counter() - started) / (len(updates) * 10)
+        
+        started = time.perf_counter()
+        await bot.conversation_state.stop()
+        flush_seconds = time.perf_counter() - started
+    
+    failures = []
+    loaded = loads.count - loads_before
+    if loaded != len(user_ids):
+        failures.append(f"conversation state loaded {loaded} times for {len(user_ids)} users")
+    for user_id in user_ids:
+        stored = (await bot.run_db(bot.get_conversation_state, user_id, user_id)).get('user')
+        if stored != dict(application.user_data[user_id]):
+            failures.append(f"user {user_id}: stored {stored} != user_data {dict(application.user_data[user_id])}")
+            break
+    if per_update > BENCH_CONVERSATION_MAX_COST:
+        failures.append(f"restore + track cost {per_update * 1e6:.1f} µs per update")
+    
+    print(f"💾 {len(user_ids)} users x {BENCH_CONVERSATION_ROUNDS} flow rounds, concurrency {args.concurrency}: "
+          f"{loaded} lazy loads")
+    print(f"   restore + track: {per_update * 1e6:.2f} µs per update; "
+          f"final flush of {len(user_ids)} users: {flush_seconds * 1000:.1f} ms")
+    return failures
+
+async def measure_replies(request, user_ids, update_ids, submit):
+    """Seconds from ``submit``-ting each user's /balance to the bot's reply, one at a time"""
+    latencies = []
+    for user_id in user_ids:
+        replied = request.replied[user_id] = asyncio.Event()
+        started = time.perf_counter()
+        await submit(bench_message(next(update_ids), user_id, '/balance'))
+        await asyncio.wait_for(replied.wait(), BENCH_REPLY_TIMEOUT)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+async def bench_webhook(args):
+    """End-to-end latency in webhook mode against polling mode.
+    
+    Starts the updater both ways with main()'s settings: the embedded
+    webhook server on a free local port, which is sent the updates over
+    HTTP, and long polling fed by the stub getUpdates. Each user's /balance
+    is timed until the bot replies. Fails if requests without the secret
+    token are handled, if allowed_updates is not ALLOWED_UPDATES, or if a
+    reply does not arrive.
+    """
+    update_ids = itertools.count(1)
+    secret_header = 'X-Telegram-Bot-Api-Secret-Token'
+    failures = []
+    
+    request = RecordingRequest()
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN)
+                                    .request(request).get_updates_request(RecordingRequest()))
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    url = f"http://127.0.0.1:{port}/{bot.WEBHOOK_PATH}"
+    
+    async with application:
+        await application.updater.start_webhook(listen='127.0.0.1', port=port, url_path=bot.WEBHOOK_PATH,
+                                                webhook_url=f"https://bench.invalid/{bot.WEBHOOK_PATH}",
+                                                secret_token=bot.WEBHOOK_SECRET, allowed_updates=bot.ALLOWED_UPDATES)
+        await application.start()
+        
+        async with httpx.AsyncClient() as client:
+            for user_id, headers in ((BENCH_FIRST_USER_ID - 1, {}), (BENCH_FIRST_USER_ID - 2, {secret_header: 'wrong'})):
+                response = await client.post(url, json=bench_message(next(update_ids), user_id, '/balance'), headers=headers)
+                if response.status_code != 403:
+                    failures.append(f"webhook answered {response.status_code} to a request with secret {headers}")
+            
+            async def post(payload):
+                response = await client.post(url, json=payload, headers={secret_header: bot.WEBHOOK_SECRET})
+                response.raise_for_status()
+            
+            try:
+                webhook = await measure_replies(request, [BENCH_FIRST_USER_ID + i for i in range(args.users)],
+                                                update_ids, post)
+            except asyncio.TimeoutError:
+                failures.append("webhook: no reply within BENCH_REPLY_TIMEOUT")
+                webhook = [0.0]
+        
+        await application.updater.stop()
+        await application.stop()
+    
+    if request.texts[BENCH_FIRST_USER_ID - 1] or request.texts[BENCH_FIRST_USER_ID - 2]:
+        failures.append("webhook handled an update without the right secret token")
+    if request.parameters['setWebhook'].get('allowed_updates') != bot.ALLOWED_UPDATES:
+        failures.append(f"setWebhook allowed_updates {request.parameters['setWebhook'].get('allowed_updates')}")
+    
+    request = RecordingRequest()
+    updates_request = RecordingRequest()
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN)
+                                    .request(request).get_updates_request(updates_request))
+    
+    async def feed(payload):
+        updates_request.feed(payload)
+    
+    async with application:
+        await application.updater.start_polling(timeout=1, allowed_updates=bot.ALLOWED_UPDATES)
+        await application.start()
+        try:
+            polling = await measure_replies(request, [BENCH_FIRST_USER_ID + args.users + i for i in range(args.users)],
+                                            update_ids, feed)
+        except asyncio.TimeoutError:
+            failures.append("polling: no reply within BENCH_REPLY_TIMEOUT")
+            polling = [0.0]
+        await application.updater.stop()
+        await application.stop()
+    
+    if updates_request.parameters['getUpdates'].get('allowed_updates') != bot.ALLOWED_UPDATES:
+        failures.append(f"getUpdates allowed_updates {updates_request.parameters['getUpdates'].get('allowed_updates')}")
+    
+    print(f"🌐 /balance from {args.users} users per mode, one update at a time, reply latency:")
+    for mode, latencies in (('webhook', webhook), ('polling', polling)):
+        cuts = statistics.quantiles(latencies * 2, n=100, method='inclusive')
+        print(f"   {mode:<8} p50 {cuts[49] * 1000:.2f} ms, p95 {cuts[94] * 1000:.2f} ms, p99 {cuts[98] * 1000:.2f} ms")
+    return failures
+
+async def measure_throughput(update_processor, level, user_ids):
+    """Updates/s with ``level`` users at a time each sending BENCH_UPDATES_PER_USER
+    /balance updates through application.update_queue and waiting for every reply"""
+    request = RecordingRequest()
+    request.latency = BENCH_API_LATENCY
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN)
+                                    .request(request).get_updates_request(RecordingRequest()),
+                                    update_processor)
+    update_ids = itertools.count(1)
+    
+    async def check_balance_repeatedly(user_id):
+        for _ in range(BENCH_UPDATES_PER_USER):
+            replied = request.replied[user_id] = asyncio.Event()
+            await application.update_queue.put(Update.de_json(bench_message(next(update_ids), user_id, '/balance'),
+                                                              application.bot))
+            await asyncio.wait_for(replied.wait(), BENCH_REPLY_TIMEOUT)
+    
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        await run_concurrently(user_ids, level, check_balance_repeatedly)
+        elapsed = time.perf_counter() - started
+        await application.stop()
+    
+    return len(user_ids) * BENCH_UPDATES_PER_USER / elapsed
+
+async def bench_concurrency(args):
+    """Throughput of concurrent update processing, and in-order handling per user.
+    
+    Updates go through application.update_queue as they do from polling or
+    the webhook, with every Bot API call taking BENCH_API_LATENCY. For each
+    of BENCH_CONCURRENCY_LEVELS that many users send /balance updates, once
+    with PTB's one-at-a-time processor and once with PerUserUpdateProcessor.
+    Then every user who can afford one key queues a product tap and a
+    double tapped "Use Balance" at once. Fails unless each of them got
+    exactly one key, or if concurrency gives less than BENCH_MIN_SPEEDUP
+    from 8 users up.
+    """
+    product = bot.runtime_settings.current.products_by_type[BENCH_KEY_TYPE]
+    next_user_ids = itertools.count(BENCH_FIRST_USER_ID)
+    failures = []
+    
+    print(f"🚦 {BENCH_UPDATES_PER_USER} /balance per user, {BENCH_API_LATENCY * 1000:.0f} ms per Bot API call:")
+    for level in BENCH_CONCURRENCY_LEVELS:
+        sequential = await measure_throughput(SimpleUpdateProcessor(1), level,
+                                              [next(next_user_ids) for _ in range(level)])
+        concurrent = await measure_throughput(None, level, [next(next_user_ids) for _ in range(level)])
+        print(f"   {level:>3} users: sequential {sequential:.0f} updates/s, concurrent {concurrent:.0f} updates/s")
+        if level >= 8 and concurrent < sequential * BENCH_MIN_SPEEDUP:
+            failures.append(f"{level} users: concurrent {concurrent:.0f} updates/s is not "
+                            f"{BENCH_MIN_SPEEDUP}x sequential {sequential:.0f}")
+    
+    request = RecordingRequest()
+    application = bot.build_application(Application.builder().token(BENCH_TOKEN)
+                                    .request(request).get_updates_request(RecordingRequest()))
+    update_ids = itertools.count(1)
+    tappers = [next(next_user_ids) for _ in range(args.users)]
+    seed_bench_users(tappers, product['price'] + product['price'] // 2)
+    bot.bulk_add_keys(BENCH_KEY_TYPE, [f'BENCH-{i}' for i in range(2 * args.users)], bot.ADMIN_IDS[0])
+    
+    async with application:
+        await application.start()
+        # All three taps are queued before the first one is handled
+        for user_id in tappers:
+            for data in (f"product_{product['product_id']}", 'use_balance', 'use_balance'):
+                await application.update_queue.put(Update.de_json(bench_callback(next(update_ids), user_id, data),
+                                                                  application.bot))
+        await asyncio.wait_for(application.update_queue.join(), BENCH_REPLY_TIMEOUT * 10)
+        await application.stop()
+    
+    min_balance, _, used, user_keys, distinct_keys, _ = await bot.run_db(get_sales_ledger, BENCH_KEY_TYPE)
+    print(f"   double tapped Use Balance: {len(tappers)} users, {user_keys} keys sold")
+    
+    if user_keys != len(tappers) or used != len(tappers) or distinct_keys != user_keys:
+        failures.append(f"{len(tappers)} double tapping users got {user_keys} keys "
+                        f"({distinct_keys} distinct, {used} used in stock)")
+    if min_balance < 0:
+        failures.append(f"negative balance: {min_balance}")
+    return failures
+
+class FirstReplyRequest(RecordingRequest):
+    """RecordingRequest for a startup run: on the bot's first reply it prints
+    the time and the startup phases, then stops the bot as Ctrl+C would"""
+    
+    def __init__(self):
+        super().__init__()
+        self.answered = False
+    
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        response = await super().do_request(url, method, request_data, **kwargs)
+        if not self.answered and any(self.texts[BENCH_FIRST_USER_ID]):
+            self.answered = True
+            report = {'replied_at': time.time(), 'phases': bot.startup_timings}
+            print(STARTUP_REPORT_PREFIX + json.dumps(report), flush=True)
+            os.kill(os.getpid(), signal.SIGINT)
+        return response
+
+def run_startup_child():
+    """One startup run: main() on ATOPLAY_DB_PATH, polling a single /balance from the stub"""
+    request = FirstReplyRequest()
+    updates_request = RecordingRequest()
+    updates_request.feed(bench_message(1, BENCH_FIRST_USER_ID, '/balance'))
+    builder = bot.Application.builder
+    bot.Application.builder = lambda: builder().request(request).get_updates_request(updates_request)
+    bot.main()
+
+async def time_startup(db_path):
+    """Launch a bot process on ``db_path``; returns (seconds to its first reply, its startup phases)"""
+    env = {**os.environ, 'ATOPLAY_DB_PATH': db_path}
+    for name in ('ATOPLAY_WEBHOOK_URL', 'ATOPLAY_METRICS_PORT'):
+        env.pop(name, None)
+    
+    launched = time.time()
+    process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), 'startup-child', env=env,
+                                                   stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), BENCH_REPLY_TIMEOUT * 6)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise RuntimeError(f"no reply within {BENCH_REPLY_TIMEOUT * 6} s")
+    
+    for line in stdout.decode().splitlines():
+        if line.startswith(STARTUP_REPORT_PREFIX):
+            report = json.loads(line[len(STARTUP_REPORT_PREFIX):])
+            return report['replied_at'] - launched, report['phases']
+    raise RuntimeError(f"no reply, exit code {process.returncode}: {stderr.decode()[-300:]!r}")
+
+async def bench_startup(args):
+    """Process launch to the first polled update answered, with and without setup work.
+    
+    main() is started BENCH_STARTUP_RUNS times in a new process against a
+    fresh database, which it migrates, then as many times against the first
+    of those databases, where the setup is skipped. getUpdates is the
+    RecordingRequest stub and returns one /balance. Fails if a run gets no
+    reply or if either median is over BENCH_STARTUP_TARGET.
+    """
+    failures = []
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fresh_paths = [os.path.join(temp_dir, f'fresh{run}.db') for run in range(BENCH_STARTUP_RUNS)]
+        cases = (('fresh database', fresh_paths), ('migrated database', fresh_paths[:1] * BENCH_STARTUP_RUNS))
+        
+        print(f"🚀 process launch to first reply, median of {BENCH_STARTUP_RUNS} runs "
+              f"(target {BENCH_STARTUP_TARGET * 1000:.0f} ms):")
+        for case, db_paths in cases:
+            try:
+                runs = [await time_startup(db_path) for db_path in db_paths]
+            except RuntimeError as e:
+                failures.append(f"{case}: {e}")
+                continue
+            
+            seconds = statistics.median(elapsed for elapsed, _ in runs)
+            phases = {phase: statistics.median(timings[phase] for _, timings in runs)
+                      for phase in ('database ready', 'first update')}
+            print(f"   {case:<18} {seconds * 1000:>6.0f} ms (after imports: database ready "
+                  f"{phases['database ready'] * 1000:.0f} ms, first update {phases['first update'] * 1000:.0f} ms)")
+            if seconds > BENCH_STARTUP_TARGET:
+                failures.append(f"{case}: first reply {seconds * 1000:.0f} ms after launch, "
+                                f"target {BENCH_STARTUP_TARGET * 1000:.0f} ms")
+    return failures
+
+# `python bench_bot.py <check>`: scenarios that assert invariants rather than compare to a baseline
+BENCH_CHECKS = {
+    'purchases': bench_purchases,
+    'loop': bench_loop,
+    'admins': bench_admins,
+    'conversation': bench_conversation,
+    'webhook': bench_webhook,
+    'concurrency': bench_concurrency,
+    'startup': bench_startup
+}
+
+@contextmanager
+def bench_database():
+    """Give the bot its own pool on a freshly seeded temporary database for one run.
+    
+    The bot module's db_pool is swapped for the bench pool and put back
+    afterwards. Logs go to a file next to it, keeping their cost in the
+    measurement but out of the terminal.
+    """
+    production_pool = bot.db_pool
+    
+    with tempfile.TemporaryDirectory() as temp_dir:
+        log_file = open(os.path.join(temp_dir, 'bench.log'), 'w')
+        bot.log_handler.setStream(log_file)
+        bot.db_pool = bot.ConnectionPool(os.path.join(temp_dir, 'bench.db'), bot.DB_POOL_SIZE)
+        try:
+            with redirect_stdout(io.StringIO()):
+                bot.seed_db()
+            bot.runtime_settings.load()
+            bot.admin_cache.load()
+            bot.stock_counters.rebuild()
+            yield
+        finally:
+            bot.db_pool.close_all()
+            bot.db_pool = production_pool
+            # Drain the queue into bench.log before switching back to stderr
+            bot.log_listener.stop()
+            bot.log_handler.setStream(sys.stderr)
+            log_file.close()
+            bot.log_listener.start()
+
+def run_benchmark(argv):
+    """`python bench_bot.py [CHECK]`: load-test the handlers on a temporary database.
+    
+    Returns the process exit code: 1 if a metric regressed past the baseline
+    or there is no baseline to compare against (create one with --save-baseline).
+    With a CHECK from BENCH_CHECKS, runs that scenario instead and returns 1
+    if any of its invariants failed.
+    """
+    parser = argparse.ArgumentParser(prog='bench_bot.py',
+                                     description="Simulated-user load test against a temporary database")
+    parser.add_argument('check', nargs='?', choices=sorted(BENCH_CHECKS),
+                        help="run one invariant check instead of the baseline load test")
+    parser.add_argument('--users', type=int, default=BENCH_USERS)
+    parser.add_argument('--concurrency', type=int, default=BENCH_CONCURRENCY)
+    parser.add_argument('--baseline', default=BENCH_BASELINE_PATH, help="JSON results to compare against")
+    parser.add_argument('--save-baseline', action='store_true', help="write this run's results to --baseline")
+    parser.add_argument('--tolerance', type=float, default=BENCH_TOLERANCE,
+                        help="allowed slowdown as a fraction of the baseline")
+    args = parser.parse_args(argv)
+    
+    if args.check:
+        with bench_database():
+            failures = asyncio.run(BENCH_CHECKS[args.check](args))
+        for failure in failures:
+            print(f"❌ {failure}")
+        if not failures:
+            print(f"✅ {args.check}: all checks passed")
+        return 1 if failures else 0
+    
+    with bench_database():
+        bot.bulk_add_keys(BENCH_KEY_TYPE, [f'BENCH-{i}' for i in range(args.users)], bot.ADMIN_IDS[0])
+        latencies, elapsed = asyncio.run(run_benchmark_load(args.users, args.concurrency))
+    
+    results = summarize_benchmark(latencies, elapsed, args.users, args.concurrency)
+    
+    print(f"📊 {results['users']} users, concurrency {results['concurrency']}: {results['updates']} updates "
+          f"in {results['seconds']:.1f} s = {results['updates_per_second']:.0f} updates/s")
+    print(f"{'step':<26}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, row in [*results['steps'].items(), ('all', {'count': results['updates'], **results})]:
+        print(f"{step:<26}{row['count']:>8}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}{row['p99_ms']:>10.2f}")
+    
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f"✅ Baseline saved to {args.baseline}")
+        return 0
+    
+    # A missing baseline fails the run so that regressions cannot pass unnoticed
+    if not os.path.exists(args.baseline):
+        print(f"❌ No baseline at {args.baseline}; run with --save-baseline to create one")
+        return 1
+    
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if (baseline['users'], baseline['concurrency']) != (results['users'], results['concurrency']):
+        print(f"⚠️ Baseline was run with {baseline['users']} users, concurrency {baseline['concurrency']}")
+    
+    regressions = compare_benchmark(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f"❌ Regression: {regression}")
+    if not regressions:
+        print(f"✅ Within {args.tolerance:.0%} of the baseline")
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['startup-child']:
+        run_startup_child()
+    else:
+        sys.exit(run_benchmark(sys.argv[1:]))